@@ -0,0 +1,38 @@
+import time
+import numpy as np
+import pyarrow as pa
+from wombat_db.ops.join import join
+from wombat_db.ops.helpers import groupify_array, groupify_strategy, COUNTING_MAX_RANGE
+
+# Benchmark matrix of the join & groupify strategies, with the strategy chosen at runtime (*)
+rng = np.random.default_rng(0)
+
+def timed(f, repeat=3):
+    ts = []
+    for _ in range(repeat):
+        ti = time.time()
+        f()
+        ts.append(time.time() - ti)
+    return min(ts)
+
+print("Join: rows left x rows right, distinct keys, unique left keys, sorted keys")
+for left_size, right_size, keys, unique, ordered in [(1e2, 1e6, 1e2, False, False), (1e2, 1e6, 1e2, True, False), (1e4, 1e6, 1e4, True, False), (1e5, 1e6, 1e5, False, False), (1e5, 1e6, 1e5, True, False),
+                                                      (1e6, 1e6, 1e5, False, False), (1e6, 1e6, 1e6, False, False), (1e6, 1e6, 1e5, False, True), (1e5, 1e6, 1e5, False, True)]:
+    ids = (rng.permutation(int(keys))[:int(left_size)] if unique else rng.integers(0, keys, int(left_size)))
+    l = pa.Table.from_arrays([ids, rng.random(int(left_size))], names=['id', 'salary'])
+    r = pa.Table.from_arrays([rng.integers(0, keys, int(right_size)), rng.random(int(right_size))], names=['id', 'age'])
+    if ordered:
+        l, r = l.take(np.argsort(l.column('id').to_numpy())), r.take(np.argsort(r.column('id').to_numpy()))
+    profile = {}
+    join(l, r, on=['id'], profile=profile)
+    chosen = profile['strategy']
+    times = {s: timed(lambda: join(l, r, on=['id'], strategy=s)) for s in ['broadcast', 'partitioned'] + (['sort-merge'] if ordered else [])}
+    print("{:.0e} x {:.0e}, {:.0e} keys, unique: {}, sorted: {}".format(left_size, right_size, keys, unique, ordered).ljust(50), "  ".join("{}{}: {:.4f}s".format(s, ('*' if s == chosen else ''), t) for s, t in times.items()))
+
+print("Groupify: rows, distinct values, value range")
+for size, distinct, spread in [(1e4, 10, 1), (1e6, 10, 1), (1e6, 1e4, 1), (1e6, 1e5, 1), (1e6, 1e6, 1), (1e6, 100, 1e9), (1e7, 1e3, 1), (1e7, 1e3, 1e9)]:
+    arr = rng.integers(0, distinct, int(size)) * int(spread)
+    chosen = groupify_strategy(arr)[0]
+    strategies = ['hash', 'sort'] + (['counting'] if arr.max() - arr.min() < 16 * COUNTING_MAX_RANGE else [])
+    times = {s: timed(lambda: groupify_array(arr, s)) for s in strategies}
+    print("{:.0e} rows, {:.0e} distinct, range {:.0e}".format(size, distinct, distinct * spread).ljust(50), "  ".join("{}{}: {:.4f}s".format(s, ('*' if s == chosen else ''), t) for s, t in times.items()))
@@ -0,0 +1,50 @@
+import time, tempfile, shutil, os, contextlib, io
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from wombat_db import Engine
+from wombat_db.datasets.table import ParquetUniqueDataset
+
+# Row groups the DatasetNode statistics pruning reads for range filters on two columns, with the files of a unique dataset
+# in key order, sorted by the columns & clustered in Z-order on them (optimize)
+rng = np.random.default_rng(0)
+directory = tempfile.mkdtemp()
+rows, partitions = 250_000, 4
+for p in range(partitions):
+    os.makedirs(directory + '/part={}'.format(p))
+    t = pa.table({'id': rng.permutation(rows), 'a': rng.integers(0, 1000, rows), 'b': rng.integers(0, 1000, rows), 'value': rng.random(rows)})
+    pq.write_table(t, directory + '/part={}/file0.parquet'.format(p))
+
+queries = {
+    'a range': [('a', '>=', 100), ('a', '<', 150)],
+    'b range': [('b', '>=', 100), ('b', '<', 150)],
+    'a & b range': [('a', '>=', 100), ('a', '<', 200), ('b', '>=', 100), ('b', '<', 200)],
+    'a = & b range': [('a', '=', 500), ('b', '>=', 100), ('b', '<', 200)],
+}
+
+def measure(layout):
+    db = Engine()
+    db.register_dataset('t', pq.ParquetDataset(directory))
+    results = []
+    for name, filters in queries.items():
+        explain = db['t'].filter(filters).select(['id', 'value']).explain()
+        scan = next(info for _, info in explain.nodes() if info['node'] == 'DatasetNode')
+        ti = time.time()
+        db['t'].filter(filters).select(['id', 'value']).collect()
+        results.append("{}: {} ({:.3f}s)".format(name, scan['row_groups_read'], time.time() - ti))
+    print(layout.ljust(12), "  ".join(results))
+
+print("Row groups read (of {} rows per row group)".format(10_000))
+with contextlib.redirect_stdout(io.StringIO()):
+    ParquetUniqueDataset(directory, row_group_size=10_000).set_unique(['id']).cleanup()
+measure('id order')
+with contextlib.redirect_stdout(io.StringIO()):
+    ParquetUniqueDataset(directory, row_group_size=10_000, sort_by=['a', 'b']).set_unique(['id']).cleanup()
+measure('sorted a, b')
+with contextlib.redirect_stdout(io.StringIO()):
+    ti = time.time()
+    ParquetUniqueDataset(directory, row_group_size=10_000).set_unique(['id']).optimize(zorder_by=['a', 'b'])
+    took = time.time() - ti
+measure('z-order a, b')
+print("Optimize: {:.2f}s".format(took))
+shutil.rmtree(directory)
@@ -1,6 +1,7 @@
 from wombat_db import Engine, head
 import pyarrow as pa
 import pyarrow.parquet as pq
+import numpy as np
 
 # Avoid initial take() time
 t1 = pq.ParquetDataset('data/skus/org_key=0/file0.parquet').read(columns=['sku_key'])
@@ -81,3 +82,466 @@ head(r)
 
 
 
+
+# Aggregates are pre-aggregated below the join, results equal the unoptimized plan
+def stock_per_option(db):
+    return db['stock_current'] \
+        .filter([('org_key', '=', 0), ('store_key', '<=', 200)]) \
+        .join(db['skus'], on=['org_key', 'sku_key']) \
+        .aggregate(by=['option_key'], methods={'economical': 'sum', 'economical avg': ('economical', 'mean')}) \
+        .orderby('option_key') \
+        .collect()
+
+db_raw = Engine(optimize=False)
+db_raw.register_dataset('skus', d1)
+db_raw.register_dataset('stock_current', d2)
+r1, r2 = stock_per_option(db), stock_per_option(db_raw)
+assert r1.column_names == r2.column_names
+assert all(np.allclose(r1.column(c).to_numpy(), r2.column(c).to_numpy()) for c in r1.column_names)
+
+# Distinct counts of columns the min / max do not bound (strings, floats, dates) are estimated from a sample of row groups
+import os, shutil, tempfile
+names_dir = tempfile.mkdtemp()
+pq.write_table(pa.table({'name': ['n{}'.format(i % 500) for i in range(20000)], 'x': np.random.random(20000)}), names_dir + '/names.parquet', row_group_size=5000)
+db_ndv = Engine()
+db_ndv.register_dataset('names', pq.ParquetDataset(names_dir))
+assert db_ndv.catalog['names'].ndv('name') == 500 and db_ndv.catalog['names'].ndv('x') == 20000
+assert db_ndv.catalog['names'].selectivity([('name', '=', 'n1')]) == 1 / 500
+shutil.rmtree(names_dir)
+
+# Explain the optimized plan, or execute it and profile every node
+print(df.explain())
+profile = df.explain(analyze=True)
+print(profile)
+assert profile.to_dict()['plan']['rows_out'] == r.num_rows
+assert len(profile.to_chrome_trace()['traceEvents']) > 0
+
+# Under a memory limit the aggregate streams the pieces, joins that do not fit raise MemoryLimitError
+from wombat_db.engine.memory import MemoryLimitError, NODE_POOLS
+def stock_per_sku(db, **kwargs):
+    return db['stock_current'] \
+        .aggregate(by=['sku_key'], methods={'economical': 'sum', 'economical avg': ('economical', 'mean')}) \
+        .orderby('sku_key') \
+        .collect(**kwargs)
+
+r1, r2 = stock_per_sku(db_raw), stock_per_sku(db_raw, memory_limit=2e6)
+assert all(np.allclose(r1.column(c).to_numpy(), r2.column(c).to_numpy()) for c in r1.column_names)
+try:
+    db_raw['stock_current'].join(db_raw['skus'], on=['org_key', 'sku_key']).collect(memory_limit=2e6)
+    assert False
+except MemoryLimitError:
+    pass
+
+# Node pools are reused by later queries, up to a maximum number of pools
+from wombat_db.engine import memory
+max_pools, memory.MAX_NODE_POOLS = memory.MAX_NODE_POOLS, len(NODE_POOLS) + 1
+for _ in range(20):
+    stock_per_sku(db_raw, memory_limit=2e6)
+assert len(NODE_POOLS) == memory.MAX_NODE_POOLS
+memory.MAX_NODE_POOLS = max_pools
+
+# Tracers receive the plan, optimizer, node, piece read & kernel events of every query
+from wombat_db.engine.tracing import Tracer
+class EventCounter(Tracer):
+    def __init__(self):
+        self.counts = {}
+
+    def event(self, name, fields):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+counter = db_raw.add_tracer(EventCounter())
+stock_per_sku(db_raw)
+db_raw.remove_tracer(counter)
+assert all(counter.counts.get(e) for e in ['plan_built', 'node_start', 'node_end', 'piece_read', 'kernel_call'])
+
+# Concurrent collects are safe, identical subtrees computed at the same time are computed once
+import threading
+from concurrent.futures import ThreadPoolExecutor
+def overlapping_plan(db, i):
+    plan = db['stock_current'].filter([('org_key', '=', 0), ('store_key', '<=', 20)])
+    if i % 2:
+        plan = plan.join(db['skus'], on=['org_key', 'sku_key'])
+    return plan.aggregate(by=['sku_key'], methods={'economical': 'sum'}).orderby('sku_key')
+
+for cache_memory in [0, 1e9, 1e5]:
+    db_conc = Engine(cache_memory=cache_memory)
+    db_conc.register_dataset('skus', d1)
+    db_conc.register_dataset('stock_current', d2)
+    expected = [overlapping_plan(db_conc, i).collect() for i in range(2)]
+    barrier = threading.Barrier(16)
+    def run(i):
+        plan = overlapping_plan(db_conc, i)
+        barrier.wait()
+        return plan.collect()
+    with ThreadPoolExecutor(16) as ex:
+        results = list(ex.map(run, range(16)))
+    assert all(r.equals(expected[i % 2]) for i, r in enumerate(results))
+
+# Asyncio: queries run on the engine's executor, cancelling the task stops the piece reads
+import asyncio
+async def async_queries():
+    results = await asyncio.gather(*[overlapping_plan(db_conc, i).collect_async() for i in range(4)])
+    assert all(r.equals(expected[i % 2]) for i, r in enumerate(results))
+
+    tables = [t async for t in db_conc['stock_current'].filter(('store_key', '<=', 20)).select(['sku_key', 'economical']).stream_async()]
+    assert sum(t.num_rows for t in tables) == db_conc['stock_current'].filter(('store_key', '<=', 20)).select(['sku_key', 'economical']).collect().num_rows
+
+    task = asyncio.ensure_future(db_conc['stock_current'].select(['sku_key']).collect_async())
+    await asyncio.sleep(0)
+    task.cancel()
+    try:
+        await task
+        assert False
+    except asyncio.CancelledError:
+        pass
+asyncio.run(async_queries())
+
+# Batch execution: shared subtrees are computed once and scans of the same source are merged, also without cache
+def report_plans(db):
+    stock = lambda: db['stock_current'].filter([('org_key', '=', 0), ('store_key', '<=', 20)])
+    plans = [stock().join(db['skus'], on=['org_key', 'sku_key']).aggregate(by=['option_key'], methods={'economical': m}).orderby('option_key') for m in ['sum', 'max', 'mean']]
+    return plans + [stock().aggregate(by=['sku_key'], methods={'technical': 'sum'}).orderby('sku_key')]
+
+db_batch = Engine()
+db_batch.register_dataset('skus', d1)
+db_batch.register_dataset('stock_current', d2)
+for r1, r2 in zip([p.collect() for p in report_plans(db_batch)], db_batch.collect_many(report_plans(db_batch))):
+    assert r1.column_names == r2.column_names
+    assert all(np.allclose(r1.column(c).to_numpy(), r2.column(c).to_numpy()) for c in r1.column_names)
+
+# Runtime join filters still apply in a batch when the probe side is not shared with other plans
+from wombat_db.engine.optimizer import walk
+from wombat_db.engine.nodes import JoinNode
+plans = [report_plans(db_batch)[0], db_batch['skus'].aggregate(by=['option_key'], methods={'sku_key': 'count'})]
+db_batch.collect_many(plans)
+assert [n.runtime_pushed for n in walk(plans[0].last) if isinstance(n, JoinNode)][0]
+
+# A plan reading all the columns of a merged scan uses it too, the scan is read once
+db_scans = Engine()
+db_scans.register_dataset('stock_current', d2)
+scans = lambda: [db_scans['stock_current'].filter([('org_key', '=', 0), ('store_key', '<=', 20)]).select(['sku_key', 'economical', 'technical']),
+                 db_scans['stock_current'].filter([('org_key', '=', 0), ('store_key', '<=', 20)]).aggregate(by=['sku_key'], methods={'economical': 'sum'})]
+counter = db_scans.add_tracer(EventCounter())
+single = scans()[0].collect()
+reads, counter.counts = counter.counts['piece_read'], {}
+batched = db_scans.collect_many(scans())
+db_scans.remove_tracer(counter)
+assert counter.counts['piece_read'] == reads and batched[0].equals(single)
+
+# Materialized views: refreshed with only the pieces added to the dataset, persisted to survive restarts
+import os, shutil, tempfile
+view_dir = tempfile.mkdtemp()
+stores = sorted(os.listdir('data/stock_current/org_key=0'))
+shutil.copytree('data/stock_current', view_dir + '/stock', ignore=lambda d, files: [f for f in files if f in stores[len(stores) // 2:]])
+def stock_view(db):
+    return db['stock'].filter(('technical', '>', 50)).aggregate(by=['sku_key'], methods={'economical': 'sum', 'technical avg': ('technical', 'mean')})
+
+db_view = Engine()
+db_view.register_dataset('stock', pq.ParquetDataset(view_dir + '/stock'))
+view = db_view.create_materialized_view('stock_view', stock_view(db_view), path=view_dir + '/stock_view.parquet')
+for s in stores[len(stores) // 2:]:
+    shutil.copytree('data/stock_current/org_key=0/' + s, view_dir + '/stock/org_key=0/' + s)
+db_view.refresh()
+db_view2 = Engine()
+db_view2.register_dataset('stock', pq.ParquetDataset(view_dir + '/stock'))
+db_view2.create_materialized_view('stock_view', stock_view(db_view2), path=view_dir + '/stock_view.parquet')
+r1 = stock_view(db_view2).orderby('sku_key').collect()
+for db_v in [db_view, db_view2]:
+    r2 = db_v['stock_view'].select().orderby('sku_key').collect()
+    assert view.mode == 'aggregate' and r1.column_names == r2.column_names
+    assert all(np.allclose(r1.column(c).to_numpy(), r2.column(c).to_numpy()) for c in r1.column_names)
+shutil.rmtree(view_dir)
+
+# Appends: cached aggregates over a table are updated with only the appended rows
+stock_table = d2.read(columns=['sku_key', 'store_key', 'economical', 'technical'])
+def stock_sums(db):
+    return db['stock_table'].filter(('store_key', '<', 40)).aggregate(by=['sku_key'], methods={'economical': 'sum', 'technical avg': ('technical', 'mean'), 'n': ('technical', 'count')}).orderby('sku_key')
+
+db_append = Engine(cache_memory=1e9)
+db_append.register_table('stock_table', stock_table.slice(0, 100000))
+stock_sums(db_append).collect()
+for i in range(1, 5):
+    db_append.append('stock_table', stock_table.slice(100000 * i, 100000))
+    r1 = stock_sums(db_append).collect()
+db_full = Engine()
+db_full.register_table('stock_table', stock_table.slice(0, 500000))
+r2 = stock_sums(db_full).collect()
+assert r1.column_names == r2.column_names
+assert all(np.allclose(r1.column(c).to_numpy(), r2.column(c).to_numpy()) for c in r1.column_names)
+
+# Indexes on registered tables: binary search / hash lookups instead of a filter scan, rebuilt after appends
+def indexed_queries(db):
+    return [db['stock_table'].filter([('sku_key', 'in', [3, 17, 250, 10**9])]).select(),
+            db['stock_table'].filter([('store_key', '=', 5), ('sku_key', '>=', 100), ('sku_key', '<', 200), ('technical', '>', 0)]).select(),
+            db['stock_table'].filter([('store_key', '>', 45)]).select()]
+
+db_index = Engine()
+db_index.register_table('stock_table', stock_table)
+db_index.create_index('stock_table', 'sku_key', kind='hash')
+db_index.create_index('stock_table', ['store_key', 'sku_key'])
+db_index.append('stock_table', stock_table.slice(0, 1000))
+db_full.register_table('stock_table', pa.concat_tables([stock_table, stock_table.slice(0, 1000)]))
+for p1, p2 in zip(indexed_queries(db_index), indexed_queries(db_full)):
+    assert p1.collect().equals(p2.collect())
+    assert p1.explain(analyze=True).tree['children'][0]['children'][0].get('index') is not None
+
+# Adaptive join & groupify strategies: all give the same result, the chosen one is reported in the explain profile
+from wombat_db import join
+from wombat_db.ops.helpers import groupify_array
+skus, stock = d1.read(columns=['sku_key', 'option_key']), stock_table.slice(0, 100000)
+stock_sorted = stock.take(np.argsort(stock.column('sku_key').to_numpy(), kind='stable'))
+skus_sorted = skus.take(np.argsort(skus.column('sku_key').to_numpy(), kind='stable'))
+def canonical(t):
+    return t.select(sorted(t.column_names)).take(np.lexsort([t.column(c).to_numpy() for c in sorted(t.column_names)]))
+joins = [canonical(join(stock_sorted, skus_sorted, on=['sku_key'], strategy=s)) for s in ['sort-merge', 'broadcast', 'partitioned']]
+assert joins[0].num_rows == stock.num_rows and all(j.equals(joins[0]) for j in joins)
+arr = stock.column('sku_key').to_numpy()
+groups = [groupify_array(arr, s) for s in ['counting', 'hash', 'sort']]
+assert all(np.array_equal(g[0], groups[0][0]) and np.array_equal(g[1], groups[0][1]) and np.array_equal(arr[g[2]], arr[groups[0][2]]) for g in groups)
+
+p = db_full['stock_table'].join(db_full['stock_table'].aggregate(by=['sku_key'], methods={'n': ('store_key', 'count')}), on=['sku_key']).select(['sku_key', 'n'])
+p.collect()
+explained = str(p.explain(analyze=True))
+assert 'strategy: counting' in explained and 'strategy: broadcast' in explained
+
+# Approximate queries: a reproducible sample of the row groups, sums & counts scaled with error estimates
+def stock_totals(db):
+    return db['stock_current'].filter(('technical', '>', 10)).aggregate(by=['org_key'], methods={'economical': 'sum', 'n': ('technical', 'count'), 'technical avg': ('technical', 'mean')})
+
+exact, approx = stock_totals(db_batch).collect(), stock_totals(db_batch).collect(sample=0.25, seed=3)
+assert approx.equals(stock_totals(db_batch).collect(sample=0.25, seed=3))
+for c in ['economical', 'n', 'technical avg']:
+    value, error, true = approx.column(c).to_numpy()[0], approx.column(c + ' error').to_numpy()[0], exact.column(c).to_numpy()[0]
+    assert 0 < error and abs(value - true) < 5 * error
+assert stock_totals(db_batch).collect().equals(exact)
+
+# Unique datasets: partitions are upserted / deleted in parallel (last upserted row per key wins)
+from wombat_db.datasets.table import ParquetUniqueDataset, PartitionError, CHECKPOINT, write_deletes, deletes_path, write_tag
+from wombat_db import drop_duplicates
+import pyarrow.compute as pc
+import contextlib, io
+unique_dir = tempfile.mkdtemp()
+shutil.copytree('data/stock_current', unique_dir + '/stock')
+plain = lambda t: pa.table({c: (t.column(c).cast(pa.string()) if pa.types.is_dictionary(t.column(c).type) else t.column(c)) for c in t.column_names})
+sorted_keys = lambda t: plain(t).take(np.lexsort([t.column('sku_key').to_numpy(), plain(t).column('store_key').to_numpy()]))
+uds = ParquetUniqueDataset(unique_dir + '/stock', max_workers=8).set_unique(['store_key', 'sku_key'])
+current = plain(uds.read())
+updates = current.take(np.arange(0, current.num_rows, 7))
+updates = updates.set_column(updates.column_names.index('economical'), 'economical', pa.array(np.zeros(updates.num_rows)))
+with contextlib.redirect_stdout(io.StringIO()):
+    uds.upsert(pa.concat_tables([updates, updates.slice(0, 10)]))
+    uds.delete(current.slice(0, 100))
+keys = lambda t: list(zip(t.column('store_key').to_pylist(), t.column('sku_key').to_pylist()))
+deleted = set(keys(current.slice(0, 100)))
+expected = drop_duplicates(pa.concat_tables([current, updates]), on=['store_key', 'sku_key'], keep='last')
+expected = expected.filter(pa.array([k not in deleted for k in keys(expected)]))
+assert sorted_keys(uds.read()).select(current.column_names).equals(sorted_keys(expected).select(current.column_names))
+
+# Deletes are written as deletion vectors, which the engine applies when reading the pieces
+assert any(f.endswith('.deletes') for f in os.listdir(unique_dir + '/stock/org_key=0/store_key=0'))
+db_unique = Engine()
+db_unique.register_dataset('stock', pq.ParquetDataset(unique_dir + '/stock'))
+assert not deleted & set(keys(plain(db_unique['stock'].select(['store_key', 'sku_key']).collect())))
+# The vectors are found at registration, from the transaction log: a vector of an uncommitted write is not applied
+piece = db_unique.catalog['stock'].pieces[0].path
+uncommitted = deletes_path(piece, write_tag(10**6))
+write_deletes(uncommitted, np.ones(pq.read_metadata(piece).num_rows, dtype=bool))
+db_unique.refresh('stock')
+assert db_unique['stock'].filter([('store_key', '=', db_unique.catalog['stock'].partition_values[0]['store_key'])]).collect().num_rows > 0
+os.remove(uncommitted)
+
+# Upserts append sorted delta files, merged on read (last writer wins) until they are compacted into the base files
+partition = unique_dir + '/stock/org_key=0/store_key=1'
+with contextlib.redirect_stdout(io.StringIO()):
+    uds.upsert(updates.slice(100, 100))
+    expected = drop_duplicates(pa.concat_tables([expected, updates.slice(100, 100)]), on=['store_key', 'sku_key'], keep='last')
+    assert any(f.startswith('_delta-') for f in os.listdir(partition))
+    assert sorted_keys(uds.read()).select(current.column_names).equals(sorted_keys(expected).select(current.column_names))
+    uds.compact()
+assert not any(f.startswith('_delta-') or f.endswith('.deletes') for f in os.listdir(partition))
+assert sorted_keys(pq.ParquetDataset(unique_dir + '/stock').read()).select(current.column_names).equals(sorted_keys(expected).select(current.column_names))
+
+# Size-triggered compaction runs in the background, the next read waits for it
+uds_small = ParquetUniqueDataset(unique_dir + '/stock', max_deltas=2).set_unique(['store_key', 'sku_key'])
+with contextlib.redirect_stdout(io.StringIO()):
+    uds_small.upsert(updates.slice(200, 10))
+    uds_small.upsert(updates.slice(210, 10))
+    expected = drop_duplicates(pa.concat_tables([expected, updates.slice(200, 20)]), on=['store_key', 'sku_key'], keep='last')
+    assert sorted_keys(uds_small.read()).select(current.column_names).equals(sorted_keys(expected).select(current.column_names))
+assert not any(f.startswith('_delta-') for ds in uds_small.deltas.values() for f in ds)
+
+# Every write commits a version to the transaction log, older versions can be read (until vacuum)
+uds = ParquetUniqueDataset(unique_dir + '/stock').set_unique(['store_key', 'sku_key'])
+assert uds.version == uds_small.version and [v['version'] for v in uds.history()] == list(range(uds.version + 1))
+assert sorted_keys(uds.as_of(0).read()).select(current.column_names).equals(sorted_keys(current).select(current.column_names))
+try:
+    uds.as_of(0).delete(current.slice(0, 1))
+    assert False
+except Exception as e:
+    assert 'read only' in str(e)
+uds.vacuum()
+
+# Writers that loaded the same version race for the next one: the loser fails without touching the files of the winner
+uds_a, uds_b = [ParquetUniqueDataset(unique_dir + '/stock').set_unique(['store_key', 'sku_key']) for _ in range(2)]
+with contextlib.redirect_stdout(io.StringIO()):
+    uds_a.upsert(updates.slice(300, 5))
+    expected = drop_duplicates(pa.concat_tables([expected, updates.slice(300, 5)]), on=['store_key', 'sku_key'], keep='last')
+    try:
+        uds_b.upsert(updates.slice(300, 5).set_column(updates.column_names.index('economical'), 'economical', pa.array(np.ones(5))))
+        assert False
+    except Exception as e:
+        assert 'another writer' in str(e)
+    uds = ParquetUniqueDataset(unique_dir + '/stock').set_unique(['store_key', 'sku_key'])
+    assert sorted_keys(uds.read()).select(current.column_names).equals(sorted_keys(expected).select(current.column_names))
+    assert uds.get(updates.slice(300, 5)).num_rows == 5
+
+# A partition that fails after writing some of its files leaves none of them
+import wombat_db.datasets.table as table_module
+def broken_stats(path):
+    raise Exception("disk full")
+listing = lambda: sorted(os.path.join(d, f) for d, _, fs in os.walk(unique_dir + '/stock') for f in fs)
+files, file_stats, table_module.file_stats = listing(), table_module.file_stats, broken_stats
+try:
+    with contextlib.redirect_stdout(io.StringIO()):
+        uds.upsert(updates.slice(400, 5))
+    assert False
+except PartitionError as e:
+    assert all('disk full' in str(f) for f in e.failures.values())
+finally:
+    table_module.file_stats = file_stats
+assert listing() == files
+
+# Files are written sorted by the unique columns & split in files of about file_size bytes, so their key ranges do not overlap
+uds = ParquetUniqueDataset(unique_dir + '/stock', file_size=20000, row_group_size=200).set_unique(['store_key', 'sku_key'])
+versions = len(uds.history())
+with contextlib.redirect_stdout(io.StringIO()):
+    uds.cleanup()
+assert len(uds.history()) == versions + 1 and uds.history()[-1]['operation'] == 'cleanup'
+files = sorted((p.path for p in uds.pieces if '/store_key=0/' in p.path), key=lambda p: int(p.split('-')[-1][:-len('.parquet')]))
+ranges = [(m.row_group(0).column(0).statistics.min, m.row_group(m.num_row_groups - 1).column(0).statistics.max) for m in map(pq.read_metadata, files)]
+assert len(files) > 1 and all(hi < lo for (_, hi), (lo, _) in zip(ranges[:-1], ranges[1:]))
+assert sorted_keys(uds.read()).select(current.column_names).equals(sorted_keys(expected).select(current.column_names))
+
+# Bloom filters hash strings vectorized (the same plain, dictionary encoded or chunked) & keep their bits packed
+from wombat_db.ops.bloom import BloomFilter, hash_array, hash_columns
+names = pa.array(['sku-{}'.format(i) for i in range(1000)])
+assert (hash_array(names.dictionary_encode()) == hash_array(names)).all() and (hash_array(pa.chunked_array([names.slice(0, 7), names.slice(7)])) == hash_array(names)).all()
+bloom = BloomFilter.from_table(pa.table({'name': names}), ['name'])
+others = pa.table({'name': ['x-{}'.format(i) for i in range(1000)]})
+assert bloom.contains(hash_columns(pa.table({'name': names}), ['name'])).all() and bloom.contains(hash_columns(others, ['name'])).mean() < 0.05 and bloom.nbytes == (bloom.m + 7) // 8
+
+# Point lookups only read the row groups of the files whose bloom filter & min / max can hold the keys
+wanted = expected.take(np.arange(0, expected.num_rows, 20))
+with contextlib.redirect_stdout(io.StringIO()):
+    uds.upsert(wanted.slice(0, 10))
+    uds.delete(wanted.slice(10, 10))
+lookup = pa.concat_tables([wanted.select(['org_key', 'store_key', 'sku_key']), pa.table({'org_key': ['0'], 'store_key': ['0'], 'sku_key': pa.array([10**6])})])
+found = ParquetUniqueDataset(unique_dir + '/stock').set_unique(['store_key', 'sku_key']).get(lookup)
+assert sorted_keys(found).select(current.column_names).equals(sorted_keys(pa.concat_tables([wanted.slice(0, 10), wanted.slice(20)])).select(current.column_names))
+
+# Clustering in Z-order on two columns lets the row group statistics prune filters on the second column too
+expected = plain(uds.read())
+def scanned(filters):
+    db_z = Engine()
+    db_z.register_dataset('stock', pq.ParquetDataset(unique_dir + '/stock'))
+    return next(i for _, i in db_z['stock'].filter(filters).select(['sku_key']).explain().nodes() if i['node'] == 'DatasetNode')['row_groups_read']
+before = scanned([('economical', '<', 10.0)])
+with contextlib.redirect_stdout(io.StringIO()):
+    uds.optimize(zorder_by=['sku_key', 'economical'])
+assert int(scanned([('economical', '<', 10.0)]).split('/')[0]) < int(before.split('/')[0]) * 2 / 3
+assert sorted_keys(uds.read()).select(current.column_names).equals(sorted_keys(expected).select(current.column_names))
+
+# Footers, bloom filters & (packed) deletion vectors are cached within metadata_memory bytes (least recently used evicted first)
+uds = ParquetUniqueDataset(unique_dir + '/stock', cache_memory=0, metadata_memory=2000).set_unique(['store_key', 'sku_key'])
+wanted = expected.take(np.arange(0, expected.num_rows, 50))
+with contextlib.redirect_stdout(io.StringIO()):
+    assert sorted_keys(uds.get(wanted)).select(current.column_names).equals(sorted_keys(wanted).select(current.column_names))
+    stats = uds.metadata.stats()
+    assert 0 < stats['memory'] <= 2000 and stats['evictions'] > 0
+
+# The table cache is bounded (least recently used files are evicted), files replaced since they were cached are read again
+uds = ParquetUniqueDataset(unique_dir + '/stock', cache_memory=50000, cache_mmap=True).set_unique(['store_key', 'sku_key'])
+with contextlib.redirect_stdout(io.StringIO()):
+    assert sorted_keys(uds.read()).select(current.column_names).equals(sorted_keys(expected).select(current.column_names))
+    stats = uds.tables.stats()
+    assert stats['memory'] <= 50000 and stats['evictions'] > 0 and stats['mapped'] == stats['tables'] > 0
+    path = uds.tables.keys()[-1]
+    pq.write_table(pq.read_table(path).slice(0, 10), path)
+    assert uds.read_file(path).num_rows == 10 and uds.tables.stats()['invalidations'] == 1
+    uds.tables.clear()
+    assert uds.tables.stats()['memory'] == 0
+
+# The change feed records the rows each upsert & delete changed, applied to an older read they give the current rows
+uds = ParquetUniqueDataset(unique_dir + '/stock', change_feed=True).set_unique(['store_key', 'sku_key'])
+with contextlib.redirect_stdout(io.StringIO()):
+    old, version = plain(uds.read()), uds.version
+    changed = old.slice(0, 3).set_column(old.column_names.index('economical'), 'economical', pa.array(np.full(3, -1.0)))
+    uds.upsert(pa.concat_tables([changed, changed.slice(0, 2).set_column(old.column_names.index('sku_key'), 'sku_key', pa.array([10**6, 10**6 + 1]))]))
+    uds.delete(old.slice(10, 2))
+    uds.compact()
+    changes = uds.changes(version)
+    assert [changes.column('_change_type').to_pylist().count(c) for c in ['insert', 'update_preimage', 'update_postimage', 'delete']] == [2, 3, 3, 2]
+    removed = set(keys(changes.filter(pc.is_in(changes.column('_change_type'), value_set=pa.array(['update_preimage', 'delete'])))))
+    applied = pa.concat_tables([old.filter(pa.array([k not in removed for k in keys(old)])), changes.filter(pc.is_in(changes.column('_change_type'), value_set=pa.array(['insert', 'update_postimage']))).select(old.column_names)])
+    assert sorted_keys(applied).select(current.column_names).equals(sorted_keys(uds.read()).select(current.column_names))
+try:
+    uds.changes(0)
+    assert False
+except Exception as e:
+    assert 'no change data' in str(e)
+
+# Registered in the engine, queries read the version of the dataset when they are prepared (merging deltas & deletes), or as_of a version
+db_unique = Engine(cache_memory=1e9)
+db_unique.register_dataset('stock', uds)
+columns = current.column_names
+version, before = uds.version, sorted_keys(db_unique['stock'].select(columns).collect())
+assert before.equals(sorted_keys(uds.read()).select(columns))
+with contextlib.redirect_stdout(io.StringIO()):
+    latest = plain(uds.read())
+    changed = latest.slice(0, 20).set_column(latest.column_names.index('economical'), 'economical', pa.array(np.full(20, -2.0)))
+    uds.upsert(changed)
+    uds.delete(latest.slice(100, 5))
+    assert db_unique['stock'].filter([('economical', '=', -2.0)]).select(columns).collect().num_rows == 20
+    assert sorted_keys(db_unique['stock'].select(columns).collect()).equals(sorted_keys(uds.read()).select(columns))
+    assert sorted_keys(db_unique.select('stock', as_of=version).select(columns).collect()).equals(before)
+    db_many = Engine()
+    db_many.register_dataset('stock', uds)
+    # Scans of different versions are not merged
+    batched = db_many.collect_many([db_many.select('stock').select(['sku_key', 'economical']), db_many.select('stock', as_of=version).select(['economical', 'technical'])])
+    assert batched[0].column('economical').to_numpy().sum() == uds.read().column('economical').to_numpy().sum()
+    assert batched[1].column('economical').to_numpy().sum() == before.column('economical').to_numpy().sum()
+    # Queries do not wait for a running background compaction, nor raise its failures (the writer does)
+    release, latest = threading.Event(), sorted_keys(uds.read()).select(columns)
+    uds.compaction, uds.compaction_failures = threading.Thread(target=release.wait), {('0',): Exception('compaction failed')}
+    uds.compaction.start()
+    assert sorted_keys(db_many['stock'].select(columns).collect()).equals(latest)
+    release.set()
+    try:
+        uds.wait()
+        assert False
+    except PartitionError:
+        pass
+
+# Loading starts from the latest checkpoint of the manifest (written every CHECKPOINT versions)
+loaded = ParquetUniqueDataset(unique_dir + '/stock').set_unique(['store_key', 'sku_key'])
+assert loaded.log_versions('.checkpoint') == list(range(CHECKPOINT, uds.version + 1, CHECKPOINT)) and uds.version >= CHECKPOINT
+assert sorted(p.path for p in loaded.pieces) == sorted(p.path for p in uds.pieces) and loaded.deltas == uds.deltas and loaded.deletes == uds.deletes
+with contextlib.redirect_stdout(io.StringIO()):
+    assert sorted_keys(loaded.read()).equals(sorted_keys(uds.read()))
+
+# Statistics of dates, timestamps, decimals & bytes are logged with their type: reloaded, they still prune key lookups
+import datetime, decimal
+typed = pa.table({'day': pa.array([datetime.date(2020, 1, 1) + datetime.timedelta(days=i) for i in range(1000)]),
+                  'at': pa.array([datetime.datetime(2020, 1, 1) + datetime.timedelta(hours=i) for i in range(1000)], pa.timestamp('us')),
+                  'amount': pa.array([decimal.Decimal(i - 500) / 100 for i in range(1000)], pa.decimal128(10, 2)), 'raw': pa.array([bytes([i % 256, 1]) for i in range(1000)])})
+os.makedirs(unique_dir + '/typed/part=0')
+pq.write_table(typed, unique_dir + '/typed/part=0/file0.parquet', row_group_size=100)
+with contextlib.redirect_stdout(io.StringIO()):
+    written = ParquetUniqueDataset(unique_dir + '/typed', row_group_size=100).set_unique(['day'])
+    written.upsert(typed.slice(5, 3).append_column('part', pa.array(['0'] * 3)))
+    for key in ['day', 'at']:
+        loaded = ParquetUniqueDataset(unique_dir + '/typed').set_unique([key])
+        assert all(f['columns'] == written.manifest[p]['columns'] and f['row_groups'] == written.manifest[p]['row_groups'] for p, f in loaded.manifest.items())
+        assert loaded.manifest['part=0/file0.parquet']['columns']['amount']['min'] == decimal.Decimal('-5.00')
+        assert loaded.get(typed.slice(500, 2).append_column('part', pa.array(['0', '0']))).num_rows == 2
+shutil.rmtree(unique_dir)
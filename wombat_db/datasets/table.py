@@ -1,157 +1,954 @@
-import os, time, s3fs
-import pyarrow as pa
-import pyarrow.parquet as pq
-from ops import drop_duplicates, head, split
-
-class ParquetUniqueDataset(pq.ParquetDataset):
-    def __init__(self, *args, **kwargs):
-        self.args, self.kwargs = args, kwargs
-        # super().__init__(*args, **kwargs) 
-        self.path = args[0]
-        self.tables = {}
-        self.load()
-
-    def load(self, verbose=False):
-        # Initiate the parent class
-        super().__init__(*self.args, **self.kwargs) 
-
-        self.meta = self.pieces[0].get_metadata()
-        self.columns = [c['path_in_schema'] for c in self.meta.row_group(0).to_dict()['columns']]
-
-        # Partition information
-        self.partition_cols = [c[0] for c in self.pieces[0].partition_keys]
-        self.partitions_ = [p.partition_keys for p in self.pieces]
-        self.partitions_val = [tuple(v[1] for v in p) for p in self.partitions_]      
-
-        if verbose:
-            print("Loaded all the data:", [p.path for p in self.pieces])
-            print("Column names:", self.columns)
-    
-    def set_unique(self, columns):
-        self.unique_cols = [u for u in columns if u not in self.partition_cols]
-        return self
-
-    def partition_dict(self, partition_val):
-        return dict(zip(self.partition_cols, list(partition_val)))
-
-    def get_path(self, partition_val, name):
-        partition = self.partition_dict(partition_val)
-        return self.path + '/' + '/'.join(str(k) + '=' + str(v) for k, v in partition.items()) + '/' + name + '.parquet'
-
-    def get_idxs(self, partition_val):
-        return [idx for idx, p in enumerate(self.partitions_val) if p == partition_val]
-
-    # Cleaning tables
-    def concat(self, tables):
-        return pa.concat_tables([t.select(self.columns) for t in tables])
-
-    def sanitize(self, table):
-        # TODO: Add casting to default schema of class
-        return table.select(self.partition_cols + self.columns)
-
-    def cleanup(self):
-        for p in set(self.partitions_val):
-            print("Cleaning up:", p)
-            table = self.read_parts(p)
-            table_dedup = drop_duplicates(table, on=self.unique_cols, keep='last')
-            self.save(self.deduplicate(table), p)
-
-    # Reading / writing tables
-    def read_parts(self, partition_val=None):
-        # See what pieces we need to load
-        idxs = (self.get_idxs(partition_val) if partition_val else range(len(self.pieces)))
-        for i in idxs:
-            if self.pieces[i].path not in self.tables.keys():
-                print("Reading {} as it is not in cache".format(self.pieces[i].path))
-                self.tables[self.pieces[i].path] = self.pieces[i].read(columns=self.columns, partitions=self.partitions)
-        return self.concat([self.tables[self.pieces[i].path] for i in idxs])
-
-    def save(self, table, partition_val):
-        paths_old = [self.pieces[i].path for i in self.get_idxs(partition_val)]
-        paths_new = [self.get_path(partition_val, 'file0')]
-
-        # Delete old which are not written in new
-        for path in [p for p in paths_old if p not in paths_new]:
-            os.remove(path)
-
-        # Write new table
-        pq.write_table(table.select(self.columns), paths_new[0])
-
-        # Add table to caching
-        self.tables[paths_new[0]] = table
-
-        # Reload the Dataset if file names have changed
-        if set(paths_old) != set(paths_new):
-            return True
-        else:
-            return False
-
-    # Upsertion
-    def upsert_part(self, table, partition_val, partition_idxs, keep):
-        # If partition exists, gather original data, before deduplication. Else use new table
-        rows_b4 = None
-        if partition_val in self.partitions_val:
-            table_part = self.read_parts(partition_val)
-            rows_b4 = table_part.num_rows
-            table_new = self.concat([table_part, table.take(partition_idxs)])
-        else:
-            table_new = table.take(partition_idxs)
-        table_dedup = drop_duplicates(table_new, on=self.unique_cols, keep=keep)
-        print("Upserting data for partition {0}. Added {1} unique records".format(partition_val, table_dedup.num_rows - rows_b4))
-        return self.save(table_dedup, partition_val)
-
-    def upsert(self, table, keep='last'):
-        table = self.sanitize(table)
-        # bools = self.pool.map(lambda p: self.upsert_part(*p), [(table, val, idxs, keep) for val, idxs in split(table=table, columns=self.partition_cols)])
-        bools = [self.upsert_part(table, val, idxs, keep) for val, idxs in split(table=table, columns=self.partition_cols)]
-        if max(bools):
-            print("Reloading dataset!")
-            self.load()
-
-    # Deletion by table
-    def delete_part(self, table, partition_val, partition_idxs):
-        if partition_val in self.partitions_val:
-            table_part = self.read_parts(partition_val)
-            table_new = self.concat([table_part, table.take(partition_idxs)])
-            table_dedup = drop_duplicates(table_new, on=self.unique_cols, keep='drop')
-            print("Removing data for partition {0}. Removed {1} unique records".format(partition_val, table_part.num_rows - table_dedup.num_rows))
-            return self.save(table_dedup, partition_val)
-        else:
-            print("There does not data for partition:", self.partition_dict(partition_val))
-            return False
-
-    def delete(self, table):
-        table = self.sanitize(table)
-        # bools = self.pool.map(lambda p: self.delete_part(*p), [(table, val, idxs) for val, idxs in split(table=table, columns=self.partition_cols)])
-        bools = [self.delete_part(table, val, idxs) for val, idxs in split(table=table, columns=self.partition_cols)]
-        if max(bools):
-            self.load()
-
-    # Delete full partition
-    def delete_predicate(self, partition_val, predicate):
-        return
-
-
-if __name__ == '__main__':
-    t = ParquetUniqueDataset('data/skus').set_unique(columns=['sku_key'])
-    table = t.read()
-    head(table)
-
-    # Upsert functionality
-    import numpy as np
-    idxs = np.random.choice(table.num_rows, 100_000)
-    table_new = table.take(idxs)
-
-    t1 = time.time()
-    t.upsert(table_new)
-
-    # Remove functionality
-    t2 = time.time()
-    idxs = np.random.choice(table.num_rows, 100)
-    t.delete(table.take(idxs))
-
-    print("Time upsert / delete", t2 - t1, time.time() - t2)
-
-
-
-
+import os, time, threading, json, base64, shutil, tempfile, uuid, datetime, decimal
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from wombat_db.ops import drop_duplicates, head
+from wombat_db.ops.bloom import BloomFilter, hash_columns
+from wombat_db.ops.helpers import split, tables_to_arrays
+
+# The files of a version of the dataset are recorded in a transaction log: one json file per version with the added & removed files
+# (with their statistics) and deletion vectors. Files are never changed: every write adds files named by its version. Files removed
+# from the current version are moved to the archive, where older versions can still read them until vacuum()
+LOG, ARCHIVE = '_wombat_log', '_removed'
+
+# Every CHECKPOINT versions the full manifest is also written to the log, loading replays the versions after the latest checkpoint
+CHECKPOINT = 10
+
+# With the change feed on, upserts & deletes also write the rows they changed (the inserted, deleted & updated rows, with the row
+# before & after the update) to one file per version in CHANGES, with a CHANGE_TYPE & CHANGE_VERSION column
+CHANGES, CHANGE_TYPE, CHANGE_VERSION = '_wombat_changes', '_change_type', '_commit_version'
+
+# Upserts are written as small delta files next to the base files of a partition, named by the version of the upsert. They start
+# with an underscore, so the ParquetDataset discovery skips them: reads merge them in version order
+DELTA = '_delta-'
+
+class PartitionError(Exception):
+    # Raised after an upsert / delete in which partitions failed: failures is {partition: exception}. The other partitions were written
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__("Failed partitions: " + ", ".join("{} ({})".format(p, repr(e)) for p, e in failures.items()))
+
+def write_tag(version):
+    # Files written for a version are named by it & a random token, so writers that race for the same version never share a path
+    return '{:08d}-{}'.format(version, uuid.uuid4().hex[:12])
+
+def is_delta(path):
+    return os.path.basename(path).startswith(DELTA)
+
+def delta_path(directory, tag):
+    return os.path.join(directory, '{}{}.parquet'.format(DELTA, tag))
+
+def delta_seq(path):
+    return int(os.path.basename(path)[len(DELTA):-len('.parquet')].split('-')[0])
+
+def list_deltas(directory):
+    names = (os.listdir(directory) if os.path.isdir(directory) else [])
+    return sorted([os.path.join(directory, n) for n in names if n.startswith(DELTA) and n.endswith('.parquet')], key=delta_seq)
+
+# Deletes are recorded per file as a bitmap of the deleted row positions, in a sidecar next to it (also skipped by the discovery)
+def deletes_path(path, tag):
+    return os.path.join(os.path.dirname(path), '_{}.{}.deletes'.format(os.path.basename(path), tag))
+
+def list_deletes(directory):
+    # Newest deletion vector of the files in a directory {file path: vector}, for readers without the transaction log
+    vectors = {}
+    for n in (os.listdir(directory) if os.path.isdir(directory) else []):
+        if n.startswith('_') and n.endswith('.deletes'):
+            name, tag = n[1:-len('.deletes')].rsplit('.', 1)
+            vectors.setdefault(os.path.join(directory, name), []).append((int(tag.split('-')[0]), n))
+    return {p: os.path.join(directory, max(vs)[1]) for p, vs in vectors.items()}
+
+def committed_deletes(root):
+    # Deletion vectors {file path: vector} of the current version in the transaction log of a directory, or None without a log
+    if not os.path.isdir(os.path.join(root, LOG)):
+        return None
+    return ParquetUniqueDataset(root).deletes
+
+def read_deletes(vector, packed=False):
+    # Boolean mask of the deleted rows of a file (packed: the bits, 8 rows per byte), or None
+    if vector is None:
+        return None
+    with np.load(vector) as f:
+        return (f['bits'] if packed else np.unpackbits(f['bits'], count=int(f['rows'])).astype(bool))
+
+def write_deletes(vector, deleted):
+    tmp = os.path.join(os.path.dirname(vector), '.' + os.path.basename(vector) + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.savez(f, bits=np.packbits(deleted), rows=len(deleted))
+    os.replace(tmp, vector)
+
+def apply_deletes(table, vector):
+    deleted = read_deletes(vector)
+    return (table.filter(pa.array(np.invert(deleted))) if deleted is not None and deleted.any() else table)
+
+# Key lookups (get) skip the files whose bloom filter of the unique columns (in a sidecar) does not hold the keys
+def bloom_path(path):
+    return os.path.join(os.path.dirname(path), '_' + os.path.basename(path) + '.bloom')
+
+# Statistics values that are not json types are logged with their type, others are left out
+STAT_TYPES = {'datetime': datetime.datetime, 'date': datetime.date, 'time': datetime.time, 'decimal': decimal.Decimal, 'bytes': bytes}
+
+def stat_type(value):
+    # Name of the type of a statistics value in the log, or None if it can not be logged
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return 'json'
+    return next((name for name, t in STAT_TYPES.items() if isinstance(value, t)), None)
+
+def encode_stat(value):
+    name = stat_type(value)
+    if name in [None, 'json']:
+        raise TypeError("Can not log {!r}".format(value))
+    text = (base64.b64encode(value).decode() if name == 'bytes' else str(value) if name == 'decimal' else value.isoformat())
+    return {'__type__': name, 'value': text}
+
+def decode_stat(d):
+    # json object hook
+    if set(d) != {'__type__', 'value'}:
+        return d
+    name, text = d['__type__'], d['value']
+    if name == 'bytes':
+        return base64.b64decode(text)
+    elif name == 'decimal':
+        return decimal.Decimal(text)
+    return STAT_TYPES[name].fromisoformat(text)
+
+def stat_value(value, arrow_type):
+    # A footer statistics value as a value of the arrow type of the column (pyarrow may return dates as days & decimals as bytes)
+    if pa.types.is_date32(arrow_type) and isinstance(value, int):
+        return datetime.date(1970, 1, 1) + datetime.timedelta(days=value)
+    if pa.types.is_decimal(arrow_type) and isinstance(value, (bytes, int)):
+        unscaled = (int.from_bytes(value, 'big', signed=True) if isinstance(value, bytes) else value)
+        return decimal.Decimal(unscaled).scaleb(-arrow_type.scale)
+    return value
+
+def file_stats(path):
+    # Rows, size & per column min / max / null count of a written file & its row groups, from its footer
+    meta, columns, row_groups = pq.read_metadata(path), {}, []
+    schema = meta.schema.to_arrow_schema()
+    for r in range(meta.num_row_groups):
+        rg = meta.row_group(r)
+        row_groups.append({'rows': rg.num_rows, 'columns': {}})
+        for j in range(rg.num_columns):
+            col, s = rg.column(j), rg.column(j).statistics
+            c = columns.setdefault(col.path_in_schema, {'min': None, 'max': None, 'nulls': 0, 'complete': True})
+            arrow_type = (schema.field(col.path_in_schema).type if col.path_in_schema in schema.names else None)
+            low, high = ((stat_value(s.min, arrow_type), stat_value(s.max, arrow_type)) if s is not None and s.has_min_max and arrow_type is not None else (None, None))
+            if low is None or stat_type(low) is None or stat_type(high) is None:
+                c['complete'] = False
+                continue
+            row_groups[-1]['columns'][col.path_in_schema] = [low, high]
+            c['min'] = (low if c['min'] is None else min(c['min'], low))
+            c['max'] = (high if c['max'] is None else max(c['max'], high))
+            c['nulls'] += s.null_count
+    columns = {k: ({'min': c['min'], 'max': c['max'], 'nulls': c['nulls']} if c['complete'] else {}) for k, c in columns.items()}
+    return {'rows': meta.num_rows, 'size': os.path.getsize(path), 'columns': columns, 'row_groups': row_groups}
+
+def sort_keys(table, columns):
+    return table.take(pc.sort_indices(table, sort_keys=[(c, 'ascending') for c in columns]))
+
+def zorder_values(table, columns):
+    # Morton code of the rows: the bits of the dense rank of every column (scaled to the same number of bits, nulls last) interleaved,
+    # so rows close in all columns are close in the order & the row groups have narrow min / max on each of the columns
+    bits, z = min(32, 64 // len(columns)), np.zeros(table.num_rows, dtype=np.uint64)
+    for j, c in enumerate(columns):
+        col = table.column(c)
+        col = (col.cast(col.type.value_type) if pa.types.is_dictionary(col.type) else col)
+        valid = (pc.is_valid(col).to_numpy() if col.null_count else np.ones(table.num_rows, dtype=bool))
+        values = col.to_numpy()[valid]
+        dic, inverse = np.unique(values.astype(str) if values.dtype == object else values, return_inverse=True)
+        rank = np.full(table.num_rows, len(dic), dtype=np.float64)
+        rank[valid] = inverse
+        v = (rank / max(len(dic), 1) * (2**bits - 1)).astype(np.uint64)
+        for b in range(bits):
+            z |= ((v >> np.uint64(b)) & np.uint64(1)) << np.uint64(b * len(columns) + j)
+    return z
+
+def zorder_keys(table, columns):
+    return table.take(pa.array(np.argsort(zorder_values(table, columns), kind='stable')))
+
+def read_merged(paths, deltas, deletes, cached, columns, unique):
+    # Base files & deltas in version order, without their deleted rows: the last written row per key wins
+    t = pa.concat_tables([apply_deletes((cached[p] if p in cached else pq.read_table(p, columns=columns)), deletes.get(p)) for p in paths + deltas])
+    return (drop_duplicates(t, on=unique, keep='last') if deltas else t)
+
+def write_file(path, table, layout):
+    # Write to a hidden temporary file (ignored by the dataset) & move it in place, so a failed write leaves no file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+    try:
+        pq.write_table(table, tmp, row_group_size=layout['row_group_size'], compression=layout['compression'], use_dictionary=(layout['dictionary'] if layout['dictionary'] is not None else True))
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    if layout['bloom']:
+        with open(bloom_path(path), 'wb') as f:
+            BloomFilter.from_table(table, layout['bloom']).save(f)
+
+def write_files(directory, name, table, layout):
+    # Sorted by the layout (or in Z-order), split into files of about the target size (in memory) with consecutive keys: [(path, stats)]
+    if layout.get('zorder_by'):
+        table = zorder_keys(table, layout['zorder_by'])
+    elif layout['sort_by']:
+        table = sort_keys(table, layout['sort_by'])
+    n = max(1, int(np.ceil(table.nbytes / layout['file_size'])))
+    rows = int(np.ceil(table.num_rows / n))
+    paths = [os.path.join(directory, (name if n == 1 else '{}-{}'.format(name, i)) + '.parquet') for i in range(n)]
+    for i, path in enumerate(paths):
+        write_file(path, table.slice(i * rows, rows), layout)
+    return [(path, file_stats(path)) for path in paths], {path: table.slice(i * rows, rows) for i, path in enumerate(paths)}
+
+def merge_partition(task):
+    # Write the new files of a single partition (in a worker thread or process). Returns (message, [(path added, stats)],
+    # paths removed, {path: (deletion vector, deleted rows)}, {path: table written})
+    mode, tag, directory, paths, deltas, deletes, cached, rows, columns, schema, unique, keep, layout, return_table = task
+    if rows is not None:
+        rows = rows.select(columns).cast(schema)
+
+    if mode == 'upsert' and paths and keep == 'last':
+        # Only the new rows are written, as a single sorted delta
+        delta = sort_keys(drop_duplicates(rows, on=unique, keep='last'), layout['sort_by'] or unique)
+        path = delta_path(directory, tag)
+        write_file(path, delta, layout)
+        return "Wrote {} records to delta {}".format(delta.num_rows, tag), [(path, file_stats(path))], [], {}, ({path: delta} if return_table else {})
+
+    if mode == 'delete':
+        # Only new deletion vectors of the files with rows of the deleted keys are written (base files & deltas)
+        vectors, removed = {}, 0
+        for p in paths + deltas:
+            keys = (cached[p].select(unique) if p in cached else pq.read_table(p, columns=unique))
+            l_arr, r_arr = tables_to_arrays(keys, rows, unique)
+            before = read_deletes(deletes.get(p))
+            before = (before if before is not None else np.zeros(keys.num_rows, dtype=bool))
+            deleted = before | np.isin(l_arr, r_arr)
+            if deleted.sum() > before.sum():
+                write_deletes(deletes_path(p, tag), deleted)
+                vectors[p] = (deletes_path(p, tag), int(deleted.sum()))
+                removed += deleted.sum() - before.sum()
+        return "Marked {} rows as deleted".format(removed), [], [], vectors, {}
+
+    table_part = (read_merged(paths, deltas, deletes, cached, columns, unique) if paths else None)
+    rows_b4 = (table_part.num_rows if table_part is not None else 0)
+    if mode == 'upsert':
+        table_new = drop_duplicates((pa.concat_tables([table_part, rows]) if table_part is not None else rows), on=unique, keep=keep)
+        message = "Added {} unique records".format(table_new.num_rows - rows_b4)
+    elif mode == 'optimize':
+        table_new = table_part
+        message = "Clustered {} records in Z-order on {}".format(rows_b4, ", ".join(layout['zorder_by']))
+    else:
+        table_new = table_part
+        message = "Folded {} deltas & the deletes into {} records".format(len(deltas), rows_b4)
+
+    added, tables = (write_files(directory, 'file{}'.format(tag), table_new, layout) if table_new.num_rows else ([], {}))
+    return message, added, paths + deltas, {}, (tables if return_table else {})
+
+def file_signature(path):
+    # Size & modification time: a cached table of a file that was replaced is read again
+    try:
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns)
+    except OSError:
+        return None
+
+def metadata_size(value):
+    # Bytes of a cached footer (its serialized size), bloom filter or packed deletion vector
+    return (value.serialized_size if isinstance(value, pq.FileMetaData) else getattr(value, 'nbytes', 0))
+
+class TableCache():
+    # Tables read from files by path, within a budget of max_memory bytes: the least recently used are evicted first. An entry is
+    # only used while signature(path) still equals the one it was read with. With a mmap_dir (True for a temporary one), the tables
+    # are kept as memory mapped arrow files, which the OS can page out. Other values are sized by size (e.g. metadata_size)
+    def __init__(self, max_memory=1e9, signature=file_signature, mmap_dir=None, size=lambda t: t.nbytes):
+        self.tables, self.signatures, self.sizes, self.memory, self.max_memory = OrderedDict(), {}, {}, 0, max_memory
+        self.signature, self.mmap_dir, self.mapped, self.size = signature, mmap_dir, {}, size
+        self.hits, self.misses, self.evictions, self.invalidations = 0, 0, 0, 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def __getitem__(self, key):
+        t = self.get(key)
+        if t is None:
+            raise KeyError(key)
+        return t
+
+    def __setitem__(self, key, table):
+        self.put(key, table)
+
+    def get(self, key, default=None, count=True):
+        with self.lock:
+            if key in self.tables and self.signatures[key] != self.signature(key):
+                self.invalidations += 1
+                self.pop(key)
+            if key not in self.tables:
+                self.misses += count
+                return default
+            self.hits += count
+            self.tables.move_to_end(key)
+            return self.tables[key]
+
+    def put(self, key, table):
+        with self.lock:
+            self.pop(key)
+            size = self.size(table)
+            if size > self.max_memory:
+                return
+            while self.tables and self.memory + size > self.max_memory:
+                self.pop(next(iter(self.tables)))
+                self.evictions += 1
+            # The size is recorded once, the same is subtracted when the entry is removed
+            self.signatures[key], self.sizes[key] = self.signature(key), size
+            self.tables[key] = (self.map(key, table) if self.mmap_dir else table)
+            self.memory += self.sizes[key]
+
+    def update(self, tables):
+        for key, table in tables.items():
+            self.put(key, table)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.tables:
+                return default
+            table = self.tables.pop(key)
+            self.memory -= self.sizes.pop(key)
+            del self.signatures[key]
+            if key in self.mapped:
+                os.remove(self.mapped.pop(key))
+            return table
+
+    def map(self, key, table):
+        # Written to a new file (tables still using an old mapping keep reading it), then memory mapped
+        if self.mmap_dir is True:
+            self.mmap_dir = tempfile.mkdtemp(prefix='wombat_tables_')
+        os.makedirs(self.mmap_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix='.arrow', dir=self.mmap_dir)
+        os.close(fd)
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        self.mapped[key] = path
+        return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.tables):
+                self.pop(key)
+
+    def keys(self):
+        with self.lock:
+            return list(self.tables.keys())
+
+    def stats(self):
+        with self.lock:
+            return {'tables': len(self.tables), 'mapped': len(self.mapped), 'memory': self.memory, 'max_memory': self.max_memory,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'invalidations': self.invalidations}
+
+class ParquetUniqueDataset(pq.ParquetDataset):
+    def __new__(cls, *args, **kwargs):
+        # Always the legacy dataset class (the files come from the transaction log)
+        return super().__new__(cls)
+
+    def __init__(self, *args, max_workers=1, processes=False, max_deltas=8, compact_ratio=0.25, background=True, version=None,
+                 file_size=256e6, row_group_size=2**17, sort_by=None, zorder_by=None, compression='snappy', dictionary=None,
+                 cache_memory=1e9, cache_mmap=None, metadata_memory=1e8, change_feed=False, **kwargs):
+        # Partitions are upserted / deleted by max_workers threads (or processes, which do not share the table cache)
+        # A partition is compacted (in a background thread) when it has max_deltas deltas, or compact_ratio times its base rows in deltas
+        # The latest version is loaded, or the given version (read only)
+        # Files are written sorted by sort_by (the unique columns by default), in files of about file_size bytes (in memory) with
+        # row groups of row_group_size rows, so the min / max statistics of the files & row groups prune key lookups & range filters.
+        # zorder_by: write in Z-order of these columns instead (see optimize), dictionary: the columns to dictionary encode (all by default)
+        # The files read & written are cached (see TableCache) within cache_memory bytes, as memory mapped arrow files in cache_mmap,
+        # their footers, bloom filters & deletion vectors within metadata_memory bytes
+        # change_feed: record the rows changed by every upsert & delete (see changes)
+        self.args, self.kwargs = args, kwargs
+        self.max_workers, self.processes = max_workers, processes
+        self.max_deltas, self.compact_ratio, self.background = max_deltas, compact_ratio, background
+        self.file_size, self.row_group_size, self.sort_by, self.zorder_by = file_size, row_group_size, sort_by, zorder_by
+        self.compression, self.dictionary = compression, dictionary
+        self.cache_memory, self.cache_mmap, self.metadata_memory, self.change_feed = cache_memory, cache_mmap, metadata_memory, change_feed
+        # super().__init__(*args, **kwargs)
+        self.path = args[0]
+        self.tables = TableCache(cache_memory, lambda p: file_signature(self.resolve(p)), cache_mmap)
+        # Keyed by (kind, path): files never change, so the entries stay valid
+        self.metadata = TableCache(metadata_memory, lambda key: None, size=metadata_size)
+        self.compaction, self.compaction_failures = None, {}
+        self.load(version)
+
+    # Transaction log
+    def log_path(self, version):
+        return os.path.join(self.path, LOG, '{:08d}.json'.format(version))
+
+    def checkpoint_path(self, version):
+        return os.path.join(self.path, LOG, '{:08d}.checkpoint'.format(version))
+
+    def log_versions(self, extension='.json'):
+        names = (os.listdir(os.path.join(self.path, LOG)) if os.path.isdir(os.path.join(self.path, LOG)) else [])
+        return sorted(int(n[:-len(extension)]) for n in names if n.endswith(extension) and not n.startswith('.'))
+
+    def relative(self, path):
+        return os.path.relpath(path, self.path)
+
+    def absolute(self, path):
+        return os.path.join(self.path, path)
+
+    def resolve(self, path):
+        # Files removed from the current version are read from the archive
+        archived = os.path.join(self.path, ARCHIVE, self.relative(path))
+        return (archived if not os.path.exists(path) and os.path.exists(archived) else path)
+
+    def commit(self, version, operation, added=[], removed=[], deletes={}, **extra):
+        # The version is created atomically & only once (by a hard link), a concurrent writer of the same version fails
+        entry = {'version': version, 'timestamp': time.time(), 'operation': operation, 'add': added, 'remove': removed, 'deletes': deletes, **extra}
+        os.makedirs(os.path.join(self.path, LOG), exist_ok=True)
+        tmp = os.path.join(self.path, LOG, '.{:08d}.json.tmp'.format(version))
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(entry, f, default=encode_stat)
+            os.link(tmp, self.log_path(version))
+        except FileExistsError:
+            raise Exception("Version {} of {} was committed by another writer, reload the dataset".format(version, self.path))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return entry
+
+    def create(self):
+        # Version 0: the files found by the ParquetDataset discovery, with the deltas next to them
+        dataset = pq.ParquetDataset(*self.args, **self.kwargs)
+        meta = dataset.pieces[0].get_metadata()
+        columns = [c['path_in_schema'] for c in meta.row_group(0).to_dict()['columns']]
+        schema = meta.schema.to_arrow_schema()
+        schema = pa.schema([schema.field(c) for c in columns])
+        partition_cols = [c[0] for c in dataset.pieces[0].partition_keys]
+        added, directories = [], {}
+        for p in dataset.pieces:
+            val = [str(dataset.partitions.levels[j].keys[v[1]]) for j, v in enumerate(p.partition_keys)]
+            added.append({'path': self.relative(p.path), 'partition': val, 'kind': 'base', 'seq': 0, **file_stats(p.path)})
+            directories[os.path.dirname(p.path)] = val
+        for directory, val in directories.items():
+            added += [{'path': self.relative(p), 'partition': val, 'kind': 'delta', 'seq': delta_seq(p), **file_stats(p)} for p in list_deltas(directory)]
+        self.commit(0, 'create', added, partition_cols=partition_cols, schema=base64.b64encode(schema.serialize().to_pybytes()).decode())
+
+    def load(self, version=None, verbose=False):
+        # Replay the transaction log up to the version (the latest by default)
+        if not self.log_versions():
+            self.create()
+        versions = [v for v in self.log_versions() if version is None or v <= version]
+        if version is not None and version not in versions:
+            raise Exception("Version {} does not exist for {}".format(version, self.path))
+        self.manifest, self.read_only = {}, version is not None and version != self.log_versions()[-1]
+        checkpoints = [v for v in self.log_versions('.checkpoint') if v <= versions[-1]]
+        if checkpoints:
+            with open(self.checkpoint_path(checkpoints[-1])) as f:
+                self.replay(json.load(f, object_hook=decode_stat))
+        for v in [v for v in versions if not checkpoints or v > checkpoints[-1]]:
+            with open(self.log_path(v)) as f:
+                self.replay(json.load(f, object_hook=decode_stat))
+        self.set_state()
+
+        if verbose:
+            print("Loaded version {}:".format(self.version), [p.path for p in self.pieces])
+            print("Column names:", self.columns)
+
+    def replay(self, entry):
+        # A version (or a checkpoint, with the full manifest) applied to the manifest only
+        if 'schema' in entry:
+            self.partition_cols = entry['partition_cols']
+            self.arrow_schema = pa.ipc.read_schema(pa.py_buffer(base64.b64decode(entry['schema'])))
+            self.columns = self.arrow_schema.names
+        if 'manifest' in entry:
+            self.manifest = entry['manifest']
+        for p in entry.get('remove', []):
+            self.manifest.pop(p, None)
+        for f in entry.get('add', []):
+            self.manifest[f['path']] = f
+        for p, vector in entry.get('deletes', {}).items():
+            self.manifest[p]['deletes'] = vector
+        self.version, self.timestamp = entry['version'], entry['timestamp']
+
+    def apply(self, entry):
+        self.replay(entry)
+        self.set_state()
+
+    def checkpoint(self):
+        # The manifest of the current version, written once (like a version)
+        if os.path.exists(self.checkpoint_path(self.version)):
+            return
+        schema = base64.b64encode(self.arrow_schema.serialize().to_pybytes()).decode()
+        tmp = os.path.join(self.path, LOG, '.{:08d}.checkpoint.tmp'.format(self.version))
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version, 'timestamp': self.timestamp, 'partition_cols': self.partition_cols, 'schema': schema, 'manifest': self.manifest}, f, default=encode_stat)
+        os.replace(tmp, self.checkpoint_path(self.version))
+
+    def set_state(self):
+        # Pieces & partitions (as the ParquetDataset discovery would find them), deltas & deletion vectors of the version
+        bases = sorted(p for p, f in self.manifest.items() if f['kind'] == 'base')
+        self._partitions = pq.ParquetPartitions()
+        for j, c in enumerate(self.partition_cols):
+            for v in sorted(set(self.manifest[p]['partition'][j] for p in bases)):
+                self.partitions.get_index(j, c, v)
+        self._pieces = [pq.ParquetDatasetPiece._create(self.absolute(p), partition_keys=[(c, self.partitions.levels[j].get_index(v)) for j, (c, v) in enumerate(zip(self.partition_cols, self.manifest[p]['partition']))]) for p in bases]
+
+        # Partition information (values as strings, like the directory names)
+        self.partitions_ = [p.partition_keys for p in self.pieces]
+        self.partitions_val = [tuple(self.manifest[p]['partition']) for p in bases]
+
+        # Deltas per partition, in version order & deletion vectors per file
+        self.deltas = {}
+        for p, f in sorted(self.manifest.items(), key=lambda pf: pf[1]['seq']):
+            if f['kind'] == 'delta':
+                self.deltas.setdefault(tuple(f['partition']), []).append(self.absolute(p))
+        self.deletes = {self.absolute(p): self.absolute(f['deletes']['path']) for p, f in self.manifest.items() if f.get('deletes')}
+
+    def history(self):
+        # The versions with their operation & number of files added and removed
+        versions = []
+        for v in self.log_versions():
+            with open(self.log_path(v)) as f:
+                entry = json.load(f)
+            versions.append({'version': v, 'timestamp': entry['timestamp'], 'operation': entry['operation'], 'added': len(entry['add']), 'removed': len(entry['remove']), 'deletes': len(entry['deletes'])})
+        return versions
+
+    def as_of(self, version):
+        # Read only snapshot of an older version
+        snapshot = ParquetUniqueDataset(*self.args, max_workers=self.max_workers, processes=self.processes, version=version, **self.layout_options(),
+                                       cache_memory=self.cache_memory, cache_mmap=self.cache_mmap, metadata_memory=self.metadata_memory, change_feed=self.change_feed, **self.kwargs)
+        # Files never change, so the snapshot reads from the caches of this dataset
+        snapshot.tables, snapshot.metadata = self.tables, self.metadata
+        return (snapshot.set_unique(self.unique_cols) if hasattr(self, 'unique_cols') else snapshot)
+
+    def vacuum(self):
+        # Remove the archived files: older versions that use them can not be read anymore
+        self.wait()
+        if os.path.isdir(os.path.join(self.path, ARCHIVE)):
+            shutil.rmtree(os.path.join(self.path, ARCHIVE))
+
+    def archive(self, paths):
+        for p in paths:
+            if os.path.exists(p):
+                os.renames(p, os.path.join(self.path, ARCHIVE, self.relative(p)))
+
+    def layout_options(self):
+        return {'file_size': self.file_size, 'row_group_size': self.row_group_size, 'sort_by': self.sort_by, 'zorder_by': self.zorder_by, 'compression': self.compression, 'dictionary': self.dictionary}
+
+    def layout(self):
+        return {**self.layout_options(), 'sort_by': (self.sort_by if self.sort_by is not None else getattr(self, 'unique_cols', None)), 'bloom': getattr(self, 'unique_cols', None)}
+
+    def set_unique(self, columns):
+        self.unique_cols = [u for u in columns if u not in self.partition_cols]
+        return self
+
+    def partition_dict(self, partition_val):
+        return dict(zip(self.partition_cols, list(partition_val)))
+
+    def get_path(self, partition_val, name):
+        partition = self.partition_dict(partition_val)
+        return self.path + '/' + '/'.join(str(k) + '=' + str(v) for k, v in partition.items()) + '/' + name + '.parquet'
+
+    def get_idxs(self, partition_val):
+        return [idx for idx, p in enumerate(self.partitions_val) if p == partition_val]
+
+    def partition_arrays(self, partition_val, n):
+        # Partition columns as the dictionaries the ParquetDataset reads them as
+        keys = self.partitions_[self.get_idxs(partition_val)[0]]
+        return [pa.DictionaryArray.from_arrays(pa.array(np.full(n, k[1], dtype=np.int32)), self.partitions.levels[j].dictionary) for j, k in enumerate(keys)]
+
+    # Cleaning tables
+    def concat(self, tables):
+        return pa.concat_tables([t.select(self.columns) for t in tables])
+
+    def sanitize(self, table):
+        # TODO: Add casting to default schema of class
+        return table.select(self.partition_cols + self.columns)
+
+    def cleanup(self):
+        # Rewrite all partitions deduplicated, committed as one version. Files written before a failure are removed again
+        self.wait()
+        self.check_writable()
+        version = self.version + 1
+        name, added, removed, tables = 'file{}'.format(write_tag(version)), [], [], {}
+        try:
+            for p in dict.fromkeys(self.partitions_val):
+                print("Cleaning up:", p)
+                table_dedup = drop_duplicates(self.read_parts(p), on=self.unique_cols, keep='last')
+                add, ts = write_files(os.path.dirname(self.get_path(p, 'file0')), name, table_dedup.select(self.columns), self.layout())
+                added += [(p, path, stats) for path, stats in add]
+                removed += [self.pieces[i].path for i in self.get_idxs(p)] + self.deltas.get(p, [])
+                tables.update(ts)
+        except Exception:
+            for path in [path for _, path, _ in added] + [bloom_path(path) for _, path, _ in added]:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        self.commit_changes(version, 'cleanup', added, removed, {})
+        self.tables.update(tables)
+
+    # Reading / writing tables (files never change, so they are cached by path)
+    def read_file(self, path):
+        t = self.tables.get(path)
+        if t is None:
+            print("Reading {} as it is not in cache".format(path))
+            t = pq.read_table(self.resolve(path), columns=self.columns)
+            self.tables[path] = t
+        return t
+
+    def read_partition(self, partition_val):
+        # Base files merged with the deltas of the partition, without the deleted rows
+        paths, deltas = [self.pieces[i].path for i in self.get_idxs(partition_val)], self.deltas.get(partition_val, [])
+        tables = {p: self.read_file(p) for p in paths + deltas}
+        deletes = {p: self.resolve(v) for p, v in self.deletes.items() if p in paths + deltas}
+        return read_merged(paths, deltas, deletes, tables, self.columns, self.unique_cols)
+
+    def read_parts(self, partition_val=None):
+        self.wait()
+        vals = ([partition_val] if partition_val else list(dict.fromkeys(self.partitions_val)))
+        return self.concat([self.read_partition(val) for val in vals])
+
+    def read(self, columns=None, use_threads=True, use_pandas_metadata=False):
+        # All partitions with the deltas merged, with the partition columns
+        self.wait()
+        tables = []
+        for val in dict.fromkeys(self.partitions_val):
+            t = self.read_partition(val)
+            tables.append(pa.Table.from_arrays(t.columns + self.partition_arrays(val, t.num_rows), names=self.columns + self.partition_cols))
+        table = pa.concat_tables(tables)
+        return (table.select(columns) if columns is not None else table)
+
+    # Point lookups by key
+    def bloom(self, path):
+        # False is cached for a file without a (usable) bloom filter
+        bloom = self.metadata.get(('bloom', path))
+        if bloom is None:
+            bloom = (BloomFilter.load(self.resolve(bloom_path(path))) if os.path.exists(self.resolve(bloom_path(path))) else None) or False
+            self.metadata[('bloom', path)] = bloom
+        return bloom or None
+
+    def deleted(self, path):
+        # Deletion vectors never change (a delete writes a new one), so they are cached packed by path
+        if path not in self.deletes:
+            return None
+        bits = self.metadata.get(('vector', self.deletes[path]))
+        if bits is None:
+            bits = read_deletes(self.resolve(self.deletes[path]), packed=True)
+            self.metadata[('vector', self.deletes[path])] = bits
+        return np.unpackbits(bits, count=self.manifest[self.relative(path)]['rows']).astype(bool)
+
+    def footer(self, path):
+        footer = self.metadata.get(('footer', path))
+        if footer is None:
+            footer = pq.read_metadata(self.resolve(path))
+            self.metadata[('footer', path)] = footer
+        return footer
+
+    def empty(self):
+        fields = list(self.arrow_schema) + [pa.field(c, pa.dictionary(pa.int32(), self.partitions.levels[j].dictionary.type)) for j, c in enumerate(self.partition_cols)]
+        return pa.schema(fields).empty_table()
+
+    def get(self, keys, columns=None):
+        # Current rows of the keys (a table with the partition & unique columns). Per file, the keys that pass its bloom filter
+        # are looked up in the row groups whose min / max holds them (or in the cached table), then matched exactly
+        self.wait()
+        keys, tables = keys.select(self.partition_cols + self.unique_cols), []
+        for val, idxs in split(table=keys, columns=self.partition_cols):
+            val = tuple(str(v) for v in val)
+            if len(idxs) and val in self.partitions_val:
+                t = self.get_partition(val, keys.take(idxs))
+                tables.append(pa.Table.from_arrays(t.columns + self.partition_arrays(val, t.num_rows), names=self.columns + self.partition_cols))
+        table = (pa.concat_tables(tables) if tables else self.empty())
+        return (table.select(columns) if columns is not None else table)
+
+    def get_partition(self, partition_val, keys):
+        paths = [self.pieces[i].path for i in self.get_idxs(partition_val)] + self.deltas.get(partition_val, [])
+        hashes, found = hash_columns(keys, self.unique_cols), []
+        for p in paths:
+            bloom = self.bloom(p)
+            candidates = (keys.filter(pa.array(bloom.contains(hashes))) if bloom is not None else keys)
+            if candidates.num_rows:
+                found.append(self.get_file(p, candidates))
+        found = [t for t in found if t.num_rows]
+        if not found:
+            return self.arrow_schema.empty_table()
+        # Base files & deltas in version order: the last written row per key wins
+        return (drop_duplicates(pa.concat_tables(found), on=self.unique_cols, keep='last') if len(found) > 1 else found[0])
+
+    def get_file(self, path, keys):
+        t, positions = self.tables.get(path, count=False), None
+        if t is None:
+            # Row groups with a key within their min / max on all unique columns
+            row_groups, selected = self.manifest[self.relative(path)]['row_groups'], []
+            values = [keys.column(c).to_numpy() for c in self.unique_cols]
+            for r, rg in enumerate(row_groups):
+                inside = np.ones(keys.num_rows, dtype=bool)
+                for c, v in zip(self.unique_cols, values):
+                    if c in rg['columns']:
+                        inside &= (v >= rg['columns'][c][0]) & (v <= rg['columns'][c][1])
+                if inside.any():
+                    selected.append(r)
+            if not selected:
+                return self.arrow_schema.empty_table()
+            t = pq.ParquetFile(self.resolve(path), metadata=self.footer(path)).read_row_groups(selected, columns=self.columns)
+            starts = np.cumsum([0] + [rg['rows'] for rg in row_groups])
+            positions = np.concatenate([np.arange(starts[r], starts[r + 1]) for r in selected])
+        deleted = self.deleted(path)
+        if deleted is not None:
+            t = t.filter(pa.array(np.invert(deleted if positions is None else deleted[positions])))
+        l_arr, r_arr = tables_to_arrays(t, keys, self.unique_cols)
+        return t.filter(pa.array(np.isin(l_arr, r_arr)))
+
+    def check_writable(self):
+        if self.read_only:
+            raise Exception("Version {} of {} is a read only snapshot".format(self.version, self.path))
+
+    def save(self, table, partition_val):
+        self.wait()
+        self.check_writable()
+        version = self.version + 1
+        paths_old = [self.pieces[i].path for i in self.get_idxs(partition_val)] + self.deltas.get(partition_val, [])
+        directory = os.path.dirname(self.get_path(partition_val, 'file0'))
+
+        # Write the new table, commit it & archive the old files
+        added, tables = write_files(directory, 'file{}'.format(write_tag(version)), table.select(self.columns), self.layout())
+        self.commit_changes(version, 'save', [(partition_val, p, stats) for p, stats in added], paths_old, {})
+        self.tables.update(tables)
+
+    def commit_changes(self, version, operation, added, removed, deletes, changes=None):
+        # Commit the files written by a write (added: [(partition, path, stats)], deletes: {path: (vector, deleted rows)}, changes: the
+        # change file), then archive the removed files & replaced deletion vectors. Without a commit the written files are removed again
+        add = [{'path': self.relative(p), 'partition': list(val), 'kind': ('delta' if is_delta(p) else 'base'), 'seq': version, **stats} for val, p, stats in added]
+        vectors = {self.relative(p): {'path': self.relative(v), 'deleted': n} for p, (v, n) in deletes.items()}
+        extra = ({'changes': self.relative(changes)} if changes else {})
+        try:
+            entry = self.commit(version, operation, add, [self.relative(p) for p in removed], vectors, **extra)
+        except Exception:
+            # Only files of this write (their names are unique to it)
+            for p in [p for _, p, _ in added] + [bloom_path(p) for _, p, _ in added] + [v for v, _ in deletes.values()] + ([changes] if changes else []):
+                if os.path.exists(p):
+                    os.remove(p)
+            raise
+        replaced = [self.deletes[p] for p in list(removed) + list(deletes) if p in self.deletes]
+        self.apply(entry)
+        if version % CHECKPOINT == 0:
+            self.checkpoint()
+        self.archive(list(removed) + [bloom_path(p) for p in removed] + replaced)
+        for p in removed:
+            self.tables.pop(p, None)
+            self.metadata.pop(('bloom', p))
+            self.metadata.pop(('footer', p))
+        for v in replaced:
+            self.metadata.pop(('vector', v))
+
+    # Upsertion / deletion / compaction, per partition
+    def partition_task(self, mode, tag, table, partition_val, partition_idxs, keep=None, layout=None):
+        paths, deltas = [self.pieces[i].path for i in self.get_idxs(partition_val)], self.deltas.get(partition_val, [])
+        deletes = {p: v for p, v in self.deletes.items() if p in paths + deltas}
+        cached = ({p: self.tables.get(p) for p in paths + deltas} if not self.processes else {})
+        cached = {p: t for p, t in cached.items() if t is not None}
+        rows = (table.take(partition_idxs) if table is not None else None)
+        directory = os.path.dirname(self.get_path(partition_val, 'file0'))
+        return (mode, tag, directory, paths, deltas, deletes, cached, rows, self.columns, self.arrow_schema, self.unique_cols, keep, (layout or self.layout()), not self.processes)
+
+    def run_tasks(self, mode, parts, table=None, keep=None, layout=None, before=None):
+        # Partitions are independent: write them concurrently & commit them as one version. Returns the failed partitions
+        self.check_writable()
+        version = self.version + 1
+        tag = write_tag(version)
+        tasks = [self.partition_task(mode, tag, table, val, idxs, keep, layout) for val, idxs in parts]
+        if self.max_workers == 1:
+            results = [run_task(t) for t in tasks]
+        else:
+            with (ProcessPoolExecutor if self.processes else ThreadPoolExecutor)(max_workers=self.max_workers) as pool:
+                results = list(pool.map(run_task, tasks))
+
+        failures, added, removed, deletes, tables = {}, [], [], {}, {}
+        for (val, _), (result, error) in zip(parts, results):
+            if error is not None:
+                failures[val] = error
+                continue
+            message, add, remove, vectors, ts = result
+            print("{} data for partition {}. {}".format({'upsert': 'Upserting', 'delete': 'Removing', 'compact': 'Compacting', 'optimize': 'Optimizing'}[mode], val, message))
+            added += [(val, p, stats) for p, stats in add]
+            removed += remove
+            deletes.update(vectors)
+            tables.update(ts)
+        if added or removed or deletes:
+            changes = (self.write_changes(version, tag, mode, before, table, keep, failures) if before is not None else None)
+            self.commit_changes(version, mode, added, removed, deletes, changes)
+            self.tables.update(tables)
+        return failures
+
+    def merge_parts(self, mode, table, keep=None):
+        self.wait()
+        table = self.sanitize(table)
+        # Dictionary partition columns are split in all their values, also those without rows
+        parts = [(tuple(str(v) for v in val), idxs) for val, idxs in split(table=table, columns=self.partition_cols) if len(idxs)]
+        if mode == 'delete':
+            for val in [val for val, _ in parts if val not in self.partitions_val]:
+                print("There does not data for partition:", self.partition_dict(val))
+            parts = [(val, idxs) for val, idxs in parts if val in self.partitions_val]
+        # The current rows of the keys, for the change feed
+        before = (self.get(table) if self.change_feed and parts else None)
+        failures = self.run_tasks(mode, parts, table, keep, before=before)
+
+        # Size-triggered compaction of the partitions that were written
+        full = [val for val, _ in parts if val not in failures and self.needs_compaction(val)]
+        if full:
+            self.compact(full, wait=not self.background)
+        if failures:
+            raise PartitionError(failures)
+
+    # Change feed
+    def change_rows(self, table):
+        # Partition columns as strings (like the partition values), the other columns in the dataset schema
+        return pa.Table.from_arrays([table.column(c).cast(pa.string()) for c in self.partition_cols] + [table.column(c).cast(self.arrow_schema.field(c).type) for c in self.columns],
+                                    names=self.partition_cols + self.columns)
+
+    def change_schema(self):
+        return pa.schema([pa.field(c, pa.string()) for c in self.partition_cols] + list(self.arrow_schema) + [pa.field(CHANGE_TYPE, pa.string()), pa.field(CHANGE_VERSION, pa.int64())])
+
+    def write_changes(self, version, tag, mode, before, table, keep, failures):
+        # The rows changed in the partitions that were written: the rows before the write (of the keys written) are compared with the
+        # rows after it, as the deduplication of the upsert (or delete) decides them. Returns the path of the change file
+        keys, before, rows = self.partition_cols + self.unique_cols, self.change_rows(before), self.change_rows(table)
+        if failures:
+            select = lambda t: t.take(pa.array(np.concatenate([np.array([], dtype=np.int64)] + [idxs for val, idxs in split(table=t, columns=self.partition_cols) if len(idxs) and tuple(val) not in failures])))
+            before, rows = select(before), select(rows)
+        if mode == 'delete':
+            deleted, changed = before, []
+        else:
+            flag = lambda t, new: t.append_column('_new', pa.array(np.full(t.num_rows, new)))
+            after = drop_duplicates(pa.concat_tables([flag(before, False), flag(rows, True)]), on=keys, keep=keep)
+            written = after.filter(after.column('_new')).drop(['_new'])
+            w_arr, b_arr = tables_to_arrays(written, before, keys)
+            existed = np.isin(w_arr, b_arr)
+            updated = before.filter(pa.array(np.isin(b_arr, w_arr[existed])))
+            b_arr, a_arr = tables_to_arrays(before, after, keys)
+            deleted = before.filter(pa.array(np.invert(np.isin(b_arr, a_arr))))
+            changed = [(written.filter(pa.array(np.invert(existed))), 'insert'), (updated, 'update_preimage'), (written.filter(pa.array(existed)), 'update_postimage')]
+        changes = pa.concat_tables([t.append_column(CHANGE_TYPE, pa.array(np.full(t.num_rows, kind), pa.string())).append_column(CHANGE_VERSION, pa.array(np.full(t.num_rows, version), pa.int64()))
+                                    for t, kind in changed + [(deleted, 'delete')]])
+        path = os.path.join(self.path, CHANGES, '{}.parquet'.format(tag))
+        write_file(path, changes, {**self.layout(), 'bloom': None})
+        return path
+
+    def changes(self, start_version, end_version=None):
+        # Rows changed by the versions after start_version up to end_version (the current version by default), in version order, so a
+        # consumer that processed start_version can apply them. Versions that changed rows without a change file (written without the
+        # change feed, or by save) raise
+        end_version = (self.version if end_version is None else end_version)
+        tables = []
+        for v in [v for v in self.log_versions() if start_version < v <= end_version]:
+            with open(self.log_path(v)) as f:
+                entry = json.load(f)
+            if 'changes' in entry:
+                tables.append(pq.read_table(self.absolute(entry['changes'])))
+            elif entry['operation'] not in ['compact', 'optimize']:
+                raise Exception("Version {} of {} has no change data ({}), read the full version instead".format(v, self.path, entry['operation']))
+        return (pa.concat_tables(tables) if tables else self.change_schema().empty_table())
+
+    def needs_compaction(self, partition_val):
+        paths, deltas = [self.pieces[i].path for i in self.get_idxs(partition_val)], self.deltas.get(partition_val, [])
+        files = [self.manifest[self.relative(p)] for p in paths + deltas]
+        base = sum(f['rows'] for f in files if f['kind'] == 'base')
+        changed = sum(f['rows'] for f in files if f['kind'] == 'delta') + sum(f['deletes']['deleted'] for f in files if f.get('deletes'))
+        return len(deltas) >= self.max_deltas or (changed > 0 and changed >= self.compact_ratio * base)
+
+    def has_deletes(self, partition_val):
+        return any(p in self.deletes for p in [self.pieces[i].path for i in self.get_idxs(partition_val)] + self.deltas.get(partition_val, []))
+
+    def compact(self, partition_vals=None, wait=True):
+        # Fold the deltas into the base file & purge the deleted rows of the partitions (all with deltas or deletes by default), in a
+        # background thread unless wait
+        self.wait()
+        vals = [val for val in (partition_vals if partition_vals is not None else list(dict.fromkeys(self.partitions_val))) if self.deltas.get(val) or self.has_deletes(val)]
+        if not vals:
+            return
+        if wait:
+            failures = self.run_tasks('compact', [(val, None) for val in vals])
+            if failures:
+                raise PartitionError(failures)
+            return
+        def run():
+            self.compaction_failures = self.run_tasks('compact', [(val, None) for val in vals])
+        self.compaction = threading.Thread(target=run)
+        self.compaction.start()
+
+    def optimize(self, zorder_by, partition_vals=None):
+        # Rewrite the partitions (all by default) in Z-order of the columns, with the deltas folded in & the deleted rows purged, so the
+        # row group statistics prune filters on any of the columns (sorting only prunes well on the first). Later rewrites use the
+        # layout of the dataset again (pass zorder_by to the dataset to keep it)
+        self.wait()
+        zorder_by = [c for c in zorder_by if c not in self.partition_cols]
+        missing = [c for c in zorder_by if c not in self.columns]
+        if missing or not zorder_by:
+            raise Exception("Can not Z-order by {}, choose from: {}".format(missing or zorder_by, ", ".join(self.columns)))
+        vals = (partition_vals if partition_vals is not None else list(dict.fromkeys(self.partitions_val)))
+        failures = self.run_tasks('optimize', [(val, None) for val in vals], layout={**self.layout(), 'zorder_by': zorder_by})
+        if failures:
+            raise PartitionError(failures)
+
+    def wait(self):
+        # Wait for a background compaction (all reads & writes do), raise its failures
+        if self.compaction is not None:
+            self.compaction.join()
+            self.compaction = None
+        failures, self.compaction_failures = self.compaction_failures, {}
+        if failures:
+            raise PartitionError(failures)
+
+    def upsert(self, table, keep='last'):
+        # keep='last' appends deltas, other values merge & rewrite the partitions
+        return self.merge_parts('upsert', table, keep=keep)
+
+    # Deletion by table (of unique keys), as deletion vectors
+    def delete(self, table):
+        return self.merge_parts('delete', table)
+
+    # Delete full partition
+    def delete_predicate(self, partition_val, predicate):
+        return
+
+def run_task(task):
+    # (result, None) or (None, exception), so one failed partition does not stop the others. The files a failed partition
+    # wrote are removed again
+    try:
+        return merge_partition(task), None
+    except Exception as e:
+        remove_written(task[2], task[1])
+        return None, e
+
+def remove_written(directory, tag):
+    # Files (& their sidecars) written in the directory by the write of the tag: their names hold it
+    for n in (os.listdir(directory) if os.path.isdir(directory) else []):
+        if tag in n:
+            os.remove(os.path.join(directory, n))
+
+if __name__ == '__main__':
+    t = ParquetUniqueDataset('data/skus', max_workers=8).set_unique(columns=['sku_key'])
+    table = t.read()
+    head(table)
+
+    # Upsert functionality
+    idxs = np.random.choice(table.num_rows, 100_000)
+    table_new = table.take(idxs)
+
+    t1 = time.time()
+    t.upsert(table_new)
+
+    # Remove functionality
+    t2 = time.time()
+    idxs = np.random.choice(table.num_rows, 100)
+    t.delete(table.take(idxs))
+
+    # Fold the remaining deltas into the base files
+    t3 = time.time()
+    t.compact()
+
+    print("Time upsert / delete / compact", t2 - t1, t3 - t2, time.time() - t3)
+
+    # The version before the upserts
+    print(t.history())
+    head(t.as_of(0).read())
@@ -0,0 +1,194 @@
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from wombat_db.datasets.table import ParquetUniqueDataset, list_deletes, committed_deletes
+
+# Statistics of registered sources, gathered once at registration (refresh with Engine.refresh)
+# Distinct counts the min / max can not bound are estimated from the first row group of up to NDV_SAMPLE pieces
+NDV_SAMPLE = 4
+
+def column_ndv(low, high, rows):
+    # Integer ranges bound the number of distinct values, otherwise unknown
+    if isinstance(low, int) and isinstance(high, int) and not isinstance(low, bool):
+        return min(rows, high - low + 1)
+    return None
+
+def sample_ndv(sample, rows):
+    # Haas & Stokes (Duj1) estimate from a sample of n rows with d distinct values, f1 of them seen once: n * d / (n - f1 + f1 * n / rows)
+    sample = (sample.cast(sample.type.value_type) if pa.types.is_dictionary(sample.type) else sample)
+    n = len(sample)
+    if not n:
+        return None
+    counts = pc.value_counts(sample).field('counts').to_numpy()
+    d, f1 = len(counts), int((counts == 1).sum())
+    return int(min(rows, max(d, round(n * d / (n - f1 + f1 * n / rows)))))
+
+def filter_selectivity(stats, op, value):
+    # Fraction of rows passing a filter, using distinct counts & min/max (with defaults if unknown)
+    ndv, low, high = stats.get('ndv'), stats.get('min'), stats.get('max')
+    if op in ['=', '==']:
+        return (1.0 / ndv if ndv else 0.1)
+    elif op == '!=':
+        return 1.0 - filter_selectivity(stats, '=', value)
+    elif op == 'in':
+        return min(1.0, (len(value) / ndv if ndv else 0.1 * len(value)))
+    elif op == 'not in':
+        return 1.0 - filter_selectivity(stats, 'in', value)
+    elif op in ['<', '<=', '>', '>=']:
+        try:
+            below = min(1.0, max(0.0, (value - low) / (high - low)))
+            return (below if op in ['<', '<='] else 1.0 - below)
+        except (TypeError, ZeroDivisionError):
+            return 1.0 / 3
+    else:
+        return 1.0
+
+def join_rows(rows_left, rows_right, ndv_left, ndv_right):
+    # Containment assumption: every key of the side with fewer distinct keys finds a match
+    return rows_left * rows_right / max(ndv_left or rows_left, ndv_right or rows_right, 1)
+
+def reopen(dataset):
+    # The pieces of a (legacy) dataset are listed once, open it again to find added files. Unique datasets follow their own writes
+    if isinstance(dataset, ParquetUniqueDataset):
+        return dataset
+    return pq.ParquetDataset(dataset.paths, filesystem=dataset.fs, memory_map=dataset.memory_map, buffer_size=dataset.buffer_size, read_dictionary=dataset.read_dictionary)
+
+class DatasetStatistics():
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.refresh()
+
+    def refresh(self):
+        d = self.dataset
+        self.pieces = d.pieces
+        self.partition_keys = ([p.name for p in d.partitions] if d.partitions else [])
+        self.partition_values = [{pk[0]: dp.keys[pk[1]] for pk, dp in zip(p.partition_keys, d.partitions)} for p in self.pieces]
+
+        # Footer metadata: per piece & row group row counts and column statistics (min, max, null count)
+        metas = [p.get_metadata() for p in self.pieces]
+        self.schema = metas[0].schema.to_arrow_schema()
+        self.columns = self.partition_keys + [c['path_in_schema'] for c in metas[0].row_group(0).to_dict()['columns']]
+        self.rows = [m.num_rows for m in metas]
+        self.row_groups = [[self.row_group_stats(m.row_group(r)) for r in range(m.num_row_groups)] for m in metas]
+        self.deletes = self.deletion_vectors()
+        return self.summarize()
+
+    def deletion_vectors(self):
+        # Per piece the deletion vector (or None): of the committed version if the dataset has a transaction log, else the newest
+        # vector next to the file (one listing per directory)
+        root = (self.dataset.paths if isinstance(self.dataset.paths, str) else None)
+        deletes = (committed_deletes(root) if root else None)
+        if deletes is None:
+            deletes = {}
+            for directory in set(os.path.dirname(p.path) for p in self.pieces):
+                deletes.update(list_deletes(directory))
+        deletes = {os.path.normpath(p): v for p, v in deletes.items()}
+        return [deletes.get(os.path.normpath(p.path)) for p in self.pieces]
+
+    def summarize(self):
+        # Aggregated column statistics
+        self.num_rows = sum(self.rows)
+        self.column_stats = {}
+        for rgs in self.row_groups:
+            for rg in rgs:
+                for c, (low, high, nulls) in rg['columns'].items():
+                    s = self.column_stats.setdefault(c, {'min': low, 'max': high, 'null_count': 0})
+                    s['null_count'] += (nulls or 0)
+                    try:
+                        s['min'] = (low if s['min'] is None or (low is not None and low < s['min']) else s['min'])
+                        s['max'] = (high if s['max'] is None or (high is not None and high > s['max']) else s['max'])
+                    except TypeError:
+                        s['min'], s['max'] = None, None
+        for c, s in self.column_stats.items():
+            s['ndv'] = column_ndv(s['min'], s['max'], self.num_rows)
+        for k in self.partition_keys:
+            self.column_stats[k] = {'min': None, 'max': None, 'null_count': 0, 'ndv': len(set(p[k] for p in self.partition_values))}
+        self.sampled = set()
+        return self
+
+    def stats(self, column):
+        # Column statistics, the distinct count estimated from a sample on first use if the min / max did not bound it
+        s = self.column_stats.get(column, {})
+        if s and s.get('ndv') is None and column not in self.sampled:
+            self.sampled.add(column)
+            try:
+                s['ndv'] = sample_ndv(self.sample(column), self.num_rows)
+            except (KeyError, pa.ArrowNotImplementedError, pa.ArrowInvalid, pa.ArrowTypeError):
+                pass
+        return s
+
+    def sample(self, column):
+        resolve = getattr(self.dataset, 'resolve', lambda path: path)
+        files = [pq.ParquetFile(resolve(self.pieces[i].path)) for i in sorted(set(np.linspace(0, len(self.pieces) - 1, min(NDV_SAMPLE, len(self.pieces))).astype(int)))]
+        return pa.chunked_array([c for f in files if f.metadata.num_row_groups for c in f.read_row_group(0, columns=[column]).column(0).chunks], type=self.schema.field(column).type)
+
+    @staticmethod
+    def row_group_stats(rg):
+        columns = {}
+        for j in range(rg.num_columns):
+            c = rg.column(j)
+            st = c.statistics
+            if st is not None and st.has_min_max:
+                columns[c.path_in_schema] = (st.min, st.max, st.null_count)
+            elif st is not None:
+                columns[c.path_in_schema] = (None, None, st.null_count)
+        return {'rows': rg.num_rows, 'columns': columns}
+
+    def ndv(self, column):
+        return self.stats(column).get('ndv')
+
+    def selectivity(self, filters):
+        return float(np.prod([filter_selectivity(self.stats(c), op, v) for c, op, v in filters]))
+
+    def to_dict(self):
+        return {'rows': self.num_rows, 'pieces': len(self.pieces), 'row_groups': sum(map(len, self.row_groups)), 'columns': self.column_stats}
+
+class UniqueDatasetStatistics(DatasetStatistics):
+    # Statistics of a version of a ParquetUniqueDataset from its transaction log (without reading footers): the base files are the
+    # pieces, the rows of the deltas are added to the row count of the first piece of their partition
+    def refresh(self):
+        d = self.dataset
+        self.pieces, self.partition_keys = d.pieces, list(d.partition_cols)
+        self.partition_values = [dict(zip(d.partition_cols, val)) for val in d.partitions_val]
+        files = [d.manifest[d.relative(p.path)] for p in self.pieces]
+        self.schema, self.columns = d.arrow_schema, self.partition_keys + list(d.columns)
+        self.rows = [f['rows'] - f.get('deletes', {}).get('deleted', 0) for f in files]
+        for val, deltas in d.deltas.items():
+            self.rows[d.get_idxs(val)[0]] += sum(d.manifest[d.relative(p)]['rows'] for p in deltas)
+        self.row_groups = [[{'rows': rg['rows'], 'columns': {c: (low, high, None) for c, (low, high) in rg['columns'].items()}} for rg in f['row_groups']] for f in files]
+        return self.summarize()
+
+class TableStatistics():
+    def __init__(self, table):
+        self.table = table
+        self.refresh()
+
+    def refresh(self):
+        self.schema, self.columns, self.num_rows = self.table.schema, self.table.column_names, self.table.num_rows
+        self.column_stats = {}
+        return self
+
+    def stats(self, column):
+        # Computed lazily, as in-memory tables are cheap to scan on demand
+        if column not in self.column_stats:
+            arr = self.table.column(column)
+            s = {'null_count': arr.null_count, 'min': None, 'max': None, 'ndv': None}
+            try:
+                mmx = pc.min_max(arr)
+                s['min'], s['max'] = mmx['min'].as_py(), mmx['max'].as_py()
+                s['ndv'] = len(pc.unique(arr))
+            except (pa.ArrowNotImplementedError, pa.ArrowInvalid, pa.ArrowTypeError):
+                pass
+            self.column_stats[column] = s
+        return self.column_stats[column]
+
+    def ndv(self, column):
+        return (self.stats(column)['ndv'] if column in self.columns else None)
+
+    def selectivity(self, filters):
+        return float(np.prod([filter_selectivity((self.stats(c) if c in self.columns else {}), op, v) for c, op, v in filters]))
+
+    def to_dict(self):
+        return {'rows': self.num_rows, 'columns': {c: self.stats(c) for c in self.columns}}
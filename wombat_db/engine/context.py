@@ -0,0 +1,56 @@
+from wombat_db.engine.memory import MemoryTracker
+from wombat_db.engine.optimizer import children
+import threading
+
+class QueryCancelled(Exception):
+    pass
+
+def passes_hash(node):
+    # Nodes that do not change their input (FilterNode) have their parent's hash
+    parent = getattr(node, 'parent', None)
+    return parent is not None and parent.hash_key == node.hash_key
+
+# State of a single query execution, passed down through node.get / node.fetch
+class QueryContext():
+    def __init__(self, verbose=False, memory_limit=None, track_memory=False, cache_obj=None, tracers=[], flights=None, sample=None):
+        self.verbose, self.tracers, self.flights, self.sample = verbose, list(tracers), flights, sample
+        self.cancelled = threading.Event()
+
+        # Batch execution (Engine.collect_many): remaining consumers of shared subtrees & merged scans
+        self.reuse, self.results, self.scans = {}, {}, {}
+        self.memory = (MemoryTracker(memory_limit, cache_obj) if memory_limit or track_memory else None)
+
+    def cancel(self):
+        # Stops the query at the next node or piece boundary
+        self.cancelled.set()
+
+    def check(self, node):
+        if self.cancelled.is_set():
+            raise QueryCancelled("Query cancelled in {}".format(node.__class__.__name__))
+        if self.memory:
+            self.memory.check(node)
+
+    def trace(self, event, **fields):
+        for t in self.tracers:
+            getattr(t, event)(**fields)
+
+    def reused(self, node):
+        # Result of a shared subtree computed earlier in the batch, released after its last consumer
+        t = (None if passes_hash(node) else self.results.get(node.hash_key))
+        if t is not None:
+            self.reuse[node.hash_key] -= 1
+            if self.reuse[node.hash_key] == 0:
+                del self.results[node.hash_key]
+        return t
+
+    def shared(self, node):
+        # Whether the subtree (or a part of it) has other consumers in the batch, that runtime filters would change the result for
+        scan = (self.scans.get(node.scan_key()) if hasattr(node, 'scan_key') else None)
+        if self.reuse.get(node.hash_key, 0) > 1 or node.hash_key in self.results or (scan and scan['uses'] > 0):
+            return True
+        return any(self.shared(c) for c in children(node))
+
+    def keep(self, node, t):
+        if self.reuse.get(node.hash_key, 0) > 1 and not passes_hash(node):
+            self.results[node.hash_key] = t
+            self.reuse[node.hash_key] -= 1
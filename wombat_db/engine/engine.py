@@ -1,11 +1,28 @@
 from wombat_db.engine.nodes import *
 from wombat_db.engine.sql import parse_sql
 from wombat_db.engine.column import ColumnNode
+from wombat_db.engine.optimizer import optimize, walk, children
+from wombat_db.engine.catalog import DatasetStatistics, UniqueDatasetStatistics, TableStatistics, reopen
+from wombat_db.datasets.table import ParquetUniqueDataset
+from wombat_db.engine.views import MaterializedView
+from wombat_db.engine.explain import Explain
+from wombat_db.engine.context import QueryContext, QueryCancelled, passes_hash
+from wombat_db.engine.tracing import JsonLinesTracer
+from wombat_db.engine.index import INDEXES, best_lookup
+from wombat_db.ops.trace import tracing
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import tempfile, threading, asyncio, os, time
+
+# Versions of a ParquetUniqueDataset kept open (with their statistics) for queries, per dataset
+MAX_SNAPSHOTS = 8
 
 # Computation plan (of multiple nodes)
 class ExecutionPlan():
     def __init__(self, node):
         self.database, self.last, self.cache_obj = node.database, node, node.cache_obj
+        self.lock = threading.RLock() # Nodes hold the state of an execution, so a plan is collected by one thread at a time
 
     def __getitem__(self, key):
         if isinstance(key, ColumnNode):
@@ -24,11 +41,98 @@ class ExecutionPlan():
         else:
             raise Exception("Value must be a column node reference")
 
-    def collect(self, verbose=False):
+    def optimize(self):
+        if self.database.optimize:
+            self.last, self.rewrites = optimize(self.last, tracers=self.database.tracers)
+        else:
+            self.rewrites = []
+        return self.rewrites
+
+    def prepare(self, verbose=False, sample=None):
+        # Optimize & push columns / filters down
+        self.optimize()
+        self.set_sample(sample)
         if verbose:
+            for r in self.rewrites:
+                print("Rewrite:", r)
             print("Columns:", ", ".join(self.last.columns_forward))
         self.last.backward(columns_backward=self.last.columns_forward, filters_backward=self.last.filters_forward)
-        return self.last.get(verbose)
+        for t in self.database.tracers:
+            t.plan_built(hash=self.last.hash_key, nodes=len(list(walk(self.last))), rewrites=self.rewrites, columns=self.last.columns_forward, filters=self.last.filters_forward)
+
+    def set_sample(self, sample):
+        # Approximate queries: the largest source reads a reproducible random subset (fraction, seed) of its row groups / rows
+        sources = [n for n in walk(self.last) if isinstance(n, (DatasetNode, TableNode))]
+        for n in sources:
+            n.sample = None
+        if sample:
+            if not 0 < sample[0] <= 1:
+                raise Exception("Sample fraction must be in (0, 1], got {}".format(sample[0]))
+            max(sources, key=lambda n: n.stats.num_rows).sample = list(sample)
+
+    def query_context(self, verbose=False, memory_limit=None, track_memory=False, sample=None, seed=0):
+        sample = ((sample, seed) if sample is not None else None)
+        return QueryContext(verbose=verbose, memory_limit=memory_limit, track_memory=track_memory, cache_obj=self.cache_obj, tracers=self.database.tracers, flights=self.database.flights, sample=sample)
+
+    def collect(self, verbose=False, memory_limit=None, track_memory=False, sample=None, seed=0):
+        # memory_limit (bytes) bounds the arrow memory allocated since the query started (by the query, and concurrent queries & the
+        # cache as they grow meanwhile): spills the cache, streams aggregates or raises MemoryLimitError
+        # sample (fraction) reads a random subset of the largest source: sums & counts of aggregates are scaled, with '<column> error' columns
+        return self.run(self.query_context(verbose, memory_limit, track_memory, sample, seed))
+
+    def run(self, ctx):
+        with self.lock:
+            self.context = ctx
+            self.prepare(ctx.verbose, ctx.sample)
+            with tracing(ctx.tracers):
+                return self.last.get(ctx)
+
+    def stream(self, verbose=False, memory_limit=None, ctx=None):
+        # Tables of the result piece by piece if the plan is row-local over a dataset, else the full result
+        ctx = (ctx or self.query_context(verbose, memory_limit))
+        with self.lock:
+            self.context = ctx
+            self.prepare(ctx.verbose, ctx.sample)
+        if self.last.can_stream():
+            for t in self.last.stream(ctx):
+                yield t
+        else:
+            with tracing(ctx.tracers):
+                yield self.last.get(ctx)
+
+    # Asyncio: the plan is executed on the engine's executor, cancelling the task stops the query at the next piece
+    async def collect_async(self, verbose=False, memory_limit=None, track_memory=False, sample=None, seed=0):
+        ctx = self.query_context(verbose, memory_limit, track_memory, sample, seed)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.database.get_executor(), self.run, ctx)
+        except asyncio.CancelledError:
+            ctx.cancel()
+            raise
+
+    async def stream_async(self, verbose=False, memory_limit=None):
+        ctx, done = self.query_context(verbose, memory_limit), object()
+        tables = self.stream(ctx=ctx)
+        def step():
+            with tracing(ctx.tracers):
+                return next(tables, done)
+        try:
+            while True:
+                t = await asyncio.get_running_loop().run_in_executor(self.database.get_executor(), step)
+                if t is done:
+                    return
+                yield t
+        finally:
+            # Cancelled or closed early by the consumer
+            ctx.cancel()
+
+    def explain(self, analyze=False, verbose=False, memory_limit=None):
+        with self.lock:
+            started = time.time()
+            if analyze:
+                self.collect(verbose, memory_limit=memory_limit, track_memory=True)
+            else:
+                self.prepare(verbose)
+            return Explain(self, analyze=analyze, started=started)
 
     # Numerical operations
     def filter(self, filters):
@@ -84,6 +188,7 @@ class ExecutionPlan():
     # Other utilities
     def plot(self, name):
         from graphviz import Digraph
+        self.optimize()
         dot = Digraph()
         nodes, count = [self.last], 1
         dot.node(str(count), label=self.last.graph_info(), shape='box')
@@ -110,11 +215,64 @@ class ExecutionPlan():
         dot.render('plan/{}'.format(name), view=True)
         return
 
+class SingleFlight():
+    # Concurrent computations of the same key are coalesced: the first caller computes, the others wait for its result
+    def __init__(self):
+        self.lock, self.calls = threading.Lock(), {}
+
+    def do(self, key, f):
+        # Returns (result, shared). If the computing query was cancelled, a waiting query computes it itself
+        while True:
+            try:
+                return self.do_once(key, f)
+            except QueryCancelled as e:
+                if e.args[-1] != 'shared':
+                    raise
+
+    def do_once(self, key, f):
+        me = threading.get_ident()
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = {'owner': me, 'done': threading.Event(), 'result': None, 'error': None}
+                leader = True
+            else:
+                leader = False
+
+        if not leader and call['owner'] == me:
+            # Nodes passing their parents hash (FilterNode) request the same key again
+            del call # Referenced by the error of the outer call, see below
+            return f(), False
+        elif not leader:
+            call['done'].wait()
+            if isinstance(call['error'], QueryCancelled):
+                raise QueryCancelled("Computing query cancelled", 'shared')
+            elif call['error'] is not None:
+                raise call['error']
+            return call['result'], True
+        try:
+            result = call['result'] = f()
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+            del call # The error's traceback references this frame, which would keep the failed computation alive
+        return result, False
+
 class Cache():
-    def __init__(self, max_memory=1e9):
+    def __init__(self, max_memory=1e9, spill_dir=None):
         self.tables, self.importance, self.memory, self.max_memory = {}, {}, 0, max_memory
+        self.spill_dir, self.spilled = spill_dir, {}
+        self.lock = threading.RLock()
 
     def put(self, key, table, weight=1.0):
+        with self.lock:
+            self.put_locked(key, table, weight)
+
+    def put_locked(self, key, table, weight):
         self.importance[key] = self.importance.get(key, 0.0) + weight
         if key not in self.tables.keys():
             b = table.nbytes
@@ -124,33 +282,217 @@ class Cache():
                     self.memory += b
                     return
                 
-                importances = [self.importance[k] for k in self.tables.keys()]
+                importances = {k: self.importance[k] for k in self.tables.keys()}
                 if not importances:
                     return
                 
-                if self.importance[key] > min(importances):
-                    min_key = importances.index(min(importances))
-                    self.memory -= self.tables[min_key]
-                    del self.tables[min_key]
+                min_key = min(importances, key=importances.get)
+                if self.importance[key] > importances[min_key]:
+                    self.remove(min_key)
                 else:
                     return
 
+    def replace(self, key, table, weight=1.0):
+        with self.lock:
+            if key in self.tables:
+                self.remove(key)
+            self.put_locked(key, table, weight)
+
+    def remove(self, key):
+        if key not in self.spilled:
+            self.memory -= self.tables[key].nbytes
+        del self.tables[key]
+        if key in self.spilled:
+            os.remove(self.spilled.pop(key))
+
+    def spill(self):
+        with self.lock:
+            return self.spill_locked()
+
+    def spill_locked(self):
+        # Move the in-memory tables to (memory mapped) arrow files, returns whether anything was spilled
+        keys = [k for k in self.tables.keys() if k not in self.spilled]
+        if not keys:
+            return False
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='wombat_spill_')
+        for k in keys:
+            path = os.path.join(self.spill_dir, k + '.arrow')
+            with pa.OSFile(path, 'wb') as sink:
+                with pa.ipc.new_file(sink, self.tables[k].schema) as writer:
+                    writer.write_table(self.tables[k])
+            self.tables[k] = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+            self.spilled[k] = path
+            self.memory -= self.tables[k].nbytes
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {'tables': len(self.tables), 'spilled': len(self.spilled), 'memory': self.memory, 'max_memory': self.max_memory}
+
+    def get(self, key):
+        with self.lock:
+            return self.tables.get(key)
+
     def keys(self):
-        return self.tables.keys()
+        with self.lock:
+            return list(self.tables.keys())
+
+    def __contains__(self, key):
+        return key in self.tables
 
     def __getitem__(self, key):
-        return self.tables[key]
+        with self.lock:
+            return self.tables[key]
 
 class Engine():
-    def __init__(self, cache_memory=0):
-        self.cache, self.tables, self.datasets, self.udfs = (cache_memory > 0), {}, {}, {}
+    def __init__(self, cache_memory=0, optimize=True, max_workers=None):
+        self.cache, self.tables, self.datasets, self.udfs, self.optimize = (cache_memory > 0), {}, {}, {}, optimize
+        self.catalog, self.tracers, self.flights = {}, [], SingleFlight()
+        self.max_workers, self.executor = max_workers, None
+        self.versions, self.registered, self.views = {}, {}, {}
+        self.snapshots, self.snapshot_lock = {}, threading.Lock()
+        self.indexes, self.index_lock = {}, threading.Lock()
         self.cache_obj = (Cache(max_memory=cache_memory) if self.cache else None)
 
     def register_table(self, name, table):
         self.tables[name] = table
+        self.catalog[name] = TableStatistics(table)
+        self.versions[name] = self.registered[name] = self.versions.get(name, 0) + 1
+        # Indexes are rebuilt on their next use, dropped if the new table lacks their columns
+        self.indexes[name] = [i for i in self.indexes.get(name, []) if set(i.columns) <= set(table.column_names)]
+
+    def append(self, name, data):
+        # Append rows (table or record batch) to a registered table, cached aggregates over it are updated incrementally
+        data = (pa.Table.from_batches([data]) if isinstance(data, pa.RecordBatch) else data)
+        table = pa.concat_tables([self.tables[name], data.select(self.tables[name].column_names).cast(self.tables[name].schema)])
+        self.tables[name] = table
+        self.catalog[name] = TableStatistics(table)
+        self.versions[name] += 1
+        return self.versions[name]
+
+    def create_index(self, name, columns, kind='sorted'):
+        # Secondary index on a registered table: 'sorted' (equality & range filters) or 'hash' (equality filters on all columns)
+        if name not in self.tables:
+            raise Exception("{} not in registered tables".format(name))
+        if kind not in INDEXES:
+            raise Exception("Index kind {} is not implemented!".format(kind))
+        columns = ([columns] if isinstance(columns, str) else list(columns))
+        index = INDEXES[kind](columns).build(self.tables[name], self.versions[name])
+        with self.index_lock:
+            self.indexes[name] = [i for i in self.indexes.get(name, []) if (i.kind, i.columns) != (kind, columns)] + [index]
+        return index
+
+    def drop_index(self, name, columns=None):
+        columns = ([columns] if isinstance(columns, str) else columns)
+        with self.index_lock:
+            self.indexes[name] = [i for i in self.indexes.get(name, []) if columns is not None and i.columns != list(columns)]
+
+    def index_lookup(self, name, version, filters):
+        # (index, (rows, remaining filters, rows())) of the best index for the filters on version of the table, or None
+        with self.index_lock:
+            indexes = self.indexes.get(name, [])
+            if not indexes or version != self.versions[name]:
+                return None
+            for i in indexes:
+                if i.version != version:
+                    i.build(self.tables[name], version)
+        return best_lookup(indexes, filters)
 
     def register_dataset(self, name, dataset):
+        # A ParquetUniqueDataset is read at the version it has when a query is prepared (see snapshot)
         self.datasets[name] = dataset
+        if isinstance(dataset, ParquetUniqueDataset):
+            self.snapshots[name] = OrderedDict()
+            self.catalog[name] = self.snapshot(name)[1]
+        else:
+            self.catalog[name] = DatasetStatistics(dataset)
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def snapshot(self, name, version=None):
+        # (dataset, statistics) of a version (the current one by default) of a registered ParquetUniqueDataset. Older versions are
+        # read only snapshots sharing the table cache of the dataset. The current version is the committed one the dataset has loaded:
+        # a background compaction is not waited for (its failures are for the writer), while it runs a snapshot is read instead
+        dataset = self.datasets[name]
+        with self.snapshot_lock:
+            compacting = dataset.compaction is not None and dataset.compaction.is_alive()
+            version = (dataset.version if version is None else version)
+            snapshots = self.snapshots[name]
+            if version not in snapshots or snapshots[version][0].version != version or (compacting and snapshots[version][0] is dataset):
+                ds = (dataset if version == dataset.version and not compacting else dataset.as_of(version))
+                snapshots[version] = (ds, UniqueDatasetStatistics(ds))
+                while len(snapshots) > MAX_SNAPSHOTS:
+                    snapshots.popitem(last=False)
+            snapshots.move_to_end(version)
+            if version == dataset.version:
+                self.catalog[name] = snapshots[version][1]
+            return snapshots[version]
+
+    def create_materialized_view(self, name, plan, path=None):
+        # Stores the result of the plan as table name, persisted to path (parquet, or arrow ipc for .arrow / .ipc / .feather)
+        self.views[name] = MaterializedView(name, plan, self, path=path)
+        return self.views[name]
+
+    def refresh(self, name=None):
+        # Re-list datasets (e.g. after files were added) & recompute statistics, then refresh materialized views
+        names = ([name] if name else list(self.catalog.keys()))
+        sources = [n for n in names if n not in self.views]
+        sources += [v.source.table for n, v in self.views.items() if n in names and v.source and v.source.table not in sources]
+        for n in sources:
+            if n in self.datasets:
+                self.register_dataset(n, reopen(self.datasets[n]))
+            else:
+                self.catalog[n].refresh()
+        for n in [n for n in names if n in self.views]:
+            self.views[n].refresh()
+
+    def get_executor(self):
+        # Shared by the async queries of this engine, so queries beyond max_workers wait for a free thread
+        with self.flights.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='wombat')
+        return self.executor
+
+    def collect_many(self, plans, verbose=False, memory_limit=None):
+        # Execute plans as a batch: subtrees shared by several plans (by hash) are computed once, and kept until
+        # their last consumer (also without cache). Scans of a dataset with the same filters are read once, with their combined columns.
+        ctx = QueryContext(verbose=verbose, memory_limit=memory_limit, cache_obj=self.cache_obj, tracers=self.tracers, flights=self.flights)
+        for plan in plans:
+            plan.prepare(verbose)
+
+        def consumers(node):
+            if passes_hash(node):
+                return consumers(node.parent)
+            ctx.reuse[node.hash_key] = ctx.reuse.get(node.hash_key, 0) + 1
+            if ctx.reuse[node.hash_key] > 1:
+                return # A shared subtree is computed once, so its children are consumed once
+            if isinstance(node, DatasetNode):
+                scan = ctx.scans.setdefault(node.scan_key(), {'columns': [], 'uses': 0, 'table': None})
+                scan['columns'], scan['uses'] = sorted(set(scan['columns'] + node.columns_backward)), scan['uses'] + 1
+            for c in children(node):
+                consumers(c)
+        for plan in plans:
+            consumers(plan.last)
+        ctx.scans = {k: v for k, v in ctx.scans.items() if v['uses'] > 1}
+        if verbose:
+            print("Shared subtrees: {}, merged scans: {}".format(sum(n > 1 for n in ctx.reuse.values()), len(ctx.scans)))
+
+        results = []
+        with tracing(ctx.tracers):
+            for plan in plans:
+                with plan.lock:
+                    plan.context = ctx
+                    results.append(plan.last.get(ctx))
+        return results
+
+    def add_tracer(self, tracer):
+        # Tracer (see engine.tracing) receiving plan, optimizer, node, piece read & kernel events, or a path for a json lines trace file
+        tracer = (JsonLinesTracer(tracer) if isinstance(tracer, str) else tracer)
+        self.tracers.append(tracer)
+        return tracer
+
+    def remove_tracer(self, tracer):
+        self.tracers.remove(tracer)
 
     def register_udf(self, name, function):
         self.udfs[name] = function
@@ -158,10 +500,14 @@ class Engine():
     def __getitem__(self, key):
         return self.select(key)
 
-    def select(self, name):
-        # Return a plan from a source node
+    def select(self, name, as_of=None):
+        # Return a plan from a source node, as_of: the version of a ParquetUniqueDataset to read
+        if as_of is not None and not isinstance(self.datasets.get(name), ParquetUniqueDataset):
+            raise Exception("{} is not a ParquetUniqueDataset, as_of is not supported".format(name))
         if name in self.tables.keys():
             return ExecutionPlan(TableNode(name, self, cache_obj=self.cache_obj))
+        elif isinstance(self.datasets.get(name), ParquetUniqueDataset):
+            return ExecutionPlan(UniqueDatasetNode(name, self, cache_obj=self.cache_obj, as_of=as_of))
         elif name in self.datasets.keys():
             return ExecutionPlan(DatasetNode(name, self, cache_obj=self.cache_obj))
         else:
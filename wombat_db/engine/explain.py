@@ -0,0 +1,79 @@
+import json
+from wombat_db.engine.optimizer import children
+
+# Optimized plan tree, with a per node profile when the plan was executed (analyze=True)
+class Explain():
+    def __init__(self, plan, analyze=False, started=0.0):
+        self.analyze, self.rewrites, self.started = analyze, plan.rewrites, started
+        self.tree = self.node_info(plan.last)
+
+    def node_info(self, node):
+        info = {'node': node.__class__.__name__}
+        info.update({k: v for k, v in node.properties().items() if k not in ['name', 'columns_backward']})
+        info.update({'columns': node.columns_backward, 'hash': node.hash_key, 'estimated_rows': node.estimate_rows()})
+        info.update(node.details())
+
+        kids = children(node)
+        if self.analyze:
+            p = getattr(node, 'profile', None)
+            if p and p['start'] >= self.started:
+                # Children only ran if this node did not come from the cache
+                ran = [c.profile for c in kids if getattr(c, 'profile', None) and c.profile['start'] >= p['start']]
+                info.update({'cached': p['cached'], 'rows_in': sum(c['rows'] for c in ran), 'rows_out': p['rows'], 'bytes': p['bytes']})
+                info.update({'start': p['start'] - self.started, 'time': p['time'], 'self_time': p['time'] - sum(c['time'] for c in ran)})
+                info.update({k: v for k, v in p.items() if k not in ['start', 'time', 'rows', 'bytes', 'cached']})
+            else:
+                info['executed'] = False
+        else:
+            info['cached'] = bool(node.cache and node.hash_key in node.cache_obj)
+        info['children'] = [self.node_info(c) for c in kids]
+        return info
+
+    def nodes(self, info=None, depth=0):
+        info = (self.tree if info is None else info)
+        yield depth, info
+        for c in info['children']:
+            yield from self.nodes(c, depth + 1)
+
+    # Exports
+    def to_dict(self):
+        return {'analyze': self.analyze, 'rewrites': self.rewrites, 'plan': self.tree}
+
+    def to_json(self, path=None, indent=2):
+        s = json.dumps(self.to_dict(), indent=indent, default=str)
+        if path:
+            with open(path, 'w') as f:
+                f.write(s)
+        return s
+
+    def to_chrome_trace(self, path=None):
+        # Complete events ('X') in microseconds, open in chrome://tracing or Perfetto
+        events = []
+        for depth, info in self.nodes():
+            if 'start' in info:
+                args = {k: v for k, v in info.items() if k not in ['children', 'start', 'time', 'node']}
+                events.append({'name': info['node'], 'cat': 'node', 'ph': 'X', 'ts': info['start'] * 1e6, 'dur': info['time'] * 1e6, 'pid': 0, 'tid': 0, 'args': args})
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if path:
+            with open(path, 'w') as f:
+                json.dump(trace, f, default=str)
+        return trace
+
+    def __str__(self):
+        lines = ["Rewrite: " + r for r in self.rewrites]
+        skip = ['node', 'children', 'hash', 'version', 'columns', 'start', 'time', 'self_time', 'rows_in', 'rows_out', 'bytes', 'cached', 'estimated_rows', 'executed', 'memory_peak', 'memory_current']
+        for depth, info in self.nodes():
+            props = ", ".join("{}: {}".format(k, v) for k, v in info.items() if k not in skip and v not in [None, [], {}])
+            if self.analyze and 'start' in info:
+                stats = "rows {} -> {} (est. {}), self {:.4f}s, total {:.4f}s, {:.1f} KB{}{}".format(
+                    info['rows_in'], info['rows_out'], info['estimated_rows'], info['self_time'], info['time'], info['bytes'] / 1024,
+                    (", peak {:.1f} KB".format(info['memory_peak'] / 1024) if 'memory_peak' in info else ""), (", cached" if info['cached'] else ""))
+            elif self.analyze:
+                stats = "not executed"
+            else:
+                stats = "est. rows {}{}".format(info['estimated_rows'], (", cached" if info['cached'] else ""))
+            lines.append("  " * depth + "{} [{}] {}".format(info['node'], stats, props).rstrip())
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return self.__str__()
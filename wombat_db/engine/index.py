@@ -0,0 +1,110 @@
+import numpy as np
+import pyarrow as pa
+from itertools import product
+from wombat_db.ops.helpers import groupify_array
+
+EQUALS, RANGES = ['=', '==', 'in'], ['<', '<=', '>', '>=']
+
+def key_arrays(table, columns):
+    # Numpy arrays of the index columns & the rows without nulls (which never pass the indexed filters)
+    arrs, valid = [], np.ones(table.num_rows, dtype=bool)
+    for c in columns:
+        col = table.column(c)
+        col = (col.cast(col.type.value_type) if pa.types.is_dictionary(col.type) else col)
+        if col.null_count:
+            valid &= col.is_valid().to_numpy(zero_copy_only=False)
+        arr = col.to_numpy()
+        # Strings as fixed width unicode, which sorts much faster than python objects
+        arrs.append(arr.astype(str) if arr.dtype == object and pa.types.is_string(col.type) else arr)
+    rows = (np.arange(table.num_rows) if valid.all() else np.nonzero(valid)[0])
+    return [arr[rows] for arr in arrs], rows
+
+def filter_values(f, dtype):
+    # Values cast to the column type (not for strings, which would be truncated to the column width)
+    values = np.array(sorted(set(f[2])) if f[1] == 'in' else [f[2]], dtype=(None if dtype.kind == 'U' else dtype))
+    if dtype.kind == 'U' and values.dtype.kind != 'U':
+        raise TypeError("Cannot compare {} with strings".format(values.dtype))
+    return values
+
+# Secondary indexes on registered tables (Engine.create_index), rebuilt when used after the table changed.
+# lookup(filters) returns (number of rows, remaining filters, rows()) for the filters it can answer, or None. rows() returns the
+# sorted row numbers passing those filters
+class SortedIndex():
+    kind = 'sorted'
+
+    def __init__(self, columns):
+        self.columns, self.version = columns, None
+
+    def build(self, table, version):
+        keys, rows = key_arrays(table, self.columns)
+        order = np.lexsort(keys[::-1])
+        self.keys, self.rows, self.version = [k[order] for k in keys], rows[order], version
+        return self
+
+    def lookup(self, filters):
+        # Binary search: equality on a prefix of the columns, optionally followed by a range on the next column
+        ranges, used = [(0, len(self.rows))], []
+        for c, keys in zip(self.columns, self.keys):
+            fs = [f for f in filters if f[0] == c and f[1] in EQUALS + RANGES]
+            eq = [f for f in fs if f[1] in EQUALS]
+            try:
+                if eq:
+                    values = filter_values(eq[0], keys.dtype)
+                    ranges = [(lo + a, lo + b) for lo, hi in ranges for a, b in zip(np.searchsorted(keys[lo:hi], values, 'left'), np.searchsorted(keys[lo:hi], values, 'right')) if a < b]
+                    used.append(eq[0])
+                    continue
+                for f in fs:
+                    value = filter_values((f[0], '=', f[2]), keys.dtype)[0]
+                    side = ('left' if f[1] in ['<', '>='] else 'right')
+                    bounds = [lo + np.searchsorted(keys[lo:hi], value, side) for lo, hi in ranges]
+                    ranges = [((lo, b) if f[1] in ['<', '<='] else (b, hi)) for (lo, hi), b in zip(ranges, bounds)]
+                    used.append(f)
+            except (ValueError, TypeError):
+                pass # Value not comparable with the column, left to the filter operation
+            break
+        if not used:
+            return None
+        rows = lambda: np.sort(np.concatenate([self.rows[lo:hi] for lo, hi in ranges]) if ranges else np.array([], dtype=np.int64))
+        return sum(hi - lo for lo, hi in ranges), [f for f in filters if f not in used], rows
+
+class HashIndex():
+    kind = 'hash'
+
+    def __init__(self, columns):
+        self.columns, self.version = columns, None
+
+    def build(self, table, version):
+        keys, rows = key_arrays(table, self.columns)
+        if len(self.columns) == 1:
+            dic, counts, sort_idx, _ = groupify_array(keys[0])
+            values = dic.tolist()
+        else:
+            # Tuple keys, numbered in order of appearance
+            codes = {}
+            inverse = np.array([codes.setdefault(t, len(codes)) for t in zip(*[k.tolist() for k in keys])], dtype=np.int64)
+            values, counts, sort_idx = list(codes.keys()), np.bincount(inverse, minlength=len(codes)), np.argsort(inverse, kind='stable')
+        self.map = dict(zip(values, np.split(rows[sort_idx], np.cumsum(counts)[:-1])))
+        self.version = version
+        return self
+
+    def lookup(self, filters):
+        # Equality (or in) filters on all columns
+        fs = [next((f for f in filters if f[0] == c and f[1] in EQUALS), None) for c in self.columns]
+        if None in fs:
+            return None
+        values = [(set(f[2]) if f[1] == 'in' else [f[2]]) for f in fs]
+        keys = ([v[0] for v in product(*values)] if len(self.columns) == 1 else list(product(*values)))
+        found = [self.map[k] for k in keys if k in self.map]
+        rows = lambda: np.sort(np.concatenate(found) if found else np.array([], dtype=np.int64))
+        return sum(len(r) for r in found), [f for f in filters if f not in fs], rows
+
+INDEXES = {'sorted': SortedIndex, 'hash': HashIndex}
+
+def best_lookup(indexes, filters):
+    # The index answering the most filters, and selecting the least rows
+    best = None
+    for index in indexes:
+        found = index.lookup(filters)
+        if found is not None and (best is None or (len(found[1]), found[0]) < (len(best[1][1]), best[1][0])):
+            best = (index, found)
+    return best
@@ -0,0 +1,64 @@
+import pyarrow as pa
+import threading
+from contextlib import contextmanager
+
+# The process wide pool, captured before any node pool is installed
+ROOT_POOL = pa.default_memory_pool()
+
+# Buffers keep a raw pointer to the pool they were allocated from (and may outlive the query in the cache, also when empty),
+# so node pools are never deleted: a node takes a free pool & returns it when it is done. A new pool is created (up to
+# MAX_NODE_POOLS) unless a free one is at its peak, as the peak of a node is only exact from there
+MAX_NODE_POOLS = 256
+NODE_POOLS, FREE_POOLS, ACTIVE, LOCK = [], [], 0, threading.Lock()
+
+class MemoryLimitError(Exception):
+    pass
+
+class MemoryTracker():
+    # Tracks arrow allocations per node through proxy pools, and enforces a memory limit on the arrow memory allocated since the
+    # query started (spilling the cache first)
+    # Note: node pools are installed as the (process wide) default pool & allocations are counted in the process' arrow memory, so
+    # with concurrent queries attribution & the limit are approximate
+    def __init__(self, limit=None, cache_obj=None):
+        self.limit, self.cache_obj, self.peak = limit, cache_obj, 0
+        self.start = ROOT_POOL.bytes_allocated()
+
+    @contextmanager
+    def track(self, node):
+        # Yields a dict, filled with the peak & current (net) allocation of the node when it is done
+        global ACTIVE
+        with LOCK:
+            gaps = [p.max_memory() - p.bytes_allocated() for p in FREE_POOLS]
+            if FREE_POOLS and (min(gaps) == 0 or len(NODE_POOLS) >= MAX_NODE_POOLS):
+                pool = FREE_POOLS.pop(gaps.index(min(gaps)))
+            else:
+                pool = pa.proxy_memory_pool(ROOT_POOL)
+                NODE_POOLS.append(pool)
+            previous, start, peak = pa.default_memory_pool(), pool.bytes_allocated(), pool.max_memory()
+            ACTIVE += 1
+            pa.set_memory_pool(pool)
+        usage = {}
+        try:
+            yield usage
+        finally:
+            # With concurrent queries the pools do not nest, the root pool is restored once none is tracking
+            with LOCK:
+                ACTIVE -= 1
+                pa.set_memory_pool(previous if ACTIVE else ROOT_POOL)
+                current = max(pool.bytes_allocated() - start, 0)
+                # Below the earlier peak of a reused pool, the node's own peak is unknown: its net allocation is a lower bound
+                usage.update({'memory_peak': (pool.max_memory() - start if pool.max_memory() > peak else current), 'memory_current': current})
+                FREE_POOLS.append(pool)
+
+    def used(self):
+        return ROOT_POOL.bytes_allocated() - self.start
+
+    def check(self, node):
+        used = self.used()
+        self.peak = max(self.peak, used)
+        if self.limit and used > self.limit:
+            # Spill cached tables to disk first, fail if that did not free enough
+            if self.cache_obj is not None and self.cache_obj.spill():
+                used = self.used()
+            if used > self.limit:
+                raise MemoryLimitError("Memory limit of {:.0f} MB exceeded in {}: {:.0f} MB allocated".format(self.limit / 1e6, node.__class__.__name__, used / 1e6))
@@ -2,9 +2,18 @@ import pyarrow as pa
 import pyarrow.parquet as pq
 import numpy as np
 from wombat_db.ops import join, groupby, filters
+from wombat_db.ops.bloom import BloomFilter, hash_columns
+from wombat_db.ops.group import split_methods, finalize_means
+from wombat_db.engine.memory import MemoryLimitError
 from wombat_db.engine.column import ColumnNode
+from wombat_db.engine.catalog import join_rows
+from wombat_db.datasets.table import read_deletes
+from bisect import bisect_left
 import hashlib, json, time
 
+# Join keys with more distinct values are pushed as min/max range + bloom filter instead of an 'in' list
+RUNTIME_MAX_VALUES = 10000
+
 # Computation nodes
 class BaseNode():
     def check(self, needed, reference):
@@ -17,8 +26,8 @@ class BaseNode():
         return self.columns_backward
 
     def properties(self):
-        fields = ['table', 'on', 'filters', 'by', 'methods', 'key', 'ascending', 'calculation', 'columns_backward']
-        obj = {k: v for k,v in self.__dict__.items() if k in fields}
+        fields = ['table', 'version', 'snapshot', 'sample', 'on', 'filters', 'by', 'methods', 'key', 'ascending', 'calculation', 'rewrite', 'columns_backward']
+        obj = {k: v for k,v in self.__dict__.items() if k in fields and not (k == 'sample' and v is None)}
         return {**{'name': self.__class__.__name__}, **obj}
 
     def graph_info(self):
@@ -38,48 +47,164 @@ class BaseNode():
         hp = self.parent.backward(columns_backward=self.columns_backward, filters_backward=filters_backward)
         return self.hash(h=hp)
 
-    def get(self, verbose):
+    # Cardinality estimates, filters default to the ones pushed down in the backward pass
+    def estimate_rows(self, filters=None):
+        return self.parent.estimate_rows(filters)
+
+    def estimate_ndv(self, column):
+        return self.parent.estimate_ndv(column)
+
+    def passes(self, column):
+        # Whether a column passes this node unchanged (runtime filters can be pushed through)
+        return True
+
+    def runtime(self, filters, blooms, token):
+        # Push runtime filters (from a join) to the sources. The output changes, so the hash does too
+        filters, blooms = [f for f in filters if self.passes(f[0])], [b for b in blooms if all(self.passes(c) for c in b[0])]
+        if filters or blooms:
+            self.hash_key = hashlib.sha256((self.hash_key + token).encode()).hexdigest()
+            self.runtime_parents(filters, blooms, token)
+
+    def runtime_parents(self, filters, blooms, token):
+        self.parent.runtime(filters, blooms, token)
+
+    def details(self):
+        # Node specific information for explain()
+        return {}
+
+    def get(self, ctx):
         self.time = time.time()
-        if self.cache and self.hash_key in self.cache_obj.keys():
-            t = self.cache_obj[self.hash_key]
-            if verbose:
-                print("Node: {} Rows: {} Cumulative Time: {:2f} (cached)".format(self.__class__.__name__.ljust(16), str(t.num_rows).ljust(9), time.time() - self.time))
+        ctx.check(self)
+        if ctx.tracers:
+            ctx.trace('node_start', node=self.__class__.__name__, hash=self.hash_key, table=getattr(self, 'table', None))
+        reused = ctx.reused(self)
+        t = (reused if reused is not None else self.cache_obj.get(self.hash_key) if self.cache else None)
+        cached, shared = t is not None, False
+        if cached:
+            memory = {}
+            if ctx.verbose:
+                print("Node: {} Rows: {} Cumulative Time: {:2f} ({})".format(self.__class__.__name__.ljust(16), str(t.num_rows).ljust(9), time.time() - self.time, ("cached" if reused is None else "reused")))
         else:
-            t = self.fetch(verbose)
-            if verbose:
-                print("Node: {} Rows: {} Cumulative Time: {:2f}".format(self.__class__.__name__.ljust(16), str(t.num_rows).ljust(9), time.time() - self.time))
-            if self.cache:
-                self.cache_obj.put(self.hash_key, t, weight=time.time() - self.time)
+            # Identical subtrees requested concurrently (by other threads) are computed once
+            (t, memory), shared = (ctx.flights.do(self.hash_key, lambda: self.compute(ctx)) if ctx.flights else (self.compute(ctx), False))
+            if ctx.verbose:
+                print("Node: {} Rows: {} Cumulative Time: {:2f}{}".format(self.__class__.__name__.ljust(16), str(t.num_rows).ljust(9), time.time() - self.time, (" (shared)" if shared else "")))
+            ctx.keep(self, t)
+        ctx.check(self)
+        self.profile = {'start': self.time, 'time': time.time() - self.time, 'rows': t.num_rows, 'bytes': t.nbytes, 'cached': cached, **({'shared': True} if shared else memory)}
+        if reused is not None:
+            self.profile['reused'] = True
+        if ctx.tracers:
+            ctx.trace('node_end', node=self.__class__.__name__, hash=self.hash_key, table=getattr(self, 'table', None), **{k: v for k, v in self.profile.items() if k != 'start'})
         return t
 
+    def compute(self, ctx):
+        t, memory = self.tracked_fetch(ctx)
+        if self.cache:
+            self.cache_obj.put(self.hash_key, t, weight=time.time() - self.time)
+        return t, memory
+
+    def tracked_fetch(self, ctx):
+        # Arrow allocations of this node (excluding its parents, which install their own pool)
+        if not ctx.memory:
+            return self.fetch(ctx), {}
+        with ctx.memory.track(self) as usage:
+            t = self.fetch(ctx)
+        return t, usage
+
+    # Row-local nodes transform each table independently, so can be evaluated piece by piece
+    streamable = False
+
+    def fetch(self, ctx):
+        return self.transform(self.parent.get(ctx))
+
+    def stream(self, ctx):
+        # Tables of the parent chain (down to a dataset), one per piece
+        for t in self.parent.stream(ctx):
+            yield self.transform(t)
+
+    def can_stream(self):
+        return self.streamable and self.parent.can_stream()
+
 # Sources
 class TableNode(BaseNode):
     def __init__(self, table, database, cache_obj=None):
         self.table, self.database, self.cache_obj = table, database, cache_obj
-        self.cache = (cache_obj != None)
-        self.t = self.database.tables[table]
+        self.cache, self.sample = (cache_obj != None), None
+        self.bind()
         self.columns = self.t.column_names
         self.columns += list(set([c.split('.')[0] for c in self.columns if '.' in c]))
 
         # Forward propagation of nodes
         self.columns_source, self.columns_forward, self.filters_forward = self.columns, [], []
 
+    def bind(self):
+        # Current version of the source (re-registered or appended tables)
+        self.t, self.stats, self.version = self.database.tables[self.table], self.database.catalog[self.table], self.database.versions[self.table]
+
     def backward(self, columns_backward=[], filters_backward=[]):
+        self.bind()
         self.columns_bw(columns_backward)
-        self.filters = filters_backward
+        self.filters, self.runtime_filters, self.runtime_blooms, self.offset = filters_backward, [], [], 0
+        self.index, self.sample_rate = None, None
+        if self.sample:
+            # Reproducible random rows: (fraction, seed) set by collect(sample=...)
+            fraction, seed = self.sample
+            self.sample_rows = np.flatnonzero(np.random.default_rng(seed).random(self.t.num_rows) < fraction)
+            self.sample_rate = (len(self.sample_rows) / self.t.num_rows if self.t.num_rows else 1.0)
         return self.hash()
 
-    def fetch(self, verbose):
-        t = self.t.select(self.columns_backward)
-        tf = (filters(t, self.filters) if self.filters else t)
-        return tf
+    def appended_since(self, version, rows):
+        # Whether the table only had rows appended since (version, rows)
+        return self.database.registered[self.table] <= version and rows <= self.t.num_rows
+
+    def estimate_rows(self, filters=None):
+        return int(self.t.num_rows * self.stats.selectivity((self.filters if filters is None else filters)))
+
+    def estimate_ndv(self, column):
+        return self.stats.ndv(column)
+
+    def runtime_parents(self, filters, blooms, token):
+        self.runtime_filters, self.runtime_blooms = self.runtime_filters + filters, self.runtime_blooms + blooms
+
+    def details(self):
+        info = {'filters': self.filters, 'runtime_filters': runtime_info(self.runtime_filters, self.runtime_blooms), 'columns_read': '{}/{}'.format(len(self.columns_backward), len(self.t.column_names))}
+        if getattr(self, 'index', None):
+            info['index'] = self.index
+        if self.sample:
+            info['sample'] = sample_info(self.sample, self.sample_rate)
+        return info
+
+    def can_stream(self):
+        return True
+
+    def stream(self, ctx):
+        yield self.fetch(ctx)
+
+    def fetch(self, ctx):
+        # Rows from offset on (the rows appended since an incremental aggregate state)
+        t, fs = self.t.select(self.columns_backward), self.filters + self.runtime_filters
+        found = (self.database.index_lookup(self.table, self.version, fs) if fs else None)
+        if found:
+            # Rows selected by an index (binary search or hash lookup), the other filters are applied to those
+            index, (n, fs, rows) = found
+            self.index, rows = '{}({}): {} rows'.format(index.kind, ', '.join(index.columns), n), rows()
+            rows = (np.intersect1d(rows, self.sample_rows, assume_unique=True) if self.sample else rows)
+            t = t.take(rows[np.searchsorted(rows, self.offset):] if self.offset else rows)
+        elif self.sample:
+            t = t.take(self.sample_rows)
+        else:
+            t = (t.slice(self.offset) if self.offset else t)
+        tf = (filters(t, fs) if fs else t)
+        return bloom_filters(tf, self.runtime_blooms)
 
 def part_check(part, op, value):
     # Try to cast partition to value
+    vtype = (type(next(iter(value), part)) if op in ['in', 'not in'] else type(value))
     try:
-        part = type(value)(part)
+        part = vtype(part)
     except:
-        raise Exception("Cannot downcast {} to data type {}".format(part, type(value)))
+        raise Exception("Cannot downcast {} to data type {}".format(part, vtype))
 
     if op in ['=', '==']:
         return part == value
@@ -100,51 +225,272 @@ def part_check(part, op, value):
     else:
         raise Exception("Operand {} is not implemented!".format(op))
 
+def stats_check(low, high, op, value):
+    # Whether a row group with values in [low, high] can hold rows passing the filter ('in' values are sorted)
+    try:
+        if op in ['=', '==']:
+            return low <= value <= high
+        elif op == '<':
+            return low < value
+        elif op == '>':
+            return high > value
+        elif op == '<=':
+            return low <= value
+        elif op == '>=':
+            return high >= value
+        elif op == 'in':
+            i = bisect_left(value, low)
+            return i < len(value) and value[i] <= high
+        else:
+            return True
+    except TypeError:
+        return True
+
+def runtime_info(fs, blooms):
+    return ["{} {} {}".format(c, op, ("({} values)".format(len(v)) if op == 'in' else v)) for c, op, v in fs] + ["bloom({})".format(", ".join(b[0])) for b in blooms]
+
+def sample_unit(seed, *key):
+    # Uniform in [0, 1) from a hash of the seed & the unit, so a unit is in the sample of every query with that seed
+    return int(hashlib.sha256(json.dumps([seed, *key]).encode()).hexdigest()[:12], 16) / 16 ** 12
+
+def sample_info(sample, rate):
+    return '{:g}% (seed {}), {:.2f}% of rows'.format(100 * sample[0], sample[1], 100 * (rate or 0))
+
+def sampled_rate(node):
+    # Fraction of the rows sampled below node (None if not sampled). Aggregates scale their output, so stop there
+    if isinstance(node, AggregateNode):
+        return None
+    parents = ([node.parent] if hasattr(node, 'parent') else [node.left, node.right] if hasattr(node, 'left') else [])
+    rates = [r for r in [getattr(node, 'sample_rate', None)] + [sampled_rate(p) for p in parents] if r is not None]
+    return (float(np.prod(rates)) if rates else None)
+
+def scale_sampled(t, methods, rate):
+    # Sums & counts of sampled rows scaled by the inverse rate, with standard errors (Poisson sampling of rows: row groups
+    # are sampled as a whole, so for values clustered in row groups the error is underestimated)
+    for col, (ref, m) in methods.items():
+        if m not in ['sum', 'count', 'mean']:
+            continue
+        value = t.column(col).to_numpy().astype(float)
+        if m == 'sum':
+            squares = t.column(col + ' squares').to_numpy().astype(float)
+            scaled, error = value / rate, np.sqrt((1 - rate) * squares) / rate
+        elif m == 'count':
+            scaled, error = value / rate, np.sqrt((1 - rate) * value) / rate
+        else:
+            squares, rows = t.column(col + ' squares').to_numpy().astype(float), t.column(col + ' rows').to_numpy().astype(float)
+            scaled, error = value, np.sqrt((1 - rate) * np.maximum(squares / rows - value ** 2, 0) / rows)
+        t = t.set_column(t.column_names.index(col), col, pa.array(scaled)).append_column(col + ' error', pa.array(error))
+    helpers = [k + ' squares' for k in methods] + [k + ' rows' for k in methods]
+    return t.select([c for c in t.column_names if c not in helpers])
+
+def strategy_info(strategy, info):
+    return '{} ({})'.format(strategy, ', '.join('{}: {}'.format(k, v) for k, v in info.items()))
+
+def bloom_filters(table, blooms):
+    for columns, bloom in blooms:
+        table = table.filter(pa.array(bloom.contains(hash_columns(table, columns))))
+    return table
+
+def key_filters(table, on):
+    # Runtime filters on the join keys of an evaluated join side
+    fs, blooms = [], []
+    if table.num_rows == 0:
+        return [(c, 'in', []) for c in on], blooms
+    for c in on:
+        values = pa.compute.unique(table.column(c))
+        if pa.types.is_dictionary(values.type):
+            values = values.dictionary.take(values.indices)
+        values = sorted(v for v in values.to_pylist() if v is not None)
+        if len(values) <= RUNTIME_MAX_VALUES:
+            fs.append((c, 'in', values))
+        else:
+            fs += [(c, '>=', values[0]), (c, '<=', values[-1])]
+            if not blooms:
+                blooms.append((on, BloomFilter.from_table(table, on)))
+    return fs, blooms
+
+def read_row_groups(piece, row_groups, columns, partitions):
+    # Same as piece.read, for a subset of the row groups
+    table = piece.open().read_row_groups(row_groups, columns=columns)
+    for i, (name, index) in enumerate(piece.partition_keys):
+        indices = np.full(table.num_rows, index, dtype='i4')
+        table = table.append_column(name, pa.DictionaryArray.from_arrays(indices, partitions.levels[i].dictionary))
+    return table
+
 class DatasetNode(BaseNode):
     def __init__(self, table, database, cache_obj=None):
         self.table, self.database, self.cache_obj = table, database, cache_obj
-        self.cache = (cache_obj != None)
-        self.dataset = database.datasets[table]
+        self.cache, self.sample = (cache_obj != None), None
+        self.restrict = None # Only read pieces with these paths (incremental view refresh)
 
-        self.partition_keys = [p.name for p in self.dataset.partitions]
-        self.partition_values = [{pk[0]: dp.keys[pk[1]] for pk, dp in zip(p.partition_keys, self.dataset.partitions)} for p in self.dataset.pieces]
-        self.meta = self.dataset.pieces[0].get_metadata()
-        self.columns = self.partition_keys + [c['path_in_schema'] for c in self.meta.row_group(0).to_dict()['columns']]
+        # Partitions & columns come from the catalog, which is built at registration
+        self.bind()
+        self.columns = list(self.stats.columns)
         self.columns += list(set([c.split('.')[0] for c in self.columns if '.' in c]))
 
         # Forward propagation of nodes
         self.columns_source, self.columns_forward, self.filters_forward = self.columns, [], []
 
+    def bind(self):
+        # Current version of the source (pieces change when the dataset is refreshed)
+        self.dataset, self.stats, self.version = self.database.datasets[self.table], self.database.catalog[self.table], self.database.versions[self.table]
+        self.partition_keys, self.partition_values = self.stats.partition_keys, self.stats.partition_values
+
     def backward(self, columns_backward=[], filters_backward=[]):
+        self.bind()
         self.columns_bw(columns_backward)
         self.filters = filters_backward
         self.part_filters = list(filter(lambda f: f[0] in self.partition_keys, self.filters))
         self.value_filters = list(filter(lambda f: f[0] not in self.partition_keys, self.filters))
+        self.runtime_filters, self.runtime_blooms, self.pieces_read = [], [], None
+        self.sample_rate = (self.sample_scan(self.scan(self.part_filters, self.value_filters))[1] if self.sample else None)
         return self.hash()
 
+    def estimate_rows(self, filters=None):
+        filters = (self.filters if filters is None else filters)
+        part_filters = [f for f in filters if f[0] in self.partition_keys]
+        rows = sum(self.stats.rows[i] for i in range(len(self.stats.pieces)) if self.partition_check(self.partition_values[i], part_filters))
+        return int(rows * self.stats.selectivity([f for f in filters if f[0] not in self.partition_keys]))
+
+    def estimate_ndv(self, column):
+        return self.stats.ndv(column)
+
+    def runtime_parents(self, filters, blooms, token):
+        self.runtime_filters, self.runtime_blooms = self.runtime_filters + filters, self.runtime_blooms + blooms
+
     def partition_check(self, partition_value, filters):
         for key, op, value in filters:
             if not part_check(partition_value[key], op, value):
                 return False
         return True
 
-    def fetch(self, verbose):
+    def row_group_check(self, i, filters):
+        # Skip row groups by their min/max statistics, returns None if all row groups are needed
+        rgs = self.stats.row_groups[i]
+        if not filters or not rgs:
+            return None
+        row_groups = []
+        for r, rg in enumerate(rgs):
+            stats = [(rg['columns'][c], op, value) for c, op, value in filters if c in rg['columns']]
+            if all(low is None or stats_check(low, high, op, value) for (low, high, _), op, value in stats):
+                row_groups.append(r)
+        return (None if len(row_groups) == len(rgs) else row_groups)
+
+    def scan(self, part_filters, value_filters):
+        # Pieces & row groups to read: [(piece index, row groups or None for all)]
+        stats_filters = [(c, op, (sorted(v) if op == 'in' else v)) for c, op, v in value_filters if '.' not in c]
+        pieces = []
+        for i in range(len(self.stats.pieces)):
+            if self.restrict is not None and self.stats.pieces[i].path not in self.restrict:
+                continue
+            if self.partition_check(self.partition_values[i], part_filters):
+                row_groups = self.row_group_check(i, stats_filters)
+                if row_groups is None or row_groups:
+                    pieces.append((i, row_groups))
+        return pieces
+
+    def sample_scan(self, pieces):
+        # Reproducible random subset of the row groups to read (at least one): (pieces, fraction of the rows sampled)
+        fraction, seed = self.sample
+        units = [(i, r) for i, rgs in pieces for r in (range(len(self.stats.row_groups[i])) if rgs is None else rgs)]
+        u = {(i, r): sample_unit(seed, self.stats.pieces[i].path, r) for i, r in units}
+        keep = ([k for k in units if u[k] < fraction] or sorted(units, key=u.get)[:1])
+        rows = lambda ks: sum(self.stats.row_groups[i][r]['rows'] for i, r in ks)
+        sampled = {}
+        for i, r in keep:
+            sampled.setdefault(i, []).append(r)
+        return list(sampled.items()), (rows(keep) / rows(units) if rows(units) else 1.0)
+
+    def scan_info(self, pieces):
+        read = sum((len(self.stats.row_groups[i]) if rgs is None else len(rgs)) for i, rgs in pieces)
+        return {'pieces_read': '{}/{}'.format(len(pieces), len(self.stats.pieces)), 'row_groups_read': '{}/{}'.format(read, sum(map(len, self.stats.row_groups)))}
+
+    def details(self):
+        pieces = getattr(self, 'pieces_read', None) or self.scan(self.part_filters, self.value_filters)
+        info = {'partition_filters': self.part_filters, 'filters': self.value_filters, 'runtime_filters': runtime_info(self.runtime_filters, self.runtime_blooms)}
+        info['columns_read'] = '{}/{}'.format(len(self.columns_backward), len(self.stats.columns))
+        if self.sample:
+            info['sample'] = sample_info(self.sample, self.sample_rate)
+        return {**info, **self.scan_info(pieces)}
+
+    def read_plan(self, columns_backward=None):
+        columns = [c for c in (columns_backward or self.columns_backward) if c not in self.partition_keys]
+        part_filters = self.part_filters + [f for f in self.runtime_filters if f[0] in self.partition_keys]
+        value_filters = self.value_filters + [f for f in self.runtime_filters if f[0] not in self.partition_keys]
+        self.pieces_read = self.scan(part_filters, value_filters)
+        self.pieces_read = (self.sample_scan(self.pieces_read)[0] if self.sample else self.pieces_read)
+        return columns, value_filters
+
+    def read_piece(self, ctx, i, row_groups, columns):
+        start = time.time()
+        if row_groups is None:
+            t = self.stats.pieces[i].read(columns=columns, partitions=self.dataset.partitions)
+        else:
+            t = read_row_groups(self.stats.pieces[i], row_groups, columns, self.dataset.partitions)
+        t = self.apply_deletes(i, row_groups, t)
+        if ctx.tracers:
+            ctx.trace('piece_read', table=self.table, path=self.stats.pieces[i].path, row_groups=row_groups, rows=t.num_rows, bytes=t.nbytes, time=time.time() - start)
+        return t
+
+    def apply_deletes(self, i, row_groups, t):
+        # Rows marked in the deletion vector of the piece (ParquetUniqueDataset.delete, found at registration), by position in the file
+        deleted = read_deletes(self.stats.deletes[i])
+        if deleted is None or not deleted.any():
+            return t
+        if row_groups is not None:
+            starts = np.cumsum([0] + [rg['rows'] for rg in self.stats.row_groups[i]])
+            deleted = np.concatenate([deleted[starts[r]:starts[r + 1]] for r in row_groups])
+        return t.filter(pa.array(np.invert(deleted)))
+
+    def scan_key(self):
+        # Scans with the same source & filters can be served by one read of their combined columns
+        return json.dumps([self.table, self.filters, self.sample], sort_keys=True, default=str)
+
+    def fetch(self, ctx):
+        merged = (ctx.scans.get(self.scan_key()) if ctx.scans and not (self.runtime_filters or self.runtime_blooms) else None)
+        if merged is None:
+            return self.read(ctx)
+        if merged['table'] is None:
+            merged['table'] = self.read(ctx, merged['columns'])
+        t, merged['uses'] = merged['table'], merged['uses'] - 1
+        if merged['uses'] == 0:
+            merged['table'] = None
+        # In the order of a read of the own columns
+        return t.select([c for c in self.columns_backward if c in t.column_names and c not in self.partition_keys] + [c for c in t.column_names if c in self.partition_keys])
+
+    def read(self, ctx, columns_backward=None):
         ts = []
-        for i, p in enumerate(self.dataset.pieces):
-            if self.partition_check(self.partition_values[i], self.part_filters):
-                t = p.read(
-                    columns=[c for c in self.columns_backward if c not in self.partition_keys], 
-                    partitions=self.dataset.partitions
-                )
-                ts.append(t)
+        columns, value_filters = self.read_plan(columns_backward)
+        for i, row_groups in self.pieces_read:
+            ts.append(self.read_piece(ctx, i, row_groups, columns))
+            ctx.check(self)
+        if not ts:
+            # Nothing passed the filters: return an empty table with the right schema
+            ts.append(self.empty(columns))
         table = pa.concat_tables(ts)
-        return (filters(table, self.value_filters) if self.value_filters else table)
+        table = (filters(table, value_filters) if value_filters else table)
+        return bloom_filters(table, self.runtime_blooms)
 
-    def fetch_v2(self, verbose):
+    def empty(self, columns):
+        return read_row_groups(self.stats.pieces[0], [0], columns, self.dataset.partitions).slice(0, 0)
+
+    def can_stream(self):
+        return True
+
+    def stream(self, ctx):
+        # Filtered pieces one by one, so they can be aggregated with bounded memory
+        columns, value_filters = self.read_plan()
+        for i, row_groups in self.pieces_read:
+            t = self.read_piece(ctx, i, row_groups, columns)
+            t = (filters(t, value_filters) if value_filters else t)
+            yield bloom_filters(t, self.runtime_blooms)
+            ctx.check(self)
+
+    def fetch_v2(self, ctx):
         ts = []
         columns = [c for c in self.columns_backward if c not in self.partition_keys]
         read_filters, final_filters = [v for v in self.value_filters if '.' not in v[0]], [v for v in self.value_filters if '.' in v[0]]        
-        for i, p in enumerate(self.dataset.pieces):
+        for i, p in enumerate(self.stats.pieces):
             if self.partition_check(self.partition_values[i], self.part_filters):
                 # Read filtered parquet tables
                 t = pq.read_table(
@@ -161,6 +507,67 @@ class DatasetNode(BaseNode):
         table = pa.concat_tables(ts)
         return (filters(table, final_filters) if final_filters else table)
 
+class UniqueDatasetNode(DatasetNode):
+    # Source over a ParquetUniqueDataset: the version of the dataset when the plan is prepared (or as_of) is read for the whole query &
+    # is part of the hash. Partitions with deltas are read merged from the table cache of the dataset (a delta can change rows in
+    # row groups the filters skip), the other pieces by row group (from the cache if the file is in it) without their deleted rows
+    def __init__(self, table, database, cache_obj=None, as_of=None):
+        self.as_of = as_of
+        super().__init__(table, database, cache_obj)
+
+    def bind(self):
+        self.dataset, self.stats = self.database.snapshot(self.table, self.as_of)
+        self.version, self.snapshot = self.database.versions[self.table], self.dataset.version
+        self.partition_keys, self.partition_values = self.stats.partition_keys, self.stats.partition_values
+
+    def read_plan(self, columns_backward=None):
+        # The pinned version, resolved once per read (a read only snapshot if the dataset was written since)
+        self.dataset = self.database.snapshot(self.table, self.snapshot)[0]
+        return super().read_plan(columns_backward)
+
+    def partition_val(self, i):
+        return tuple(self.partition_values[i][k] for k in self.partition_keys)
+
+    def scan_key(self):
+        # Scans of different versions are never merged
+        return json.dumps([self.table, self.snapshot, self.filters, self.sample], sort_keys=True, default=str)
+
+    def scan(self, part_filters, value_filters):
+        deltas, pieces = self.dataset.deltas, super().scan(part_filters, value_filters)
+        merged = [i for i in range(len(self.stats.pieces)) if self.partition_val(i) in deltas and self.partition_check(self.partition_values[i], part_filters)
+                  and (self.restrict is None or self.stats.pieces[i].path in self.restrict)]
+        return sorted([(i, rgs) for i, rgs in pieces if i not in merged] + [(i, None) for i in merged])
+
+    def read_piece(self, ctx, i, row_groups, columns):
+        start, dataset, val, path = time.time(), self.dataset, self.partition_val(i), self.stats.pieces[i].path
+        if val in dataset.deltas:
+            # The first piece of the partition reads the merged partition
+            first = dataset.get_idxs(val)[0] == i
+            t = (dataset.read_partition(val) if first else dataset.arrow_schema.empty_table()).select(columns)
+        else:
+            t = dataset.tables.get(path)
+            if t is None and row_groups is not None:
+                t = pq.ParquetFile(dataset.resolve(path), metadata=dataset.footer(path)).read_row_groups(row_groups, columns=columns)
+            else:
+                t = (t if t is not None else dataset.read_file(path))
+                t = (t.take(pa.array(self.positions(i, row_groups))) if row_groups is not None else t)
+            deleted = dataset.deleted(path)
+            if deleted is not None:
+                t = t.filter(pa.array(np.invert(deleted if row_groups is None else deleted[self.positions(i, row_groups)])))
+            t = t.select(columns)
+        t = pa.Table.from_arrays(t.columns + dataset.partition_arrays(val, t.num_rows), names=columns + self.partition_keys)
+        if ctx.tracers:
+            ctx.trace('piece_read', table=self.table, path=path, row_groups=row_groups, rows=t.num_rows, bytes=t.nbytes, time=time.time() - start)
+        return t
+
+    def positions(self, i, row_groups):
+        starts = np.cumsum([0] + [rg['rows'] for rg in self.stats.row_groups[i]])
+        return np.concatenate([np.arange(starts[r], starts[r + 1]) for r in row_groups])
+
+    def empty(self, columns):
+        t = self.dataset.empty()
+        return t.select(columns + self.partition_keys)
+
 # Operations
 def column_min_max(arr):
     if hasattr(arr, 'dictionary'):
@@ -181,12 +588,12 @@ class JoinNode(BaseNode):
         self.columns = list(set(left.columns + right.columns))
 
         # Forward propagation of nodes
-        self.columns_source, self.columns_forward = list(set(left.columns_source + right.columns_source)), list(set(left.columns_forward + right.columns_forward + on))
+        self.columns_source, self.columns_forward = list(set(left.columns_source + right.columns_source)), list(set(left.columns_forward + right.columns_forward + self.on))
         self.filters_forward = left.filters_forward + right.filters_forward #[f for f in left.filters_forward + right.filters_forward if f[0] in self.on]
 
     def backward(self, columns_backward=[], filters_backward=[]):
         self.columns_bw(columns_backward)
-        self.filters = filters_backward
+        self.filters, self.build_side, self.runtime_pushed = filters_backward, None, []
         filters_l, filters_r = [f for f in self.filters if f[0] in self.left.columns_source], [f for f in self.filters if f[0] in self.right.columns_source]
         columns_l, columns_r = [c for c in self.columns_backward if c in self.left.columns_source], [c for c in self.columns_backward if c in self.right.columns_source]
         hl = self.left.backward(columns_backward=columns_l, filters_backward=filters_l)
@@ -194,10 +601,40 @@ class JoinNode(BaseNode):
         hl.update(hr.digest())
         return self.hash(h=hl)
 
-    def fetch(self, verbose):
-        tl = self.left.get(verbose)
-        tr = self.right.get(verbose)
-        return join(left=tl, right=tr, on=self.on)
+    def estimate_rows(self, filters=None):
+        filters = (self.filters if filters is None else filters)
+        rl = self.left.estimate_rows([f for f in filters if f[0] in self.left.columns_source])
+        rr = self.right.estimate_rows([f for f in filters if f[0] in self.right.columns_source])
+        ndv = lambda side, rows: min(rows, np.prod([float(side.estimate_ndv(c) or rows) for c in self.on]))
+        return int(join_rows(rl, rr, ndv(self.left, rl), ndv(self.right, rr)))
+
+    def estimate_ndv(self, column):
+        return (self.left if column in self.left.columns else self.right).estimate_ndv(column)
+
+    def details(self):
+        return {'build_side': getattr(self, 'build_side', None), 'strategy': getattr(self, 'strategy', None), 'runtime_filters': getattr(self, 'runtime_pushed', [])}
+
+    def runtime_parents(self, filters, blooms, token):
+        for side in [self.left, self.right]:
+            side.runtime([f for f in filters if f[0] in side.columns], [b for b in blooms if all(c in side.columns for c in b[0])], token)
+
+    def fetch(self, ctx):
+        # Evaluate the smaller (build) side first, its join keys filter the scan of the other (probe) side
+        build_left = self.left.estimate_rows() <= self.right.estimate_rows()
+        build, probe = ((self.left, self.right) if build_left else (self.right, self.left))
+        self.build_side, self.runtime_pushed = ('left' if build_left else 'right'), []
+        tb = build.get(ctx)
+        if not (probe.cache and probe.hash_key in probe.cache_obj) and not ctx.shared(probe):
+            fs, blooms = key_filters(tb, self.on)
+            self.runtime_pushed = runtime_info(fs, blooms)
+            if ctx.verbose:
+                print("Runtime filter on {}: {}".format(", ".join(self.on), ", ".join(self.runtime_pushed)))
+            probe.runtime(fs, blooms, token=build.hash_key + json.dumps(self.on))
+        tp = probe.get(ctx)
+        (left, right), profile = ((tb, tp) if build_left else (tp, tb)), {}
+        t = join(left=left, right=right, on=self.on, profile=profile)
+        self.strategy = (strategy_info(profile.pop('strategy'), profile) if profile else None)
+        return t
 
 class FilterNode(BaseNode):
     def __init__(self, parent, filters, cache_obj=None):
@@ -218,8 +655,10 @@ class FilterNode(BaseNode):
         self.hash_key = hp.hexdigest() # Filter node does not change anything, so can just pass its parents hash
         return hp
 
-    def fetch(self, verbose):
-        return self.parent.get(verbose)
+    streamable = True
+
+    def transform(self, t):
+        return t
 
 class AggregateNode(BaseNode):
     def __init__(self, parent, by, methods, cache_obj=None):
@@ -236,15 +675,132 @@ class AggregateNode(BaseNode):
 
     def backward(self, columns_backward=[], filters_backward=[]):
         self.columns_bw(columns_backward)
-        self.filters = [f for f in filters_backward if f[0] in self.methods.keys()] # Intercept filters which are aggregate values
+        # Intercept filters which are aggregate values (filters below the aggregate are passed on)
+        self.filters, self.streamed, self.incremental, self.strategy = [f for f in filters_backward if f[0] in self.methods.keys() and f not in self.parent.filters_forward], False, False, None
         hp = self.parent.backward(columns_backward=self.columns_backward, filters_backward=[f for f in filters_backward if f not in self.filters])
         return self.hash(h=hp)
 
-    def fetch(self, verbose):
-        tp = self.parent.get(verbose)
-        t = groupby(tp, self.by).agg(self.methods)
+    def passes(self, column):
+        return column in self.by
+
+    def estimate_rows(self, filters=None):
+        rows = self.parent.estimate_rows(filters)
+        ndvs = [self.parent.estimate_ndv(c) for c in self.by]
+        return (int(min(rows, np.prod([float(n) for n in ndvs]))) if all(ndvs) else rows)
+
+    def estimate_ndv(self, column):
+        return (self.parent.estimate_ndv(column) if column in self.by else None)
+
+    def details(self):
+        info = ({'having': self.filters} if self.filters else {})
+        info = ({**info, 'incremental': True} if getattr(self, 'incremental', False) else info)
+        info = ({**info, 'strategy': self.strategy} if getattr(self, 'strategy', None) else info)
+        rate = sampled_rate(self.parent)
+        info = ({**info, 'scaled': '1 / {:.4f}, with errors'.format(rate)} if rate is not None else info)
+        return ({**info, 'streamed': True} if getattr(self, 'streamed', False) else info)
+
+    def group(self, t, methods):
+        # Aggregate by self.by, recording the groupify strategy chosen (for the input size & key cardinality)
+        g = groupby(t, self.by)
+        self.strategy = strategy_info(g.strategy, g.strategy_info)
+        return g.agg(methods)
+
+    def fetch(self, ctx):
+        split, tp = split_methods(self.methods), None
+        source, rate = self.source(), sampled_rate(self.parent)
+        if rate is not None:
+            return self.fetch_sampled(ctx, rate)
+        if self.cache and split and not self.filters and isinstance(source, TableNode) and not (source.runtime_filters or source.runtime_blooms):
+            return self.fetch_incremental(ctx, source, *split)
+        try:
+            tp = self.parent.get(ctx)
+        except MemoryLimitError:
+            # Over the memory limit: aggregate the pieces one by one and merge the partial results, if possible
+            if split is None or not self.parent.can_stream():
+                raise
+        if tp is None:
+            # Outside of the except block, so the failed read (referenced by the traceback) is released
+            self.streamed = True
+            if ctx.verbose:
+                print("Memory limit reached, streaming aggregate by {}".format(", ".join(self.by)))
+            return self.fetch_stream(ctx, *split)
+        t = self.group(tp, self.methods)
         return (filters(t, self.filters) if self.filters else t)
 
+    def source(self):
+        # Source of a row-local chain below the aggregate, or None
+        node = self.parent
+        while node.streamable:
+            node = node.parent
+        return (node if node.can_stream() else None)
+
+    def state_key(self):
+        # Key of the partial aggregate state: the chain without the source version
+        h, node = hashlib.sha256(), self
+        while node is not None:
+            h.update(json.dumps({k: v for k, v in node.properties().items() if k != 'version'}, sort_keys=True).encode())
+            node = getattr(node, 'parent', None)
+        return 'aggregate state ' + h.hexdigest()
+
+    def fetch_sampled(self, ctx, rate):
+        # Aggregate of sampled rows (collect(sample=...)), with the sums of squares & counts needed for the errors
+        tp = self.parent.get(ctx)
+        methods = {col: ((m[0], m[1]) if isinstance(m, tuple) else (col, m)) for col, m in self.methods.items()}
+        extra = {}
+        for col, (ref, m) in methods.items():
+            if m in ['sum', 'mean']:
+                if ref + ' squared' not in tp.column_names:
+                    x = tp.column(ref).cast(pa.float64())
+                    tp = tp.append_column(ref + ' squared', pa.compute.multiply(x, x))
+                extra[col + ' squares'] = (ref + ' squared', 'sum')
+            if m == 'mean':
+                extra[col + ' rows'] = (ref, 'count')
+        t = scale_sampled(self.group(tp, {**methods, **extra}), methods, rate)
+        return (filters(t, self.filters) if self.filters else t)
+
+    def fetch_incremental(self, ctx, source, partial, merge, means):
+        # Append-only tables: merge the cached partial aggregates with those of the appended rows
+        key = self.state_key()
+        state = self.cache_obj.get(key)
+        meta = (json.loads(state.schema.metadata[b'wombat_state']) if state is not None else None)
+        if meta and source.appended_since(meta['version'], meta['rows']):
+            source.offset, self.incremental = meta['rows'], True
+            t = self.partial_stream(ctx, partial, merge)
+            t = (self.group(pa.concat_tables([state.replace_schema_metadata(None), t]), merge) if t is not None else state.replace_schema_metadata(None))
+        else:
+            source.offset = 0
+            t = self.partial_stream(ctx, partial, merge)
+        source.offset = 0
+        if t is None:
+            t = self.group(self.parent.get(ctx), self.methods)
+            return (filters(t, self.filters) if self.filters else t)
+
+        meta = json.dumps({'version': source.version, 'rows': source.t.num_rows}).encode()
+        self.cache_obj.replace(key, t.replace_schema_metadata({b'wombat_state': meta}))
+        return finalize_means(t, means, self.columns)
+
+    def fetch_stream(self, ctx, partial, merge, means):
+        t = self.partial_stream(ctx, partial, merge)
+        if t is None:
+            t = self.group(self.parent.get(ctx), self.methods)
+        else:
+            t = finalize_means(t, means, self.columns)
+        return (filters(t, self.filters) if self.filters else t)
+
+    def partial_stream(self, ctx, partial, merge):
+        # Merged partial aggregates of the streamed parent, None if it has no rows
+        # Partial results are merged once they hold twice the rows of the last merge, which keeps them within ~3x the result size
+        parts, rows, merged = [], 0, 0
+        for tp in self.parent.stream(ctx):
+            if tp.num_rows:
+                parts.append(self.group(tp, partial))
+                rows += parts[-1].num_rows
+                merged = (merged or parts[-1].num_rows)
+            if len(parts) > 1 and rows > 2 * merged:
+                parts = [self.group(pa.concat_tables(parts), merge)]
+                rows = merged = parts[0].num_rows
+        return (self.group(pa.concat_tables(parts), merge) if parts else None)
+
 class OrderNode(BaseNode):
     def __init__(self, parent, key, ascending, cache_obj=None):
         self.parent, self.key, self.ascending, self.cache_obj = parent, key, ascending, cache_obj
@@ -257,8 +813,8 @@ class OrderNode(BaseNode):
         # Forward propagation of nodes
         self.columns_source, self.columns_forward, self.filters_forward = parent.columns_source, list(set(parent.columns_forward + ([self.key] if self.key in parent.columns_source else []))), parent.filters_forward
 
-    def fetch(self, verbose):
-        tp = self.parent.get(verbose)
+    def fetch(self, ctx):
+        tp = self.parent.get(ctx)
         idxs = pa.compute.sort_indices(tp.column(self.key)).to_numpy()
         return (tp.take(idxs) if self.ascending else tp.take(idxs[::-1]))
 
@@ -278,8 +834,12 @@ class SelectionNode(BaseNode):
         # Forward propagation of nodes
         self.columns_source, self.columns_forward, self.filters_forward = parent.columns_source, list(set(parent.columns_forward + [c for c in columns if c in parent.columns_source])), parent.filters_forward
         
-    def fetch(self, verbose):
-        tp = self.parent.get(verbose)
+    def passes(self, column):
+        return column not in self.mapping.values()
+
+    streamable = True
+
+    def transform(self, tp):
         if self.aliases:
             return tp.rename_columns([self.mapping.get(col, col) for col in tp.column_names])
         else:
@@ -303,8 +863,15 @@ class CalculationNode(BaseNode):
         hp = self.parent.backward(columns_backward=self.columns_backward, filters_backward=[f for f in filters_backward if f not in self.filters])
         return self.hash(h=hp)
 
-    def fetch(self, verbose):
-        tp = self.parent.get(verbose)
+    def passes(self, column):
+        return column != self.key
+
+    def estimate_ndv(self, column):
+        return (None if column == self.key else self.parent.estimate_ndv(column))
+
+    streamable = True
+
+    def transform(self, tp):
         t = tp.append_column(self.key, self.column.get(tp))
         return (filters(t, self.filters) if self.filters else t)
 
@@ -315,10 +882,10 @@ class BooleanMaskNode(BaseNode):
         self.columns = parent.columns
         self.columns_source, self.columns_forward, self.filters_forward = parent.columns_source, parent.columns_forward, parent.filters_forward
     
-    def fetch(self, verbose):
-        tp = self.parent.get(verbose)
-        t = tp.filter(self.mask.get(tp))
-        return t
+    streamable = True
+
+    def transform(self, tp):
+        return tp.filter(self.mask.get(tp))
 
 class FillNanNode(BaseNode):
     def __init__(self, parent, columns, value, cache_obj=None):
@@ -330,8 +897,12 @@ class FillNanNode(BaseNode):
         # Forward propagation of nodes
         self.columns_source, self.columns_forward, self.filters_forward = parent.columns_source, list(set(parent.columns_forward + [c for c in self.nan_columns if c in parent.columns_source])), parent.filters_forward
     
-    def fetch(self, verbose):
-        t = self.parent.get(verbose)
+    def passes(self, column):
+        return column not in self.nan_columns
+
+    streamable = True
+
+    def transform(self, t):
         for c in self.nan_columns:
             arr = pa.compute.fill_null(t.column(c).combine_chunks(), pa.scalar(self.value))
             t = t.drop([c])
@@ -348,8 +919,12 @@ class CastNode(BaseNode):
         # Forward propagation of nodes
         self.columns_source, self.columns_forward, self.filters_forward = parent.columns_source, list(set(parent.columns_forward + [c for c in list(dtypes.keys()) if c in parent.columns_source])), parent.filters_forward
     
-    def fetch(self, verbose):
-        t = self.parent.get(verbose)
+    def passes(self, column):
+        return column not in self.dtypes
+
+    streamable = True
+
+    def transform(self, t):
         for c, tp in self.dtypes.items():
             arr = pa.array(t.column(c).to_numpy().astype(tp))
             t = t.drop([c])
@@ -366,6 +941,7 @@ class DropNode(BaseNode):
         # Forward propagation of nodes
         self.columns_source, self.columns_forward, self.filters_forward = parent.columns_source, parent.columns_forward, parent.filters_forward
     
-    def fetch(self, verbose):
-        t = self.parent.get(verbose)
+    streamable = True
+
+    def transform(self, t):
         return t.drop(self.drop_columns)
\ No newline at end of file
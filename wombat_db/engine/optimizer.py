@@ -0,0 +1,167 @@
+from wombat_db.engine.nodes import JoinNode, AggregateNode, CalculationNode, SelectionNode
+from wombat_db.engine.column import ColumnNode
+from wombat_db.engine.catalog import join_rows
+from wombat_db.ops.group import split_methods
+from itertools import permutations
+import numpy as np
+import time
+
+# Join chains up to this number of tables are ordered exhaustively, larger chains greedily
+MAX_EXHAUSTIVE_JOINS = 6
+
+# Tree utilities
+def children(node):
+    if hasattr(node, 'parent'):
+        return [node.parent]
+    elif hasattr(node, 'left'):
+        return [node.left, node.right]
+    else:
+        return []
+
+def walk(node):
+    yield node
+    for c in children(node):
+        yield from walk(c)
+
+def rewrite(node, f):
+    # Bottom-up rewrite, f returns the (possibly new) node
+    if hasattr(node, 'parent'):
+        node.parent = rewrite(node.parent, f)
+    elif hasattr(node, 'left'):
+        node.left, node.right = rewrite(node.left, f), rewrite(node.right, f)
+    return f(node)
+
+def describe(node):
+    # Name of the source a subplan reads from
+    while not hasattr(node, 'table') and hasattr(node, 'parent'):
+        node = node.parent
+    return getattr(node, 'table', node.__class__.__name__)
+
+# Eager aggregation: pre-aggregate the side holding the aggregated columns by (join keys + group keys)
+def pushdown_aggregate(node, notes):
+    if not isinstance(node, AggregateNode) or getattr(node, 'eager', False) or not isinstance(node.parent, JoinNode):
+        return node
+    join = node.parent
+    split = split_methods(node.methods)
+    if split is None:
+        return node
+    pre_methods, final_methods, means = split
+    refs = set(ref for ref, _ in pre_methods.values())
+
+    for side, other, is_left in [(join.left, join.right, True), (join.right, join.left, False)]:
+        # All aggregated columns must come from this side, and survive the join (left wins on name clashes)
+        if not all(r in side.columns and r not in join.on for r in refs):
+            continue
+        if not is_left and any(c in other.columns for c in list(refs) + list(pre_methods.keys())):
+            continue
+
+        pre_by = join.on + [c for c in node.by if c in side.columns and c not in join.on]
+        pre = AggregateNode(side, pre_by, pre_methods, cache_obj=node.cache_obj)
+        pre.rewrite = 'eager aggregate'
+        new_join = (JoinNode(pre, other, join.on, cache_obj=join.cache_obj) if is_left else JoinNode(other, pre, join.on, cache_obj=join.cache_obj))
+        last = AggregateNode(new_join, node.by, final_methods, cache_obj=node.cache_obj)
+        last.eager = True
+
+        # Finalize the means and restore the output columns
+        for k, (ks, kc) in means.items():
+            last = CalculationNode(last, k, ColumnNode(ks, required=[ks]).astype('float64') / ColumnNode(kc, required=[kc]), cache_obj=node.cache_obj)
+        if means:
+            last = SelectionNode(last, node.columns, cache_obj=node.cache_obj)
+
+        notes.append("Aggregate by [{}] pushed below join on [{}] as pre-aggregate by [{}]".format(", ".join(node.by), ", ".join(join.on), ", ".join(pre_by)))
+        return last
+    return node
+
+# Join ordering: inner join chains are natural joins, so they can be reordered by estimated cost
+def flatten_joins(node):
+    if isinstance(node, JoinNode):
+        ll, jl = flatten_joins(node.left)
+        lr, jr = flatten_joins(node.right)
+        return ll + lr, jl + jr + [node]
+    return [node], []
+
+class JoinState():
+    # Estimated result of joining a set of tables: rows, columns and distinct counts per column
+    def __init__(self, rows, columns, ndv, cost=0.0):
+        self.rows, self.columns, self.ndv, self.cost = rows, columns, ndv, cost
+
+    def key_ndv(self, keys):
+        return min(self.rows, np.prod([float(self.ndv.get(c) or self.rows) for c in keys]))
+
+    def join(self, other):
+        keys = self.columns & other.columns
+        if not keys:
+            return None
+        rows = join_rows(self.rows, other.rows, self.key_ndv(keys), other.key_ndv(keys))
+        ndv = {c: min(n, rows) for c, n in {**self.ndv, **other.ndv}.items() if n}
+        return JoinState(rows, self.columns | other.columns, ndv, self.cost + other.cost + rows)
+
+def tree_state(node, leaves, states):
+    if isinstance(node, JoinNode):
+        return tree_state(node.left, leaves, states).join(tree_state(node.right, leaves, states))
+    return states[leaves.index(node)]
+
+def order_cost(order, states):
+    state = states[order[0]]
+    for i in order[1:]:
+        state = state.join(states[i])
+        if state is None:
+            return None
+    return state.cost
+
+def greedy_order(states):
+    order = [min(range(len(states)), key=lambda i: states[i].rows)]
+    state = states[order[0]]
+    while len(order) < len(states):
+        options = [(state.join(states[i]), i) for i in range(len(states)) if i not in order]
+        options = [(s, i) for s, i in options if s is not None]
+        if not options:
+            return None
+        state, i = min(options, key=lambda o: o[0].rows)
+        order.append(i)
+    return order
+
+def reorder_joins(node, filters, notes):
+    if not isinstance(node, JoinNode) or getattr(node, 'reordered', False):
+        return node
+    leaves, joins = flatten_joins(node)
+    # Only natural joins (on exactly the shared columns) can be reordered freely
+    if len(leaves) < 3 or any(set(j.on) != set(j.left.columns) & set(j.right.columns) for j in joins):
+        return node
+
+    # Estimate the tables using the filters that will be pushed down to them
+    states = []
+    for leaf in leaves:
+        rows = leaf.estimate_rows([f for f in filters if f[0] in leaf.columns_source])
+        states.append(JoinState(rows, set(leaf.columns), {c: leaf.estimate_ndv(c) for c in leaf.columns}))
+    cost = tree_state(node, leaves, states).cost
+
+    if len(leaves) <= MAX_EXHAUSTIVE_JOINS:
+        costs = [(order_cost(o, states), o) for o in permutations(range(len(leaves)))]
+        costs = [c for c in costs if c[0] is not None]
+        best = (min(costs, key=lambda c: c[0])[1] if costs else None)
+    else:
+        best = greedy_order(states)
+    if best is None or order_cost(best, states) >= cost:
+        return node
+
+    # Build a left-deep tree in the chosen order
+    last, state = leaves[best[0]], states[best[0]]
+    for n, i in enumerate(best[1:]):
+        on = sorted(state.columns & states[i].columns)
+        state = state.join(states[i])
+        last = JoinNode(last, leaves[i], on, cache_obj=node.cache_obj)
+        last.reordered, last.rewrite = True, 'join order {}/{} (est. rows {:.0f})'.format(n + 1, len(best) - 1, state.rows)
+    notes.append("Joins reordered: {} -> {} (estimated intermediate rows {:.0f} -> {:.0f})".format(
+        " x ".join(describe(l) for l in leaves), " x ".join(describe(leaves[i]) for i in best), cost, order_cost(best, states)))
+    return last
+
+def optimize(node, tracers=[]):
+    notes, filters = [], node.filters_forward
+    passes = [('reorder_joins', lambda n: reorder_joins(n, filters, notes)), ('pushdown_aggregate', lambda n: pushdown_aggregate(n, notes))]
+    for name, f in passes:
+        start, before = time.time(), len(notes)
+        node = rewrite(node, f)
+        for t in tracers:
+            t.optimizer_pass(name=name, time=time.time() - start, rewrites=notes[before:])
+    return node, notes
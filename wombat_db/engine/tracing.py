@@ -0,0 +1,50 @@
+import json, threading, time
+
+# Tracers receive the internals of the queries of an engine (Engine.add_tracer)
+# Override the callbacks of interest, or event() to receive all of them
+class Tracer():
+    def event(self, name, fields):
+        pass
+
+    def plan_built(self, **fields):
+        # plan: hash, nodes, rewrites, columns, filters
+        self.event('plan_built', fields)
+
+    def optimizer_pass(self, **fields):
+        # name, time, rewrites
+        self.event('optimizer_pass', fields)
+
+    def node_start(self, **fields):
+        # node, hash, table
+        self.event('node_start', fields)
+
+    def node_end(self, **fields):
+        # node, hash, table, rows, bytes, cached, time (+ memory_peak, memory_current if tracked)
+        self.event('node_end', fields)
+
+    def piece_read(self, **fields):
+        # table, path, row_groups, rows, bytes, time
+        self.event('piece_read', fields)
+
+    def kernel_call(self, **fields):
+        # name, start, time, rows
+        self.event('kernel_call', fields)
+
+class JsonLinesTracer(Tracer):
+    # Appends one json object per event to a local file
+    def __init__(self, path):
+        self.path, self.lock = path, threading.Lock()
+        self.file = open(path, 'a')
+
+    def event(self, name, fields):
+        line = json.dumps({'event': name, 'ts': time.time(), 'thread': threading.get_ident(), **fields}, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,127 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+import hashlib, json, os
+from wombat_db.engine.nodes import AggregateNode, DatasetNode, UniqueDatasetNode, TableNode
+from wombat_db.engine.optimizer import walk
+from wombat_db.ops.group import groupby, split_methods, finalize_means
+
+def definition_hash(node):
+    # Hash of the plan definition, without source versions (which restart when the process does)
+    h = hashlib.sha256()
+    for n in walk(node):
+        h.update(json.dumps({k: v for k, v in n.properties().items() if k != 'version'}, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+def decode(table):
+    # Partition columns are dictionaries of the dataset at read time, store their values to merge & persist them
+    if table is None:
+        return None
+    for i, f in enumerate(table.schema):
+        if pa.types.is_dictionary(f.type):
+            table = table.set_column(i, f.name, table.column(i).cast(f.type.value_type))
+    return table
+
+def is_ipc(path):
+    return os.path.splitext(path)[1] in ['.arrow', '.ipc', '.feather']
+
+# Stored result of a plan, registered as a table. Plans over a single dataset that are row-local (filter,
+# calculate, select, ...) or a decomposable aggregate of those are refreshed with only the new pieces
+class MaterializedView():
+    def __init__(self, name, plan, database, path=None):
+        self.name, self.plan, self.database, self.path = name, plan, database, path
+        self.state, self.pieces = None, []
+        self.analyze()
+        if path and os.path.exists(path) and self.load():
+            self.database.register_table(self.name, self.table())
+            self.refresh()
+        else:
+            self.compute()
+
+    def analyze(self):
+        self.plan.prepare()
+        root = self.plan.last
+        sources = [n for n in walk(root) if isinstance(n, (DatasetNode, TableNode))]
+        # Upserts to a unique dataset change rows without adding pieces, its views are recomputed
+        self.source = (sources[0] if len(sources) == 1 and isinstance(sources[0], DatasetNode) and not isinstance(sources[0], UniqueDatasetNode) else None)
+        self.hash, self.mode, self.split = definition_hash(root), None, None
+        if self.source and root.can_stream():
+            self.mode = 'rows'
+        elif self.source and isinstance(root, AggregateNode) and not root.filters and root.parent.can_stream():
+            self.split = split_methods(root.methods)
+            self.mode = ('aggregate' if self.split else None)
+
+    def source_pieces(self):
+        return ([p.path for p in self.database.catalog[self.source.table].pieces] if self.source else [])
+
+    def compute(self):
+        # Full (re)computation
+        self.analyze()
+        self.state = (self.collect_pieces(None) if self.mode else self.plan.collect())
+        self.pieces = self.source_pieces()
+        self.publish()
+
+    def refresh(self):
+        # Process the pieces added since the last refresh, recompute if pieces were removed (or the plan is not incremental)
+        self.analyze()
+        current = self.source_pieces()
+        if not self.mode or not set(self.pieces) <= set(current):
+            return self.compute()
+        new = [p for p in current if p not in set(self.pieces)]
+        if not new:
+            return self
+        t = self.collect_pieces(new)
+        if t is not None and self.state is not None:
+            t = pa.concat_tables([self.state, t])
+            self.state = (groupby(t, self.plan.last.by).agg(self.split[1]) if self.mode == 'aggregate' else t)
+        elif t is not None:
+            self.state = t
+        self.pieces = current
+        return self.publish()
+
+    def collect_pieces(self, paths):
+        # Rows (or merged partial aggregates) of the plan over a subset of the pieces
+        root, ctx = self.plan.last, self.plan.query_context()
+        self.source.restrict = (set(paths) if paths is not None else None)
+        try:
+            if self.mode == 'rows':
+                ts = [decode(t) for t in root.stream(ctx)]
+                return (pa.concat_tables(ts) if ts else None)
+            return decode(root.partial_stream(ctx, self.split[0], self.split[1]))
+        finally:
+            self.source.restrict = None
+
+    def table(self):
+        if self.mode == 'aggregate':
+            return finalize_means(self.state, self.split[2], self.plan.last.columns)
+        return self.state
+
+    def publish(self):
+        self.database.register_table(self.name, self.table())
+        if self.path:
+            self.save()
+        return self
+
+    # Persistence: the state (partial aggregates) with the processed pieces in the schema metadata
+    def save(self):
+        meta = {b'wombat_view': json.dumps({'hash': self.hash, 'mode': self.mode, 'pieces': self.pieces}).encode()}
+        t = self.state.replace_schema_metadata({**(self.state.schema.metadata or {}), **meta})
+        tmp = self.path + '.tmp'
+        if is_ipc(self.path):
+            with pa.OSFile(tmp, 'wb') as sink:
+                with pa.ipc.new_file(sink, t.schema) as writer:
+                    writer.write_table(t)
+        else:
+            pq.write_table(t, tmp)
+        os.replace(tmp, self.path)
+
+    def load(self):
+        # Returns whether the stored view belongs to this plan
+        if is_ipc(self.path):
+            t = pa.ipc.open_file(pa.memory_map(self.path, 'r')).read_all()
+        else:
+            t = pq.read_table(self.path)
+        meta = json.loads((t.schema.metadata or {}).get(b'wombat_view', b'{}'))
+        if meta.get('hash') != self.hash or meta.get('mode') != self.mode:
+            return False
+        self.state, self.pieces = t.replace_schema_metadata(None), meta['pieces']
+        return True
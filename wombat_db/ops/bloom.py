@@ -0,0 +1,108 @@
+import hashlib
+import numpy as np
+import pyarrow as pa
+
+# Stable 64 bit hashing of (multi) column values. Persisted filters record the HASH_VERSION they were built with
+HASH_VERSION = 2
+
+def mix(h):
+    # Splitmix64 finalizer, uint64 arithmetic wraps around
+    with np.errstate(over='ignore'):
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return h ^ (h >> np.uint64(31))
+
+def hash_binary(arr):
+    # Bytes of the values read 8 at a time (vectorized over the values still that long) & mixed into their hash, starting from the length
+    large = pa.types.is_large_string(arr.type) or pa.types.is_large_binary(arr.type)
+    offsets = np.frombuffer(arr.buffers()[1], dtype=(np.int64 if large else np.int32))[arr.offset:arr.offset + len(arr) + 1].astype(np.int64)
+    starts, lengths = offsets[:-1], np.diff(offsets)
+    data = (np.frombuffer(arr.buffers()[2], dtype=np.uint8) if arr.buffers()[2] is not None else np.zeros(1, dtype=np.uint8))
+    h = mix(lengths.astype(np.uint64))
+    with np.errstate(over='ignore'):
+        for w in range(0, int(lengths.max(initial=0)), 8):
+            rows = np.flatnonzero(lengths > w)
+            word = np.zeros(len(rows), dtype=np.uint64)
+            for b in range(8):
+                inside = lengths[rows] > w + b
+                word |= (data[np.minimum(starts[rows] + w + b, len(data) - 1)] * inside).astype(np.uint64) << np.uint64(8 * b)
+            h[rows] = mix(h[rows] * np.uint64(31) + word)
+    return h
+
+def hash_array(arr):
+    if isinstance(arr, pa.ChunkedArray):
+        return np.concatenate([hash_array(c) for c in arr.chunks] + [np.empty(0, dtype=np.uint64)])
+    if pa.types.is_dictionary(arr.type):
+        # The dictionary values are hashed once
+        values = np.concatenate([hash_array(arr.dictionary), np.zeros(1, dtype=np.uint64)])
+        return values[arr.indices.fill_null(len(arr.dictionary)).to_numpy().astype(np.int64)]
+    if pa.types.is_integer(arr.type) or pa.types.is_floating(arr.type) or pa.types.is_boolean(arr.type):
+        # Hash numerics as float64, so int and float representations of a key collide
+        values = np.asarray(arr.to_numpy(zero_copy_only=False), dtype=np.float64) + 0.0
+        return mix(values.view(np.uint64))
+    elif pa.types.is_string(arr.type) or pa.types.is_binary(arr.type) or pa.types.is_large_string(arr.type) or pa.types.is_large_binary(arr.type):
+        return hash_binary(arr)
+    elif pa.types.is_temporal(arr.type) and arr.type.bit_width in [32, 64]:
+        values = arr.view(pa.int64() if arr.type.bit_width == 64 else pa.int32()).to_numpy(zero_copy_only=False)
+        return mix(np.nan_to_num(values).astype(np.int64).view(np.uint64))
+    else:
+        # Other types by their distinct values
+        encoded = arr.dictionary_encode()
+        f = lambda v: int.from_bytes(hashlib.blake2b(str(v).encode(), digest_size=8).digest(), 'little')
+        values = np.array([f(v) for v in encoded.dictionary.to_pylist()] + [0], dtype=np.uint64)
+        return values[encoded.indices.fill_null(len(encoded.dictionary)).to_numpy()]
+
+def hash_columns(table, columns):
+    h = np.zeros(table.num_rows, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for c in ([columns] if isinstance(columns, str) else columns):
+            h = mix(h * np.uint64(31) + hash_array(table.column(c)))
+    return h
+
+class BloomFilter():
+    # The bits are kept packed, 8 per byte
+    def __init__(self, n, fpp=0.01):
+        self.m = max(64, int(-max(n, 1) * np.log(fpp) / np.log(2) ** 2))
+        self.k = max(1, int(round(self.m / max(n, 1) * np.log(2))))
+        self.bits = np.zeros((self.m + 7) // 8, dtype=np.uint8)
+
+    def positions(self, h):
+        # Double hashing: h1 + i * h2
+        h1, h2 = h & np.uint64(0xffffffff), h >> np.uint64(32)
+        with np.errstate(over='ignore'):
+            return [(h1 + np.uint64(i) * h2) % np.uint64(self.m) for i in range(self.k)]
+
+    def add(self, h):
+        # Unpacked only while adding
+        bits = np.unpackbits(self.bits, count=self.m).astype(bool)
+        for p in self.positions(h):
+            bits[p] = True
+        self.bits = np.packbits(bits)
+        return self
+
+    def contains(self, h):
+        mask = np.ones(len(h), dtype=bool)
+        for p in self.positions(h):
+            mask &= (self.bits[(p >> np.uint64(3)).astype(np.int64)] & (np.uint8(128) >> (p & np.uint64(7)).astype(np.uint8))) > 0
+        return mask
+
+    @classmethod
+    def from_table(cls, table, columns, fpp=0.01):
+        return cls(table.num_rows, fpp).add(hash_columns(table, columns))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def save(self, f):
+        np.savez(f, bits=self.bits, m=self.m, k=self.k, hash=HASH_VERSION)
+
+    @classmethod
+    def load(cls, f):
+        # None for a filter built with another hashing (it can not be used)
+        with np.load(f) as data:
+            if 'hash' not in data or int(data['hash']) != HASH_VERSION:
+                return None
+            bloom = cls.__new__(cls)
+            bloom.m, bloom.k, bloom.bits = int(data['m']), int(data['k']), data['bits']
+            return bloom
@@ -1,6 +1,7 @@
 import numpy as np
 import pyarrow as pa
-from wombat_db.ops.helpers import combine_column, columns_to_array, groupify_array
+from wombat_db.ops.helpers import combine_column, columns_to_array, groupify_array, groupify_strategy
+from wombat_db.ops.trace import kernel
 
 # Grouping / groupby methods
 agg_methods = {
@@ -18,11 +19,52 @@ agg_methods = {
     'first': lambda a: a[0],
     'last': lambda a: a[-1],
 }
-def add_agg_method(self, name, method):
+
+# Methods whose partial results can be merged: partial method -> merge method
+agg_merge_methods = {
+    'sum': 'sum',
+    'count': 'sum',
+    'max': 'max',
+    'min': 'min',
+    'prod': 'prod',
+}
+
+# Methods computed for all groups at once with ufunc.reduceat on the sorted values
+agg_reductions = {
+    np.sum: np.add,
+    np.max: np.maximum,
+    np.min: np.minimum,
+    np.prod: np.multiply,
+}
+
+def split_methods(methods):
+    # Split aggregations in partial & merge steps (mean as sum / count), None if not all methods can be merged
+    methods = {k: (m if isinstance(m, tuple) else (k, m)) for k, m in methods.items()}
+    if not all(m in agg_merge_methods or m == 'mean' for _, m in methods.values()):
+        return None
+    partial, merge, means = {}, {}, {}
+    for k, (ref, m) in methods.items():
+        if m == 'mean':
+            ks, kc = k + ' (sum)', k + ' (count)'
+            partial.update({ks: (ref, 'sum'), kc: (ref, 'count')})
+            merge.update({ks: (ks, 'sum'), kc: (kc, 'sum')})
+            means[k] = (ks, kc)
+        else:
+            partial[k] = (ref, m)
+            merge[k] = (k, agg_merge_methods[m])
+    return partial, merge, means
+
+def finalize_means(table, means, columns):
+    # Divide the merged sums by the counts, and restore the output columns
+    for k, (ks, kc) in means.items():
+        table = table.append_column(k, pa.array(table.column(ks).to_numpy().astype('float64') / table.column(kc).to_numpy()))
+    return table.select(columns)
+
+def agg_method(self, method):
     def f(agg_columns=[]):
-        methods = {col: method for col in (agg_columns if agg_columns else self.table.column_names) if col not in self.columns}
+        methods = {col: (col, method) for col in (agg_columns if agg_columns else self.table.column_names) if col not in self.columns}
         return self.aggregate(methods=methods)
-    setattr(self, name, f)
+    return f
 
 class Grouping():
     def __init__(self, table, columns):
@@ -31,27 +73,37 @@ class Grouping():
 
         # Initialize array + groupify
         self.arr = columns_to_array(table, columns)
-        self.dic, self.counts, self.sort_idxs, self.bgn_idxs = groupify_array(self.arr)
-        self.set_methods()
+        self.strategy, self.strategy_info = groupify_strategy(self.arr)
+        self.dic, self.counts, self.sort_idxs, self.bgn_idxs = groupify_array(self.arr, self.strategy)
 
     def __iter__(self):
         for i in range(len(self.dic)):
             idxs = self.sort_idxs[self.bgn_idxs[i] : self.bgn_idxs[i] + self.counts[i]]
             yield {k: v[0] for k, v in self.table.select(self.columns).take([self.sort_idxs[self.bgn_idxs[i]]]).to_pydict().items()}, self.table.take(idxs)
 
-    # Aggregation methods
-    def set_methods(self):
-        for k, m in agg_methods.items():
-            add_agg_method(self, k, m)
+    # Aggregation methods (looked up on access: storing them on the instance would create a reference cycle keeping the table alive)
+    def __getattr__(self, name):
+        if name in agg_methods:
+            return agg_method(self, agg_methods[name])
+        raise AttributeError(name)
 
+    @kernel
     def aggregate(self, methods):
         # Create index columns
         table = self.table.select(self.columns).take(self.sort_idxs[self.bgn_idxs])
         self.refs = list(set(c for c, _ in methods.values()))
         data = {k: self.table.column(k).to_numpy() for k in self.refs}
         for col, (ref, f) in methods.items():
-            vf = np.vectorize(f, otypes=[object])
-            agg_arr = vf(np.split(data[ref][self.sort_idxs], self.bgn_idxs[1:]))
+            arr = data[ref][self.sort_idxs]
+            if f is np.size:
+                agg_arr = self.counts
+            elif f in agg_reductions and arr.dtype.kind in 'iuf':
+                # Vectorized over the groups (integer sums & products widen like np.sum does)
+                dtype = ({'i': np.int64, 'u': np.uint64}.get(arr.dtype.kind) if f in [np.sum, np.prod] else None)
+                agg_arr = agg_reductions[f].reduceat(arr, self.bgn_idxs, dtype=dtype)
+            else:
+                # Note: np.vectorize would treat equally sized groups as a 2D array
+                agg_arr = np.array([f(a) for a in np.split(arr, self.bgn_idxs[1:])], dtype=object)
             table = table.append_column(col, pa.array(agg_arr))
         return table
 
@@ -59,5 +111,6 @@ class Grouping():
         methods = {col: ((m[0], agg_methods[m[1]]) if isinstance(m, tuple) else (col, agg_methods[m])) for col, m in methods.items()}
         return self.aggregate(methods=methods)
 
+@kernel
 def groupby(table, by):
     return Grouping(table, by)
\ No newline at end of file
@@ -2,16 +2,72 @@ import numpy as np
 import pyarrow as pa
 import pyarrow.compute as pc
 
-def groupify_array(arr):
+# Groupify strategies, chosen at runtime from the size, value range & (sampled) cardinality of the array
+COUNTING_MAX_RANGE = 2 ** 16 # Integer ranges up to this are counted (bincount & radix sort)
+HASH_SAMPLE, HASH_MAX_FRACTION = 10000, 0.1 # Distinct fraction in a sample up to which values are hashed first
+
+def narrow(codes, size):
+    # Smallest unsigned type for codes in [0, size): numpy uses a radix sort for stable sorts of 8 & 16 bit integers
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if size <= np.iinfo(dtype).max + 1:
+            return codes.astype(dtype)
+    return codes.astype(np.int64)
+
+def groupify_strategy(arr):
+    # Returns (strategy, info): 'counting' for small integer ranges, 'hash' for few distinct values in a large range, else 'sort'
+    n = len(arr)
+    if n == 0:
+        return 'sort', {'rows': 0}
+    if arr.dtype.kind in 'iu':
+        lo, hi = arr.min(), arr.max()
+        if int(hi) - int(lo) < COUNTING_MAX_RANGE:
+            return 'counting', {'rows': n, 'range': int(hi) - int(lo) + 1, 'max_range': COUNTING_MAX_RANGE}
+    if n > HASH_SAMPLE:
+        sample = arr[np.random.default_rng(0).integers(0, n, HASH_SAMPLE)]
+        distinct = len(np.unique(sample))
+        if distinct <= HASH_MAX_FRACTION * HASH_SAMPLE:
+            return 'hash', {'rows': n, 'sample_distinct': distinct, 'max_distinct': int(HASH_MAX_FRACTION * HASH_SAMPLE)}
+    return 'sort', {'rows': n}
+
+def groupify_counting(arr, lo=None):
+    # Counts per value & a stable (radix) sort of the offsets from the minimum
+    lo = (arr.min() if lo is None else lo)
+    size = int(arr.max() - lo) + 1
+    codes = narrow(arr - lo, size)
+    counts = np.bincount(codes, minlength=size)
+    present = np.flatnonzero(counts)
+    counts = counts[present]
+    return (present + lo).astype(arr.dtype), counts, np.argsort(codes, kind='stable'), [0] + np.cumsum(counts)[:-1].tolist()
+
+def groupify_hash(arr):
+    # Dictionary encode (hashing), then count the codes ranked by their (few) sorted values
+    encoded = pc.dictionary_encode(pa.array(arr))
+    dic, codes = encoded.dictionary.to_numpy(zero_copy_only=False), encoded.indices.to_numpy()
+    order = np.argsort(dic, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    _, counts, sort_idx, bgn_idxs = groupify_counting(rank[codes], lo=0)
+    return dic[order].astype(arr.dtype), counts, sort_idx, bgn_idxs
+
+def groupify_sort(arr):
+    # A single stable sort, groups start where the sorted value changes
+    sort_idx = np.argsort(arr, kind='stable')
+    s = arr[sort_idx]
+    bgn = np.flatnonzero(np.concatenate([[True], s[1:] != s[:-1]]))
+    return s[bgn], np.diff(np.append(bgn, len(s))), sort_idx, bgn.tolist()
+
+GROUPIFY = {'counting': groupify_counting, 'hash': groupify_hash, 'sort': groupify_sort}
+
+def groupify_array(arr, strategy=None):
     # Input: Pyarrow/Numpy array
     # Output:
     #   - 1. Unique values
-    #   - 2. Sort index
-    #   - 3. Count per unique
+    #   - 2. Count per unique
+    #   - 3. Sort index
     #   - 4. Begin index per unique
-    dic, counts = np.unique(arr, return_counts=True)
-    sort_idx = np.argsort(arr)
-    return dic, counts, sort_idx, [0] + np.cumsum(counts)[:-1].tolist()
+    if len(arr) == 0:
+        return arr[:0], np.array([], dtype=np.int64), np.array([], dtype=np.int64), []
+    return GROUPIFY[strategy or groupify_strategy(arr)[0]](arr)
 
 def combine_column(table, name):
     return table.column(name).combine_chunks()
@@ -1,7 +1,9 @@
 import time
 import numpy as np
 import pyarrow as pa
-from wombat_db.ops.helpers import columns_to_array, tables_to_arrays, groupify_array
+import pyarrow.compute as pc
+from wombat_db.ops.helpers import columns_to_array, tables_to_arrays, groupify_array, narrow, COUNTING_MAX_RANGE
+from wombat_db.ops.trace import kernel
 from cjoin import inner_join
 
 def align_tables(t1, t2, l1, l2):
@@ -12,32 +14,96 @@ def align_tables(t1, t2, l1, l2):
             table = table.append_column(c, t2.column(c).take(l2))
     return table
 
-def join(left, right, on):
-    # Gather join columns
-    l_arr, r_arr = tables_to_arrays(left, right, on)
-    
-    # Groupify the join array
-    ld, lc, lidxs, lbi = groupify_array(l_arr)
-    rd, rc, ridxs, rbi = groupify_array(r_arr)
-
-    # Find both dicts
-    bd, inv = np.unique(np.concatenate([ld, rd]), return_inverse=True)
-    
-    # Align Left side
-    linv = inv[:ld.shape[0]]
-    lcc, lbic = np.zeros_like(bd), np.zeros_like(bd)
-    lcc[linv] = lc
-    lbic[linv] = lbi
-    
-    # Align right side
-    rinv = inv[ld.shape[0]:]
-    rcc, rbic = np.zeros_like(bd), np.zeros_like(bd)
-    rcc[rinv] = rc
-    rbic[rinv] = rbi
-
-    # Perform cjoin
-    left_align, right_align = inner_join(lidxs.astype(np.int64), ridxs.astype(np.int64), lcc.astype(np.int64), rcc.astype(np.int64), lbic.astype(np.int64), rbic.astype(np.int64))   
+# Join strategies, chosen at runtime from the input sizes & key order
+BROADCAST_MAX_ROWS, BROADCAST_MAX_RATIO = 10 ** 6, 0.25 # Build sides up to this size (& fraction of the other side) are broadcast
 
+def is_sorted(arr):
+    return bool(np.all(arr[:-1] <= arr[1:]))
+
+def join_strategy(left, right, on, codes=None):
+    # Returns (strategy, info): 'sort-merge' for single numeric keys sorted on both sides, 'broadcast' for a small build side, else 'partitioned'.
+    # Given the key codes (see join), a small build side is only broadcast if its keys are unique or too many to bucket by counting
+    small, large = sorted([left.num_rows, right.num_rows])
+    info = {'rows': [left.num_rows, right.num_rows]}
+    if codes is None and len(on) == 1 and all(t.column(on[0]).null_count == 0 and (pa.types.is_integer(t.column(on[0]).type) or pa.types.is_floating(t.column(on[0]).type)) for t in [left, right]):
+        if is_sorted(left.column(on[0]).to_numpy()) and is_sorted(right.column(on[0]).to_numpy()):
+            return 'sort-merge', info
+    if not (small <= BROADCAST_MAX_ROWS and small <= BROADCAST_MAX_RATIO * large):
+        return 'partitioned', info
+    if codes is None:
+        return 'broadcast', info
+    build_left = left.num_rows <= right.num_rows
+    keys, unique = int(max(codes[0].max(), codes[1].max())) + 1, bool(np.bincount(codes[0] if build_left else codes[1]).max() <= 1)
+    info = {**info, 'build': ('left' if build_left else 'right'), 'unique_build': unique, 'keys': keys, 'max_rows': BROADCAST_MAX_ROWS, 'max_ratio': BROADCAST_MAX_RATIO, 'max_range': COUNTING_MAX_RANGE}
+    return ('broadcast' if unique or keys > COUNTING_MAX_RANGE else 'partitioned'), info
+
+def counting_groups(codes, size):
+    # Counts, stable order & begin index per code in [0, size)
+    counts = np.bincount(codes, minlength=size)
+    return counts, np.argsort(narrow(codes, size), kind='stable'), np.cumsum(counts) - counts
+
+def join_partitioned(l_arr, r_arr):
+    # Both sides bucketed by their (shared) key codes, matching buckets are combined
+    size = int(max(l_arr.max(), r_arr.max())) + 1
+    lc, lidxs, lbi = counting_groups(l_arr, size)
+    rc, ridxs, rbi = counting_groups(r_arr, size)
+    return inner_join(lidxs.astype(np.int64), ridxs.astype(np.int64), lc.astype(np.int64), rc.astype(np.int64), lbi.astype(np.int64), rbi.astype(np.int64))
+
+def join_broadcast(b_arr, p_arr):
+    # Only the build side is grouped, the probe side is matched row by row (in its own order)
+    size = int(max(b_arr.max(), p_arr.max())) + 1
+    bc, bidxs, bbi = counting_groups(b_arr, size)
+    if bc.max() <= 1:
+        # Unique build keys (e.g. a dimension table): at most one match per probe row
+        p_align = np.flatnonzero(bc[p_arr])
+        return bidxs[bbi[p_arr[p_align]]], p_align
+    matches = bc[p_arr]
+    p_align = np.repeat(np.arange(len(p_arr)), matches)
+    offsets = np.arange(len(p_align)) - np.repeat(np.cumsum(matches) - matches, matches)
+    return bidxs[np.repeat(bbi[p_arr], matches) + offsets], p_align
+
+def runs(arr):
+    bgn = np.flatnonzero(np.concatenate([[True], arr[1:] != arr[:-1]]))
+    return arr[bgn], np.diff(np.append(bgn, len(arr))), bgn
+
+def join_sort_merge(l_arr, r_arr):
+    # Sorted keys: runs of equal keys are matched by binary search, without hashing or sorting
+    lv, lc, lbi = runs(l_arr)
+    rv, rc, rbi = runs(r_arr)
+    pos = np.minimum(np.searchsorted(rv, lv), len(rv) - 1)
+    match = np.flatnonzero(rv[pos] == lv)
+    lidxs, ridxs = np.arange(len(l_arr), dtype=np.int64), np.arange(len(r_arr), dtype=np.int64)
+    return inner_join(lidxs, ridxs, lc[match].astype(np.int64), rc[pos[match]].astype(np.int64), lbi[match].astype(np.int64), rbi[pos[match]].astype(np.int64))
+
+@kernel
+def join(left, right, on, strategy=None, profile=None):
+    # Strategy: 'sort-merge', 'broadcast', 'partitioned' or None (chosen at runtime, see join_strategy), reported in profile (dict)
+    if left.num_rows == 0 or right.num_rows == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return align_tables(left, right, empty, empty)
+    auto = strategy is None
+    strategy, info = ((strategy, {'rows': [left.num_rows, right.num_rows]}) if strategy else join_strategy(left, right, on))
+
+    if strategy == 'sort-merge':
+        left_align, right_align = join_sort_merge(left.column(on[0]).to_numpy(), right.column(on[0]).to_numpy())
+    else:
+        # Gather join columns (as codes of the distinct keys of both sides)
+        l_arr, r_arr = tables_to_arrays(left, right, on)
+        if max(l_arr.max(), r_arr.max()) >= left.num_rows + right.num_rows:
+            # Combined codes of multiple columns can be sparse, renumber them densely (by hashing)
+            codes = pc.dictionary_encode(pa.array(np.concatenate([l_arr, r_arr]))).indices.to_numpy()
+            l_arr, r_arr = codes[:len(l_arr)], codes[len(l_arr):]
+        if auto and strategy == 'broadcast':
+            strategy, info = join_strategy(left, right, on, codes=(l_arr, r_arr))
+
+        if strategy == 'broadcast' and left.num_rows <= right.num_rows:
+            left_align, right_align = join_broadcast(l_arr, r_arr)
+        elif strategy == 'broadcast':
+            right_align, left_align = join_broadcast(r_arr, l_arr)
+        else:
+            left_align, right_align = join_partitioned(l_arr, r_arr)
+    if profile is not None:
+        profile.update({'strategy': strategy, **info})
     return align_tables(left, right, left_align, right_align)
 
 # Old Code:
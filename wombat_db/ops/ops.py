@@ -1,6 +1,7 @@
 import numpy as np
 import pyarrow as pa
 from wombat_db.ops.helpers import columns_to_array, groupify_array
+from wombat_db.ops.trace import kernel
 
 # Filter functionality
 def arr_op_to_idxs(arr, op, value):
@@ -31,6 +32,7 @@ def arr_op_to_idxs(arr, op, value):
     else:
         raise Exception("Operand {} is not implemented!".format(op))
 
+@kernel
 def filters(table, filters):
     filters = ([filters] if isinstance(filters, tuple) else filters)
     # Filter is a list of (col, op, value) tuples
@@ -42,6 +44,7 @@ def filters(table, filters):
     return table.take(idxs)
 
 # Drop duplicates
+@kernel
 def drop_duplicates(table, on=[], keep='first'):
     # Gather columns to arr
     arr = columns_to_array(table, (on if on else table.column_names))
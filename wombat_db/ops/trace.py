@@ -0,0 +1,31 @@
+import threading, time
+from functools import wraps
+from contextlib import contextmanager
+
+# Tracers receiving kernel calls, per thread (set by the engine while a query executes)
+state = threading.local()
+
+def kernel(f):
+    # Report calls of an ops kernel to the active tracers, a single attribute lookup if there are none
+    name = f.__module__.split('.')[-1] + '.' + f.__qualname__
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        tracers = getattr(state, 'tracers', None)
+        if not tracers:
+            return f(*args, **kwargs)
+        start = time.time()
+        result = f(*args, **kwargs)
+        rows = getattr(result, 'num_rows', None)
+        for t in tracers:
+            t.kernel_call(name=name, start=start, time=time.time() - start, rows=rows)
+        return result
+    return wrapper
+
+@contextmanager
+def tracing(tracers):
+    previous = getattr(state, 'tracers', None)
+    state.tracers = tracers
+    try:
+        yield
+    finally:
+        state.tracers = previous